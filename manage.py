@@ -44,6 +44,7 @@ from portal.models.questionnaire_bank import (
     add_static_questionnaire_bank,
 )
 from portal.models.questionnaire_response import QuestionnaireResponse
+from portal.models.reference_data import ReferenceData
 from portal.models.relationship import add_static_relationships
 from portal.models.research_study import (
     add_static_research_studies,
@@ -62,6 +63,7 @@ from portal.models.user import (
     suppress_email,
     validate_email,
 )
+from portal.stage_timing import reset_timings, timing_report
 from portal.tasks import celery_beat_health_check
 
 app = create_app()
@@ -173,6 +175,9 @@ def seed(keep_unmentioned=False):
     SitePersistence(target_dir=None).import_(
         keep_unmentioned=keep_unmentioned)
 
+    # signal all processes to reload roles, interventions, etc.
+    ReferenceData.bump_generation()
+
 
 @click.option('--directory', '-d', default=None, help="Export directory")
 @click.option(
@@ -424,6 +429,27 @@ def healthcheck():
     return sys.exit(result.status_code)
 
 
+@click.option(
+    '--pipeline', '-p', default=None,
+    help="limit report to named pipeline, i.e. communication")
+@click.option('--reset', is_flag=True, help="clear timings after report")
+@app.cli.command()
+def stage_timings(pipeline, reset):
+    """Report percentile timings of messaging pipeline stages"""
+    report = timing_report(pipeline=pipeline)
+    row = "{:<16} {:<16} {:>7} {:>9} {:>9} {:>9} {:>9}"
+    click.echo(row.format(
+        'pipeline', 'stage', 'count', 'p50', 'p90', 'p99', 'max'))
+    for name, stages in sorted(report.items()):
+        for stage, stats in sorted(stages.items()):
+            click.echo(row.format(
+                name, stage, stats['count'],
+                *("{:.3f}".format(stats[k]) for k in (
+                    'p50', 'p90', 'p99', 'max'))))
+    if reset:
+        reset_timings(pipeline=pipeline)
+
+
 @click.option('--email', '-e', help='Email address wanting no communication')
 @click.option(
     '--actor', '-a',
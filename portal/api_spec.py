@@ -0,0 +1,89 @@
+"""Module for the swagger API spec and schema validators derived from it
+
+Generating the spec walks the docstring of every view function, so it is
+done once per process (lazily, on first use) and shared thereafter.
+Likewise, the schema validators built from the spec's definitions are
+compiled once and reused for every document validated.
+
+"""
+from flask import current_app
+from flask_swagger import swagger
+import jsonschema
+
+SPEC_KEY = 'swagger_spec'
+VALIDATORS_KEY = 'schema_validators'
+
+
+def swagger_spec(app=None):
+    """Return the swagger spec for the app, generating on first call
+
+    NB - the returned spec is shared; callers intending to modify must
+    make a copy.
+
+    """
+    app = app or current_app._get_current_object()
+    if SPEC_KEY not in app.extensions:
+        app.extensions[SPEC_KEY] = swagger(app)
+    return app.extensions[SPEC_KEY]
+
+
+def schema_validator(definition, app=None):
+    """Return the compiled draft 4 validator for the named spec definition
+
+    :param definition: name of the schema within the spec's definitions,
+      i.e. 'QuestionnaireResponse'
+
+    """
+    app = app or current_app._get_current_object()
+    validators = app.extensions.setdefault(VALIDATORS_KEY, {})
+    if definition not in validators:
+        definitions = swagger_spec(app)['definitions']
+        draft4_schema = {
+            '$schema': 'http://json-schema.org/draft-04/schema#',
+            'type': 'object',
+            'definitions': definitions,
+        }
+        # Copy desired schema (to validate against) to outermost dict
+        draft4_schema.update(definitions[definition])
+        jsonschema.Draft4Validator.check_schema(draft4_schema)
+        validators[definition] = jsonschema.Draft4Validator(draft4_schema)
+    return validators[definition]
+
+
+def structural_check(document, schema):
+    """Cheap check of the top level structure against the schema
+
+    Rejects documents that aren't objects, lack required properties or
+    include properties the schema doesn't allow, without the expense of
+    full validation.
+
+    :raises jsonschema.ValidationError: on the first problem found
+
+    """
+    if not isinstance(document, dict):
+        raise jsonschema.ValidationError(
+            "{!r} is not of type 'object'".format(document))
+    for required in schema.get('required', ()):
+        if required not in document:
+            raise jsonschema.ValidationError(
+                "{!r} is a required property".format(required))
+    if schema.get('additionalProperties') is False:
+        extra = set(document) - set(schema.get('properties', {}))
+        if extra:
+            raise jsonschema.ValidationError(
+                "Additional properties are not allowed ({} unexpected)".format(
+                    ', '.join(repr(e) for e in sorted(extra))))
+
+
+def validate(document, definition):
+    """Validate the document against the named spec definition
+
+    :raises jsonschema.ValidationError: for the most relevant error, as
+      chosen by ``jsonschema.validate()``
+
+    """
+    validator = schema_validator(definition)
+    structural_check(document, validator.schema)
+    error = jsonschema.exceptions.best_match(validator.iter_errors(document))
+    if error is not None:
+        raise error
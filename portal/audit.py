@@ -25,12 +25,15 @@ from .models.audit import Audit
 AUDIT = int((logging.WARN + logging.ERROR) / 2)
 
 
-def auditable_event(message, user_id, subject_id, context="other"):
+def auditable_event(
+        message, user_id, subject_id, context="other", commit=True):
     """Record auditable event
 
     message: The message to record, i.e. "log in via facebook"
     user_id: The authenticated user id performing the action
     subject_id: The user id upon which the action was performed
+    commit: Set False to leave the commit to the caller, as when
+      recording within a larger transaction
 
     """
     text = "performed by {0} on {1}: {2}: {3}".format(
@@ -41,7 +44,8 @@ def auditable_event(message, user_id, subject_id, context="other"):
         db.session.add(Audit(
             user_id=user_id, subject_id=subject_id, comment=message,
             context=context))
-        db.session.commit()
+        if commit:
+            db.session.commit()
 
 
 def configure_audit_log(app):  # pragma: no cover
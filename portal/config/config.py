@@ -64,6 +64,7 @@ class BaseConfig(object):
     )
 
     ANONYMOUS_USER_ACCOUNT = True
+    ASSESSMENT_PAGE_MAX_COUNT = 1000  # upper bound on bulk `_count`
     BROKER_URL = os.environ.get(
         'BROKER_URL',
         REDIS_URL
@@ -78,6 +79,20 @@ class BaseConfig(object):
     )
     REQUEST_CACHE_EXPIRE = 10
 
+    # Remote (Liferay) content cache; see `app_text.cached_request()`
+    CONTENT_CACHE_TIMEOUT = int(
+        os.environ.get('CONTENT_CACHE_TIMEOUT', 5 * 60))
+    CONTENT_CACHE_STALE_TIMEOUT = int(
+        os.environ.get('CONTENT_CACHE_STALE_TIMEOUT', 24 * 60 * 60))
+    CONTENT_HTTP_POOL_SIZE = 10
+    CONTENT_REQUEST_TIMEOUT = 30  # units: seconds
+    FRAGMENT_CACHE_TIMEOUT = 5 * 60  # portal wrapper & footer fragments
+    # stored organization FHIR documents; also retired on any org change
+    ORGANIZATION_FHIR_CACHE_TIMEOUT = 60 * 60
+    REFERENCE_DATA_CHECK_INTERVAL = 60  # seconds between generation checks
+    # QB_Status instances as of now are shared by a request for this long
+    QB_STATUS_NOW_BUCKET_SECONDS = 60  # units: seconds; 0 to not share
+
     MAIL_SERVER = os.environ.get('MAIL_SERVER', 'localhost')
     MAIL_PORT = int(os.environ.get('MAIL_PORT', 25))
     MAIL_USERNAME = os.environ.get('MAIL_USERNAME')
@@ -86,6 +101,19 @@ class BaseConfig(object):
     MAIL_SUPPRESS_SEND = os.environ.get(
         'MAIL_SUPPRESS_SEND',
         str(TESTING)).lower() == 'true'
+    # EMPRO trigger state rows claimed per batch by fire_trigger_events
+    TRIGGER_EVENT_BATCH_SIZE = int(os.environ.get(
+        'TRIGGER_EVENT_BATCH_SIZE', 10))
+    # seconds after which an unreleased claim on a trigger state row lapses
+    TRIGGER_EVENT_CLAIM_SECONDS = 60 * 10
+    # bound on /api/patient/<id>/triggers long-poll `wait`.  Each waiting
+    # request occupies a sync gunicorn worker (of WEB_CONCURRENCY); only
+    # raise when serving with async (e.g. gevent) workers
+    TRIGGER_STATE_MAX_WAIT_SECONDS = float(os.environ.get(
+        'TRIGGER_STATE_MAX_WAIT_SECONDS', 2))
+    # communications sent per SMTP connection / celery task
+    SEND_COMMUNICATION_BATCH_SIZE = int(os.environ.get(
+        'SEND_COMMUNICATION_BATCH_SIZE', 50))
     CONTACT_SENDTO_EMAIL = os.environ.get('CONTACT_SENDTO_EMAIL')
     ERROR_SENDTO_EMAIL = os.environ.get('ERROR_SENDTO_EMAIL')
     FLUSH_CACHE_ON_SYNC = (
@@ -133,6 +161,7 @@ class BaseConfig(object):
     RCT_INTERVENTIONS = [
         'care_plan', 'community_of_wellness', 'sexual_recovery']
     REPORTING_IDENTIFIER_SYSTEMS = []
+    RESOURCE_VERSION_TTL = 60 * 60 * 24 * 7  # units: seconds
     SHOW_EXPLORE = True
     SHOW_PROFILE_MACROS = ['ethnicity', 'race']
     SHOW_PUBLIC_TERMS = True
@@ -155,6 +184,16 @@ class BaseConfig(object):
     UPDATE_PATIENT_TASK_BATCH_SIZE = int(
         os.environ.get('UPDATE_PATIENT_TASK_BATCH_SIZE', 16)
     )
+    # batches are sized from observed cost, to take about this long
+    UPDATE_PATIENT_TASK_TARGET_SECONDS = int(
+        os.environ.get('UPDATE_PATIENT_TASK_TARGET_SECONDS', 60))
+    UPDATE_PATIENT_TASK_MAX_BATCH_SIZE = int(
+        os.environ.get('UPDATE_PATIENT_TASK_MAX_BATCH_SIZE', 256))
+    UPDATE_PATIENT_IN_FLIGHT_TIMEOUT = 4 * 60 * 60  # seconds
+    UPDATE_PATIENT_PRIORITY_WINDOW = 24  # hours, to upcoming QB transition
+    STAGE_TIMING_ENABLED = (
+        os.environ.get('STAGE_TIMING_ENABLED', 'true').lower() == 'true')
+    STAGE_TIMING_SAMPLES = 1000  # most recent durations kept per stage
     USER_APP_NAME = 'TrueNTH'  # used by email templates
     USER_AFTER_LOGIN_ENDPOINT = 'auth.next_after_login'
     USER_AFTER_CONFIRM_ENDPOINT = USER_AFTER_LOGIN_ENDPOINT
@@ -177,12 +216,33 @@ class BaseConfig(object):
 
     DEFAULT_LOCALE = 'en_US'
     FILE_UPLOAD_DIR = os.environ.get('FILE_UPLOAD_DIR', 'uploads')
+    EXPORT_DIR = os.environ.get('EXPORT_DIR', 'exports')
+    EXPORT_CHUNK_SIZE = 500  # patients per bulk export chunk task
+    EXPORT_YIELD_PER = 200  # rows fetched per server side cursor round trip
+    EXPORT_RETENTION_HOURS = 24  # bulk export files purged thereafter
 
     LR_ORIGIN = os.environ.get('LR_ORIGIN', 'https://cms-stage.us.truenth.org')
     LR_GROUP = os.environ.get('LR_GROUP', 20129)
     LR_FOLDER_ST = os.environ.get('LR_FOLDER_ST', 34666)
 
     SDC_BASE_URL = os.environ.get('SDC_BASE_URL', 'http://sdc:5000/v/r2/fhir')
+    SDC_HTTP_POOL_SIZE = 4
+    SDC_CONNECT_TIMEOUT = 5  # units: seconds
+    SDC_READ_TIMEOUT = int(os.environ.get('SDC_READ_TIMEOUT', 30))
+    SDC_RETRIES = int(os.environ.get('SDC_RETRIES', 3))
+    SDC_BACKOFF_SECONDS = 0.5  # base of jittered exponential backoff
+    SDC_BACKOFF_CAP_SECONDS = 10
+    # post a Bundle of pending QNRs when a backlog exists
+    SDC_BULK_EXTRACT = (
+        os.environ.get('SDC_BULK_EXTRACT', 'false').lower() == 'true')
+    SDC_BULK_SIZE = 20
+
+    # run post QuestionnaireResponse submission work on a celery queue;
+    # only enable where a worker consumes the post_submission queue
+    POST_SUBMISSION_ASYNC = (
+        os.environ.get('POST_SUBMISSION_ASYNC', 'false').lower() == 'true')
+    POST_SUBMISSION_WAIT_SECONDS = 3  # readers wait on pending submissions
+    POST_SUBMISSION_VERSION_TTL = 60 * 60 * 24  # units: seconds
 
     SYSTEM_TYPE = os.environ.get('SYSTEM_TYPE', 'development')
 
@@ -276,4 +336,8 @@ class TestConfig(BaseConfig):
 
     WTF_CSRF_ENABLED = False
     FILE_UPLOAD_DIR = 'test_uploads'
+    EXPORT_DIR = 'test_exports'
+    REFERENCE_DATA_CHECK_INTERVAL = 0  # db changes between tests
+    QB_STATUS_NOW_BUCKET_SECONDS = 0
+    POST_SUBMISSION_ASYNC = False
     SECRET_KEY = 'testing key'
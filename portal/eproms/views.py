@@ -90,17 +90,12 @@ def assessment_engine_view(user):
     embedded within another page, not made into a response object.
 
     """
-    from datetime import datetime
     from ..models.overall_status import OverallStatus
-    from ..models.qb_status import QB_Status, patient_research_study_status
+    from ..models.qb_status import patient_research_study_status, qb_status
     from ..models.research_study import BASE_RS_ID, EMPRO_RS_ID, ResearchStudy
-    now = datetime.utcnow()
 
     research_study_status = patient_research_study_status(user)
-    assessment_status = QB_Status(
-        user=user,
-        research_study_id=BASE_RS_ID,
-        as_of_date=now)
+    assessment_status = qb_status(user=user, research_study_id=BASE_RS_ID)
     unstarted_indefinite_instruments = (
         assessment_status.instruments_needing_full_assessment(
             classification='indefinite'))
@@ -122,10 +117,8 @@ def assessment_engine_view(user):
         research_study_status.get(BASE_RS_ID, {}).get('ready', False))
     enrolled_in_indefinite = assessment_status.enrolled_in_classification(
         "indefinite")
-    substudy_assessment_status = QB_Status(
-        user=user,
-        research_study_id=EMPRO_RS_ID,
-        as_of_date=now)
+    substudy_assessment_status = qb_status(
+        user=user, research_study_id=EMPRO_RS_ID)
     enrolled_in_substudy = EMPRO_RS_ID in research_study_status
     substudy_due_date = (
         localize_datetime(substudy_assessment_status.target_date, user)
@@ -0,0 +1,83 @@
+"""EMPRO domain score table, populated from existing Observations
+
+Revision ID: 3c0d9b1e5a72
+Revises: ebb5fee8122b
+Create Date: 2026-10-19 09:12:44.301867
+
+"""
+from alembic import op
+from flask import current_app
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '3c0d9b1e5a72'
+down_revision = 'ebb5fee8122b'
+
+
+def upgrade():
+    if current_app.config.get('GIL'):
+        return
+    op.create_table(
+        'empro_domain_scores',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('questionnaire_response_id', sa.Integer(), nullable=False),
+        sa.Column('user_id', sa.Integer(), nullable=False),
+        sa.Column('authored', sa.DateTime(), nullable=False),
+        sa.Column('domain', sa.Text(), nullable=False),
+        sa.Column('link_id', sa.Text(), nullable=False),
+        sa.Column('score', sa.Integer(), nullable=False),
+        sa.Column('severity', sa.Text(), nullable=True),
+        sa.ForeignKeyConstraint(
+            ['questionnaire_response_id'], ['questionnaire_responses.id'],
+            ondelete='CASCADE'),
+        sa.ForeignKeyConstraint(
+            ['user_id'], ['users.id'], ondelete='CASCADE'),
+        sa.PrimaryKeyConstraint('id')
+        )
+    op.create_index(
+        op.f('ix_empro_domain_scores_questionnaire_response_id'),
+        'empro_domain_scores',
+        ['questionnaire_response_id'],
+        unique=False)
+    op.create_index(
+        'ix_empro_domain_scores_user_authored',
+        'empro_domain_scores',
+        ['user_id', 'authored'],
+        unique=False)
+
+    # Score previously extracted Observations; answer codes take the
+    # form "<link_id>.<score>", the domain is found in the concept codings.
+    # Authored values are stored as UTC, without timezone, as at runtime;
+    # codes lacking a numeric score are skipped.
+    op.execute("SET LOCAL TIME ZONE 'UTC'")
+    op.execute(
+        "INSERT INTO empro_domain_scores (questionnaire_response_id, "
+        "user_id, authored, domain, link_id, score, severity) "
+        "SELECT qnr.id, qnr.subject_id, "
+        "CAST(qnr.document->>'authored' AS TIMESTAMPTZ) AT TIME ZONE 'UTC', "
+        "dc.code, "
+        "regexp_replace(vc.code, '\\.[^.]*$', ''), "
+        "CAST(substring(vc.code from '[^.]*$') AS INTEGER), ext.code "
+        "FROM observations o "
+        "JOIN questionnaire_responses qnr "
+        "ON o.derived_from = CAST(qnr.id AS TEXT) "
+        "JOIN codeable_concept_codings ccc "
+        "ON ccc.codeable_concept_id = o.codeable_concept_id "
+        "JOIN codings dc ON dc.id = ccc.coding_id "
+        "AND dc.system = 'http://us.truenth.org/observation' "
+        "JOIN codings vc ON vc.id = o.value_coding_id "
+        "LEFT JOIN codings ext ON ext.id = vc.extension_id "
+        "WHERE qnr.document->>'authored' IS NOT NULL "
+        "AND substring(vc.code from '[^.]*$') ~ '^[0-9]+$'")
+
+
+def downgrade():
+    if current_app.config.get('GIL'):
+        return
+    op.drop_index(
+        'ix_empro_domain_scores_user_authored',
+        table_name='empro_domain_scores')
+    op.drop_index(
+        op.f('ix_empro_domain_scores_questionnaire_response_id'),
+        table_name='empro_domain_scores')
+    op.drop_table('empro_domain_scores')
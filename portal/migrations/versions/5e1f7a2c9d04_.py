@@ -0,0 +1,54 @@
+"""QuestionnaireResponse instrument_id and authored columns
+
+Revision ID: 5e1f7a2c9d04
+Revises: 3c0d9b1e5a72
+Create Date: 2026-10-19 11:02:37.518204
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '5e1f7a2c9d04'
+down_revision = '3c0d9b1e5a72'
+
+
+def upgrade():
+    op.add_column(
+        'questionnaire_responses',
+        sa.Column('instrument_id', sa.Text(), nullable=True))
+    op.add_column(
+        'questionnaire_responses',
+        sa.Column('authored', sa.DateTime(), nullable=True))
+
+    # Backfill from the documents; authored values are stored as UTC,
+    # without timezone, as are all datetimes in the db
+    op.execute("SET LOCAL TIME ZONE 'UTC'")
+    op.execute(
+        "UPDATE questionnaire_responses SET "
+        "instrument_id = regexp_replace("
+        "document->'questionnaire'->>'reference', '^.*/', ''), "
+        "authored = CAST(document->>'authored' AS TIMESTAMPTZ) "
+        "AT TIME ZONE 'UTC'")
+
+    op.create_index(
+        'ix_questionnaire_responses_subject_authored',
+        'questionnaire_responses',
+        ['subject_id', 'authored'],
+        unique=False)
+    op.create_index(
+        'ix_questionnaire_responses_instrument_authored',
+        'questionnaire_responses',
+        ['instrument_id', 'authored'],
+        unique=False)
+
+
+def downgrade():
+    op.drop_index(
+        'ix_questionnaire_responses_instrument_authored',
+        table_name='questionnaire_responses')
+    op.drop_index(
+        'ix_questionnaire_responses_subject_authored',
+        table_name='questionnaire_responses')
+    op.drop_column('questionnaire_responses', 'authored')
+    op.drop_column('questionnaire_responses', 'instrument_id')
@@ -0,0 +1,43 @@
+"""Pending work summary table
+
+Revision ID: a8c41e7d3b96
+Revises: 5e1f7a2c9d04
+Create Date: 2026-10-19 16:41:05.902317
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+# revision identifiers, used by Alembic.
+revision = 'a8c41e7d3b96'
+down_revision = '5e1f7a2c9d04'
+
+
+def upgrade():
+    # rows are computed on demand; no backfill necessary
+    op.create_table(
+        'pending_work',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('user_id', sa.Integer(), nullable=False),
+        sa.Column('research_study_id', sa.Integer(), nullable=False),
+        sa.Column('withdrawn', sa.Boolean(), nullable=False),
+        sa.Column(
+            'needed', postgresql.JSONB(astext_type=sa.Text()),
+            nullable=False),
+        sa.Column(
+            'resume_identifiers', postgresql.JSONB(astext_type=sa.Text()),
+            nullable=False),
+        sa.Column('valid_until', sa.DateTime(), nullable=True),
+        sa.ForeignKeyConstraint(
+            ['research_study_id'], ['research_studies.id'],
+            ondelete='cascade'),
+        sa.ForeignKeyConstraint(['user_id'], ['users.id'], ondelete='cascade'),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint(
+            'user_id', 'research_study_id', name='_pending_work_user_study'),
+    )
+
+
+def downgrade():
+    op.drop_table('pending_work')
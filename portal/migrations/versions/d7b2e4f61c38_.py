@@ -0,0 +1,38 @@
+"""Track QuestionnaireResponse last write time
+
+Revision ID: d7b2e4f61c38
+Revises: a8c41e7d3b96
+Create Date: 2026-10-19 18:12:47.310522
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = 'd7b2e4f61c38'
+down_revision = 'a8c41e7d3b96'
+
+
+def upgrade():
+    op.add_column(
+        'questionnaire_responses',
+        sa.Column('updated', sa.DateTime(), nullable=True))
+
+    # Best available approximation for existing rows; the authored
+    # time, else the time of migration (naive UTC, as stored at runtime)
+    op.execute(
+        "UPDATE questionnaire_responses SET updated = "
+        "COALESCE(authored, timezone('UTC', now()))")
+    op.alter_column('questionnaire_responses', 'updated', nullable=False)
+    op.create_index(
+        'ix_questionnaire_responses_updated_id',
+        'questionnaire_responses',
+        ['updated', 'id'],
+        unique=False)
+
+
+def downgrade():
+    op.drop_index(
+        'ix_questionnaire_responses_updated_id',
+        table_name='questionnaire_responses')
+    op.drop_column('questionnaire_responses', 'updated')
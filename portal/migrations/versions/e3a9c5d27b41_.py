@@ -0,0 +1,28 @@
+"""Pending work generations, guarding summaries against racing writes
+
+Revision ID: e3a9c5d27b41
+Revises: d7b2e4f61c38
+Create Date: 2026-10-19 18:47:22.651830
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = 'e3a9c5d27b41'
+down_revision = 'd7b2e4f61c38'
+
+
+def upgrade():
+    # rows are added on first use; no backfill necessary
+    op.create_table(
+        'pending_work_generations',
+        sa.Column('user_id', sa.Integer(), nullable=False),
+        sa.Column('generation', sa.Integer(), nullable=False),
+        sa.ForeignKeyConstraint(['user_id'], ['users.id'], ondelete='cascade'),
+        sa.PrimaryKeyConstraint('user_id'),
+    )
+
+
+def downgrade():
+    op.drop_table('pending_work_generations')
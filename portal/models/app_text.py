@@ -12,22 +12,44 @@ SitePersistence mechanism, and looked up in a template using the
 from abc import ABCMeta, abstractmethod
 from builtins import str
 from string import Formatter
+import time
 import timeit
 from urllib.parse import parse_qsl, urlencode, urlparse
 
 from flask import current_app
 from flask_babel import gettext
 import requests
+from requests.adapters import HTTPAdapter
 from requests.exceptions import ConnectionError, InvalidURL, MissingSchema
 
 from ..cache import FIVE_MINS, cache
 from ..database import db
 
+# Process wide session, shared by all remote content requests for
+# connection reuse.  See `http_session()`
+_http_session = None
+
+
+def http_session():
+    """Return the pooled HTTP session used for remote content requests"""
+    global _http_session
+    if _http_session is None:
+        pool_size = current_app.config.get('CONTENT_HTTP_POOL_SIZE', 10)
+        adapter = HTTPAdapter(
+            pool_connections=pool_size, pool_maxsize=pool_size)
+        session = requests.Session()
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        _http_session = session
+    return _http_session
+
 
 def time_request(url, params=None):
     """Wrap the requests.get(url) and log the timing"""
     start = timeit.default_timer()
-    response = requests.get(url, params)
+    response = http_session().get(
+        url, params=params,
+        timeout=current_app.config.get('CONTENT_REQUEST_TIMEOUT'))
     duration = timeit.default_timer() - start
     message = ('TIME {duration:.4f} seconds to GET {url}'.format(
         url=url, duration=duration))
@@ -40,6 +62,119 @@ def time_request(url, params=None):
     return response
 
 
+def parse_variables(*templates):
+    """Return sorted list of format variable names found in templates"""
+    var_list = set()
+    for template in templates:
+        if template:
+            var_list.update(
+                [v[1] for v in Formatter().parse(template) if v[1]])
+    return sorted(var_list)
+
+
+class CachedResponse(object):
+    """Minimal stand in for `requests.Response` built from a cache entry
+
+    Exposes only the attributes used by the remote resource classes,
+    namely `status_code`, `reason`, `text` and `json()`, along with
+    the `variable_list` parsed at fetch time from any mail fields.
+
+    """
+
+    def __init__(self, entry):
+        self.status_code = entry['status_code']
+        self.reason = entry['reason']
+        self.text = entry['text']
+        self.fetched_at = entry['fetched_at']
+        self.variable_list = entry['variable_list']
+        self._json = entry['json']
+
+    def json(self):
+        if self._json is None:
+            raise ValueError("No JSON object could be decoded")
+        return self._json
+
+    @staticmethod
+    def entry_from_response(response):
+        """Generate cacheable dictionary from a live `requests.Response`"""
+        try:
+            data = response.json()
+        except ValueError:
+            data = None
+        variable_list = None
+        if isinstance(data, dict):
+            variable_list = parse_variables(
+                data.get('subject'), data.get('body'), data.get('footer'))
+        return {
+            'status_code': response.status_code,
+            'reason': response.reason,
+            'text': response.text,
+            'json': data,
+            'fetched_at': time.time(),
+            'variable_list': variable_list}
+
+
+def content_cache_key(url, locale_code):
+    return "content_cache::{}::{}".format(locale_code, url)
+
+
+def content_revalidation_key(url, locale_code):
+    """Key held while a background revalidation of url is in flight"""
+    return content_cache_key(url, locale_code) + "::pending"
+
+
+def refresh_remote_content(url, locale_code):
+    """Fetch url and (re)store result in the content cache
+
+    Only successful responses are cached, so a transient CMS failure
+    never replaces good content.
+
+    :returns: `CachedResponse` for the fetched content
+
+    """
+    response = time_request(url)
+    entry = CachedResponse.entry_from_response(response)
+    if response.status_code == 200:
+        cache.set(
+            content_cache_key(url, locale_code), entry,
+            timeout=current_app.config['CONTENT_CACHE_STALE_TIMEOUT'])
+    return CachedResponse(entry)
+
+
+def cached_request(url, locale_code=None):
+    """Return remote content, from the content cache when available
+
+    Content cache entries are keyed on (url, locale_code) and considered
+    fresh for `CONTENT_CACHE_TIMEOUT` seconds.  Stale entries, up to
+    `CONTENT_CACHE_STALE_TIMEOUT` seconds old, are returned immediately
+    while a background task revalidates (stale-while-revalidate).
+
+    On a cache miss the request is made synchronously, raising the same
+    exceptions as `time_request()`.
+
+    :returns: `CachedResponse` instance
+
+    """
+    entry = cache.get(content_cache_key(url, locale_code))
+    if entry is None:
+        return refresh_remote_content(url, locale_code)
+
+    age = time.time() - entry['fetched_at']
+    if age > current_app.config['CONTENT_CACHE_TIMEOUT']:
+        # Only one revalidation request per key in flight
+        pending_key = content_revalidation_key(url, locale_code)
+        if cache.add(pending_key, True, timeout=FIVE_MINS):
+            from ..tasks import refresh_remote_content_task
+            try:
+                refresh_remote_content_task.apply_async(
+                    kwargs={'url': url, 'locale_code': locale_code})
+            except Exception as e:
+                cache.delete(pending_key)
+                current_app.logger.warning(
+                    "unable to queue content revalidation of %s: %s", url, e)
+    return CachedResponse(entry)
+
+
 def get_terms(locale_code, org=None, role=None, research_study_id=0):
     """Shortcut to lookup correct terms given org and role"""
     if org:
@@ -123,6 +258,22 @@ class AppText(db.Model):
         return d
 
 
+def research_study_title(research_study_id):
+    """Return title of the research study, or None if not found
+
+    Prefers the reference data registry, falling back to the database for
+    studies added since the registry was loaded.
+
+    """
+    from .reference_data import ReferenceData  # avoid cycle
+    from .research_study import ResearchStudy  # avoid cycle
+    research_study = ReferenceData.current().research_studies.get(
+        research_study_id)
+    if research_study is None and research_study_id:
+        research_study = ResearchStudy.query.get(research_study_id)
+    return research_study.title if research_study else None
+
+
 class AppTextModelAdapter(object, metaclass=ABCMeta):
     """Several special purpose patterns used for lookups
 
@@ -166,14 +317,11 @@ class WebsiteConsentTermsByOrg_ATMA(AppTextModelAdapter):
         :returns: string for AppText.name field
 
         """
-        from .research_study import ResearchStudy
-
         default = "patient website consent URL"
 
         # try research study first
         research_study_id = kwargs.get('research_study_id', 0)
-        research_study = ResearchStudy.query.get(research_study_id)
-        study_title = research_study.title if research_study else ""
+        study_title = research_study_title(research_study_id) or ""
         specialized = " ".join((study_title, default))
         query = AppText.query.filter_by(name=specialized)
         if query.count() == 1:
@@ -282,12 +430,10 @@ class UserInviteEmail_ATMA(AppTextModelAdapter):
         :returns: string for AppText.name field
 
         """
-        from .research_study import ResearchStudy
         default = "patient invite email"
         # First try the study (if provided)
-        if kwargs.get('research_study_id'):
-            study_title = ResearchStudy.query.get(
-                kwargs.get('research_study_id')).title
+        study_title = research_study_title(kwargs.get('research_study_id'))
+        if study_title:
             specialized = " ".join((default, study_title))
             query = AppText.query.filter_by(name=specialized)
             if query.count() == 1:
@@ -415,7 +561,7 @@ class UnversionedResource(object):
             self._asset = str(asset)
         else:
             try:
-                response = time_request(url)
+                response = cached_request(url)
                 self._asset = response.text
             except (MissingSchema, InvalidURL):
                 if current_app.config.get('TESTING'):
@@ -470,7 +616,7 @@ class VersionedResource(object):
         self.url = localize_url(url, locale_code)
         self.variables = variables or {}
         try:
-            response = time_request(self.url)
+            response = cached_request(self.url, locale_code)
             self._asset = response.json().get('asset')
             self.url = self._permanent_url(
                 generic_url=self.url, version=response.json().get('version'))
@@ -564,8 +710,10 @@ class MailResource(object):
         self.error_msg, self.editor_url = None, None
         self.url = localize_url(url, locale_code)
         self.variables = variables or {}
+        self._variable_list = None
         try:
-            response = time_request(self.url)
+            response = cached_request(self.url, locale_code)
+            self._variable_list = response.variable_list
             self._subject = response.json().get('subject')
             self._body = response.json().get('body')
             if current_app.config.get("DEBUG_EMAIL", False):
@@ -656,17 +804,13 @@ class MailResource(object):
 
     @property
     def variable_list(self):
-        var_list = set()
-        if self._subject:
-            var_list.update(
-                [v[1] for v in Formatter().parse(self._subject) if v[1]])
-        if self._body:
-            var_list.update(
-                [v[1] for v in Formatter().parse(self._body) if v[1]])
-        if self._footer:
-            var_list.update(
-                [v[1] for v in Formatter().parse(self._footer) if v[1]])
-        return list(var_list)
+        if self._variable_list is None:
+            # Not pre-parsed with the cached content, i.e. plain text
+            return parse_variables(self._subject, self._body, self._footer)
+        var_list = list(self._variable_list)
+        if current_app.config.get("DEBUG_EMAIL", False) and self._body:
+            var_list.append('debug_slot')
+        return var_list
 
     def _permanent_url(self, generic_url, version):
         """Produce a permanent url from the metadata provided
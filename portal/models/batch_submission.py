@@ -0,0 +1,270 @@
+"""Batch submission of QuestionnaireResponses and Observations
+
+Accepts a FHIR ``batch`` or ``transaction`` Bundle, each entry POSTing a
+resource to the same path as the single resource endpoints, namely
+``api/patient/<id>/assessment`` for QuestionnaireResponses and
+``api/patient/<id>/clinical`` for Observations.
+
+Every entry is validated before any is persisted; all are then persisted
+in a single transaction, so a batch is saved in full or not at all.
+Post submission processing runs once per affected patient, rather than
+once per resource.
+
+"""
+from collections import namedtuple
+from datetime import datetime
+import re
+
+from dateutil import parser
+import jsonschema
+
+from ..audit import auditable_event
+from ..database import db
+from ..date_tools import FHIR_datetime
+from .audit import Audit
+from .encounter import Encounter
+from .identifier import Identifier
+from .observation import UserObservation
+from .post_submission import submit_batch_for_processing
+from .qb_timeline import invalidate_users_QBT
+from .questionnaire_response import NoFutureDates, QuestionnaireResponse
+
+BUNDLE_TYPES = ('batch', 'transaction')
+ENTRY_URL = re.compile(
+    r'(^|/)api/patient/(?P<patient_id>\d+)/(?P<endpoint>assessment|clinical)'
+    r'/?$')
+ENDPOINT_RESOURCE_TYPES = {
+    'assessment': 'QuestionnaireResponse',
+    'clinical': 'Observation',
+}
+
+BatchEntry = namedtuple(
+    'BatchEntry', ('index', 'patient_id', 'resource_type', 'resource'))
+PersistedEntry = namedtuple(
+    'PersistedEntry', ('patient_id', 'resource_type', 'resource_id'))
+
+
+class BatchEntryError(ValueError):
+    """Raised for an invalid batch, or entry therein
+
+    :ivar index: offending entry index, None for problems with the batch
+    :ivar status_code: HTTP status appropriate for the problem
+
+    """
+    def __init__(self, message, index=None, status_code=400):
+        if index is not None:
+            message = "entry[{}]: {}".format(index, message)
+        super(BatchEntryError, self).__init__(message)
+        self.index = index
+        self.status_code = status_code
+
+
+def parse_batch(bundle):
+    """Parse the entries from a batch Bundle
+
+    :returns: list of ``BatchEntry``, in Bundle order
+    :raises BatchEntryError: if the Bundle or any entry is malformed
+
+    """
+    if not isinstance(bundle, dict) or bundle.get(
+            'resourceType') != 'Bundle':
+        raise BatchEntryError('Requires resourceType of "Bundle"')
+    if bundle.get('type') not in BUNDLE_TYPES:
+        raise BatchEntryError("Bundle type must be one of {}".format(
+            BUNDLE_TYPES))
+
+    entries = []
+    for index, entry in enumerate(bundle.get('entry', [])):
+        request = entry.get('request', {})
+        if request.get('method') != 'POST':
+            raise BatchEntryError("only POST supported", index=index)
+        match = ENTRY_URL.search(request.get('url', ''))
+        if not match:
+            raise BatchEntryError(
+                "unsupported url '{}'".format(request.get('url')),
+                index=index)
+        resource = entry.get('resource', {})
+        resource_type = ENDPOINT_RESOURCE_TYPES[match.group('endpoint')]
+        if resource.get('resourceType') != resource_type:
+            raise BatchEntryError(
+                'Requires resourceType of "{}"'.format(resource_type),
+                index=index)
+        entries.append(BatchEntry(
+            index=index, patient_id=int(match.group('patient_id')),
+            resource_type=resource_type, resource=resource))
+    if not entries:
+        raise BatchEntryError("Bundle contains no entries")
+    return entries
+
+
+def validate_batch(entries):
+    """Validate all entries, before any are persisted
+
+    Applies the same checks as the single resource endpoints, and
+    additionally rejects QuestionnaireResponse identifiers repeated
+    within the batch.  Observation values the single endpoint would
+    only reject mid transaction, such as an unparsable ``issued``, are
+    likewise checked here.
+
+    :raises BatchEntryError: on the first invalid entry found
+
+    """
+    identifiers = set()
+    for entry in entries:
+        resource = entry.resource
+        if entry.resource_type == 'Observation':
+            if 'coding' not in resource.get('code', {}):
+                raise BatchEntryError(
+                    "requires at least one CodeableConcept",
+                    index=entry.index)
+            if 'valueQuantity' not in resource:
+                raise BatchEntryError(
+                    "missing required 'valueQuantity'", index=entry.index)
+            for coding in resource['code']['coding']:
+                if not (coding.get('system') and coding.get('code')):
+                    raise BatchEntryError(
+                        "coding requires system and code",
+                        index=entry.index)
+            if resource.get('issued'):
+                try:
+                    parser.parse(resource['issued'])
+                except (TypeError, ValueError, OverflowError) as e:
+                    raise BatchEntryError(
+                        "Unable to parse issued: {}".format(e),
+                        index=entry.index)
+            continue
+
+        try:
+            QuestionnaireResponse.validate_document(resource)
+            QuestionnaireResponse.validate_authored(
+                FHIR_datetime.parse(resource.get('authored')))
+        except (jsonschema.ValidationError, NoFutureDates) as e:
+            raise BatchEntryError(str(e), index=entry.index)
+
+        if 'identifier' not in resource:
+            if resource.get('status') == 'in-progress':
+                raise BatchEntryError(
+                    "Status in-progress received without the required "
+                    "identifier", index=entry.index)
+            continue
+
+        try:
+            identifier = Identifier.from_fhir(resource['identifier'])
+        except ValueError as e:
+            raise BatchEntryError(str(e), index=entry.index)
+        key = (identifier.system, identifier.value)
+        if key in identifiers or QuestionnaireResponse.by_identifier(
+                identifier).count():
+            raise BatchEntryError(
+                "QuestionnaireResponse with matching {} already exists; "
+                "must be unique over (system, value)".format(identifier),
+                index=entry.index, status_code=409)
+        identifiers.add(key)
+
+
+def persist_batch(entries, patients, acting_user, encounter_type=None):
+    """Persist all (previously validated) entries in a single transaction
+
+    As with single submissions, each QuestionnaireResponse is given a
+    discrete encounter.  The acting user's current encounter is looked
+    up once, and further encounters generated as needed within the
+    transaction.
+
+    :param entries: list of ``BatchEntry``, as returned by
+      ``parse_batch()`` and checked by ``validate_batch()``
+    :param patients: dictionary of patient users keyed by id, previously
+      checked for acting user's edit permission
+    :param acting_user: user submitting the batch
+    :param encounter_type: optional encounter type coding, such as
+      from ``EC.PAPER``, applied to each QuestionnaireResponse encounter
+    :returns: list of ``PersistedEntry``, in entry order
+
+    """
+    current_encounter = acting_user.current_encounter()
+    encounter_available = not QuestionnaireResponse.query.filter(
+        QuestionnaireResponse.encounter_id == current_encounter.id).count()
+
+    def qnr_encounter():
+        """Return a QuestionnaireResponse encounter, generating as needed"""
+        nonlocal encounter_available
+        if encounter_available:
+            encounter_available = False
+            encounter = current_encounter
+        else:
+            now = datetime.utcnow()
+            encounter = Encounter(
+                status='finished', auth_method=current_encounter.auth_method,
+                start_time=now, end_time=now, user_id=acting_user.id)
+            db.session.add(encounter)
+        if encounter_type:
+            encounter.type.append(encounter_type)
+        return encounter
+
+    qnrs, audits = [], []
+    for entry in entries:
+        patient = patients[entry.patient_id]
+        if entry.resource_type == 'Observation':
+            audit = Audit(
+                user_id=acting_user.id, subject_id=patient.id,
+                context='observation')
+            code, result = patient.add_observation(
+                entry.resource, audit, encounter=current_encounter,
+                in_batch=True)
+            if code != 200:
+                db.session.rollback()
+                raise BatchEntryError(
+                    result, index=entry.index, status_code=code)
+            audits.append(audit)
+            continue
+
+        qnr = QuestionnaireResponse(
+            subject_id=patient.id,
+            status=entry.resource["status"],
+            document=entry.resource,
+            encounter=qnr_encounter(),
+        )
+        db.session.add(qnr)
+        qnrs.append(qnr)
+
+    db.session.flush()
+    for qnr in qnrs:
+        auditable_event(
+            "added {}".format(qnr), user_id=acting_user.id,
+            subject_id=qnr.subject_id, context='assessment', commit=False)
+    observation_ids = dict(UserObservation.query.filter(
+        UserObservation.audit_id.in_([a.id for a in audits])).with_entities(
+        UserObservation.audit_id, UserObservation.observation_id))
+    persisted = []
+    qnrs, audits = iter(qnrs), iter(audits)
+    for entry in entries:
+        if entry.resource_type == 'Observation':
+            resource_id = observation_ids[next(audits).id]
+        else:
+            resource_id = next(qnrs).id
+        persisted.append(PersistedEntry(
+            patient_id=entry.patient_id, resource_type=entry.resource_type,
+            resource_id=resource_id))
+    db.session.commit()
+    return persisted
+
+
+def process_batch(persisted, acting_user_id):
+    """Post submission processing, once per affected patient
+
+    :param persisted: list of ``PersistedEntry``, from ``persist_batch()``
+    :returns: dictionary keyed by patient id of each patient's submission
+      version, for those with QuestionnaireResponses in the batch
+
+    """
+    qnr_ids = [
+        p.resource_id for p in persisted
+        if p.resource_type == 'QuestionnaireResponse']
+    qnrs = QuestionnaireResponse.query.filter(
+        QuestionnaireResponse.id.in_(qnr_ids)).all() if qnr_ids else []
+    versions = submit_batch_for_processing(
+        qnrs=qnrs, acting_user_id=acting_user_id)
+
+    # patients with only observations still need a fresh timeline
+    for patient_id in {p.patient_id for p in persisted} - set(versions):
+        invalidate_users_QBT(patient_id, research_study_id='all')
+    return versions
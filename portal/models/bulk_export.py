@@ -0,0 +1,269 @@
+"""Bulk FHIR export, modeled on the FHIR ``$export`` operation
+
+An export writes one NDJSON (newline delimited JSON) file per resource
+type and chunk of patients, each chunk written by its own background
+task so chunks run in parallel.  Rows are streamed from the database via
+server side cursors, keeping memory bounded regardless of export size.
+
+On completion, the manifest listing the output files is the export
+task's result, available through the usual ``/task/<id>`` flow, and the
+files themselves are downloaded from ``/api/export/<export_id>/<file>``.
+As files are written by workers and served by the web tier,
+``EXPORT_DIR`` must name storage shared by both.
+
+Exports expire ``EXPORT_RETENTION_HOURS`` after completion, and are
+removed by ``purge_exports()``.
+
+"""
+import json
+import os
+import shutil
+import time
+
+from flask import current_app, url_for
+from sqlalchemy import cast, exists
+
+from ..database import db
+from ..date_tools import FHIR_datetime
+from .audit import Audit
+from .observation import Observation, UserObservation
+from .procedure import Procedure
+from .questionnaire_response import QuestionnaireResponse
+from .reference import Reference
+from .role import ROLE
+from .user import User, patients_query
+
+EXPORT_TYPES = (
+    'Patient', 'QuestionnaireResponse', 'Observation', 'Procedure')
+MANIFEST_FILENAME = 'manifest.json'
+
+
+def export_dir(export_id):
+    """Return path to the directory holding the named export's files"""
+    return os.path.join(
+        current_app.root_path, current_app.config['EXPORT_DIR'], export_id)
+
+
+def resource_query(resource_type, patient_ids, since=None):
+    """Return query and serializer for the resource type and patients
+
+    :param resource_type: one of ``EXPORT_TYPES``
+    :param patient_ids: limit to resources belonging to these patients
+    :param since: if defined, limit to resources written at or after.
+      Patients carry no modification time, so are always included.
+      Observations extracted via SDC are filtered on their issued time.
+    :returns: tuple (query, function to generate FHIR from a result row)
+
+    NB - queries are streamed via ``yield_per()``, which is incompatible
+    with joined eager loading of collections; eager loads are disabled,
+    relationships loading on access.
+
+    """
+    if resource_type == 'Patient':
+        query = User.query.filter(User.id.in_(patient_ids)).order_by(
+            User.id).enable_eagerloads(False)
+        return query, lambda user: user.as_fhir(include_empties=False)
+
+    if resource_type == 'QuestionnaireResponse':
+        query = QuestionnaireResponse.query.filter(
+            QuestionnaireResponse.subject_id.in_(patient_ids))
+        if since:
+            query = query.filter(QuestionnaireResponse.updated >= since)
+        query = query.order_by(QuestionnaireResponse.id)
+        return query, lambda qnr: qnr.document
+
+    if resource_type == 'Observation':
+        # Observations are either associated with the patient directly,
+        # or, when extracted via SDC, derived from the patient's QNR
+        recorded = Observation.query.join(UserObservation).join(
+            Audit, UserObservation.audit_id == Audit.id).filter(
+            UserObservation.user_id.in_(patient_ids))
+        extracted = Observation.query.join(
+            QuestionnaireResponse, Observation.derived_from == cast(
+                QuestionnaireResponse.id, db.Text)).filter(
+            QuestionnaireResponse.subject_id.in_(patient_ids)).filter(
+            ~exists().where(UserObservation.observation_id == Observation.id))
+        if since:
+            recorded = recorded.filter(Audit.timestamp >= since)
+            extracted = extracted.filter(Observation.issued >= since)
+        query = recorded.with_entities(
+            Observation, UserObservation.user_id).union_all(
+            extracted.with_entities(
+                Observation, QuestionnaireResponse.subject_id)).order_by(
+            Observation.id).enable_eagerloads(False)
+
+        def observation_fhir(row):
+            observation, user_id = row
+            fhir = observation.as_fhir()
+            fhir['subject'] = Reference.patient(user_id).as_fhir()
+            return fhir
+        return query, observation_fhir
+
+    if resource_type == 'Procedure':
+        query = Procedure.query.join(
+            Audit, Procedure.audit_id == Audit.id).filter(
+            Procedure.user_id.in_(patient_ids))
+        if since:
+            query = query.filter(Audit.timestamp >= since)
+        query = query.order_by(Procedure.id).enable_eagerloads(False)
+        return query, lambda procedure: procedure.as_fhir()
+
+    raise ValueError("unsupported export type: {}".format(resource_type))
+
+
+def export_chunks(acting_user_id, resource_types, since, export_id):
+    """Split the export into chunks, for parallel background tasks
+
+    :param acting_user_id: user requesting the export; only patients
+      said user may view are included
+    :param resource_types: list of resource types to export
+    :param since: FHIR datetime string or None
+    :param export_id: unique export identifier, naming its directory
+    :returns: list of serializable kwargs, one per ``write_chunk()`` call
+
+    """
+    acting_user = User.query.get(acting_user_id)
+    patient_ids = [row.id for row in patients_query(
+        acting_user, include_test_role=False).with_entities(
+        User.id).order_by(User.id)]
+
+    chunk_size = current_app.config['EXPORT_CHUNK_SIZE']
+    chunks = []
+    for resource_type in resource_types:
+        for index, start in enumerate(
+                range(0, len(patient_ids), chunk_size)):
+            chunks.append({
+                'export_id': export_id,
+                'resource_type': resource_type,
+                'chunk_index': index,
+                'patient_ids': patient_ids[start:start + chunk_size],
+                'since': since})
+    return chunks
+
+
+def write_chunk(export_id, resource_type, chunk_index, patient_ids, since):
+    """Write one NDJSON file of the resource type for the given patients
+
+    :returns: dictionary with the resource ``type``, ``file`` name and
+      ``count`` of resources written
+
+    """
+    directory = export_dir(export_id)
+    os.makedirs(directory, exist_ok=True)
+    filename = '{}-{:04d}.ndjson'.format(resource_type, chunk_index)
+
+    query, as_fhir = resource_query(
+        resource_type=resource_type,
+        patient_ids=patient_ids,
+        since=FHIR_datetime.parse(since, none_safe=True))
+    count = 0
+    with open(os.path.join(directory, filename), 'w') as ndjson:
+        for row in query.execution_options(stream_results=True).yield_per(
+                current_app.config['EXPORT_YIELD_PER']):
+            ndjson.write(json.dumps(as_fhir(row), separators=(',', ':')))
+            ndjson.write('\n')
+            count += 1
+    return {'type': resource_type, 'file': filename, 'count': count}
+
+
+def export_manifest(
+        chunk_results, export_id, acting_user_id, request_url,
+        transaction_time, lock_key):
+    """Assemble the export manifest from the written chunks
+
+    The manifest is also saved alongside the NDJSON files, for the
+    download view's permission check.
+
+    :param chunk_results: list of ``write_chunk()`` results
+    :returns: dictionary of results, easily stored as a task output,
+      including details needed by ``format_task_output()``
+
+    """
+    output = [{
+        'type': chunk['type'],
+        'count': chunk['count'],
+        'url': url_for(
+            'reporting.export_file', export_id=export_id,
+            filename=chunk['file'], _external=True)}
+        for chunk in chunk_results if chunk['count']]
+    manifest = {
+        'transactionTime': transaction_time,
+        'request': request_url,
+        'requiresAccessToken': True,
+        'output': output,
+        'error': []}
+
+    directory = export_dir(export_id)
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, MANIFEST_FILENAME), 'w') as fp:
+        json.dump(
+            {'required_user_id': acting_user_id, 'manifest': manifest}, fp)
+
+    return {
+        'lock_key': lock_key,
+        'response_format': 'manifest',
+        'required_user_id': acting_user_id,
+        'required_roles': [ROLE.ADMIN.value, ROLE.RESEARCHER.value],
+        'data': manifest}
+
+
+def export_expired(export_id, now=None):
+    """Return True if the named export is past its retention period
+
+    Exports yet to complete, lacking a manifest, aren't expired.
+
+    """
+    retention = current_app.config['EXPORT_RETENTION_HOURS'] * 60 * 60
+    try:
+        completed = os.path.getmtime(
+            os.path.join(export_dir(export_id), MANIFEST_FILENAME))
+    except OSError:
+        return False
+    return (now or time.time()) - completed > retention
+
+
+def export_owner(export_id):
+    """Return id of the user who requested the export, None if unknown
+
+    Expired exports are treated as unknown.
+
+    """
+    if export_expired(export_id):
+        return None
+    try:
+        with open(os.path.join(
+                export_dir(export_id), MANIFEST_FILENAME)) as fp:
+            return json.load(fp)['required_user_id']
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def purge_exports(now=None):
+    """Remove the files of all expired exports
+
+    Exports abandoned before completion are removed once as old as
+    the retention period.
+
+    :returns: list of purged export ids
+
+    """
+    root = os.path.join(
+        current_app.root_path, current_app.config['EXPORT_DIR'])
+    if not os.path.isdir(root):
+        return []
+
+    now = now or time.time()
+    retention = current_app.config['EXPORT_RETENTION_HOURS'] * 60 * 60
+    purged = []
+    for export_id in sorted(os.listdir(root)):
+        path = os.path.join(root, export_id)
+        if not os.path.isdir(path):
+            continue
+        if os.path.exists(os.path.join(path, MANIFEST_FILENAME)):
+            expired = export_expired(export_id, now=now)
+        else:
+            expired = now - os.path.getmtime(path) > retention
+        if expired:
+            shutil.rmtree(path, ignore_errors=True)
+            purged.append(export_id)
+    return purged
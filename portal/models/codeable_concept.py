@@ -1,3 +1,7 @@
+from collections import defaultdict
+
+from sqlalchemy.dialects.postgresql import insert
+
 from ..database import db
 from .coding import Coding
 
@@ -41,6 +45,88 @@ class CodeableConcept(db.Model):
             cc.codings.append(item)
         return cc.add_if_not_found()
 
+    @classmethod
+    def resolve(cls, data):
+        """Return the CodeableConcept for FHIR data, without committing
+
+        Alternative to ``from_fhir()``, which commits any new codings,
+        for use within a larger transaction.  Codings and concept are
+        resolved via ``bulk_ids()``.
+
+        """
+        concept_id = cls.bulk_ids([data])[cls.key(data)]
+        return cls.query.get(concept_id)
+
+    @staticmethod
+    def key(data):
+        """Return key for a FHIR CodeableConcept; its set of codings"""
+        return frozenset(Coding.key(coding) for coding in data['coding'])
+
+    @classmethod
+    def bulk_ids(cls, concepts, coding_ids=None):
+        """Return ids for FHIR CodeableConcepts, inserting any not found
+
+        Bulk form of ``from_fhir()``, matching on the set of codings
+        alone.  As with ``add_if_not_found()``, a CodeableConcept
+        retains the union of all codings given for it.
+
+        :param concepts: list of FHIR CodeableConcept dictionaries
+        :param coding_ids: optional result of ``Coding.bulk_ids()``
+          including all codings in concepts, if already resolved
+        :returns: dictionary of concept ids, keyed by
+          ``CodeableConcept.key()``
+
+        """
+        if coding_ids is None:
+            coding_ids = Coding.bulk_ids(
+                coding for data in concepts for coding in data['coding'])
+
+        linked = defaultdict(set)  # coding_id: {codeable_concept_ids}
+        wanted = {
+            coding_ids[Coding.key(coding)]
+            for data in concepts for coding in data['coding']}
+        if wanted:
+            for cc_id, coding_id in CodeableConceptCoding.query.filter(
+                    CodeableConceptCoding.coding_id.in_(wanted)
+            ).with_entities(
+                    CodeableConceptCoding.codeable_concept_id,
+                    CodeableConceptCoding.coding_id):
+                linked[coding_id].add(cc_id)
+
+        results, new_links = {}, []
+        for data in concepts:
+            key = cls.key(data)
+            if key in results:
+                continue
+            ids = {coding_ids[coding_key] for coding_key in key}
+            if not ids:
+                raise ValueError(
+                    "Can't add CodeableConcept without any codings")
+            found = set()
+            for coding_id in ids:
+                found.update(linked[coding_id])
+            if len(found) > 1:
+                raise ValueError(
+                    "DB problem - multiple CodeableConcepts {} found for "
+                    "codings: {}".format(found, sorted(key)))
+            if found:
+                cc_id = found.pop()
+            else:
+                cc_id = db.session.execute(insert(cls.__table__).values(
+                    text=data.get('text')).returning(cls.id)).scalar()
+            for coding_id in ids:
+                if cc_id not in linked[coding_id]:
+                    new_links.append({
+                        'codeable_concept_id': cc_id,
+                        'coding_id': coding_id})
+                    linked[coding_id].add(cc_id)
+            results[key] = cc_id
+
+        if new_links:
+            db.session.execute(insert(
+                CodeableConceptCoding.__table__).values(new_links))
+        return results
+
     def as_fhir(self):
         """Return self in JSON FHIR formatted string"""
         d = {"coding": [coding.as_fhir() for coding in self.codings]}
@@ -1,5 +1,6 @@
 from flask import current_app
-from sqlalchemy import UniqueConstraint
+from sqlalchemy import UniqueConstraint, tuple_
+from sqlalchemy.dialects.postgresql import insert
 
 from ..database import db
 
@@ -39,6 +40,64 @@ class Coding(db.Model):
         cc = cls()
         return cc.update_from_fhir(data)
 
+    @staticmethod
+    def key(data):
+        """Return the (system, code) key of a FHIR coding"""
+        return str(data.get('system')), str(data.get('code'))
+
+    @classmethod
+    def bulk_ids(cls, codings):
+        """Return ids for FHIR codings, inserting any not yet found
+
+        Bulk form of ``from_fhir()``, matching on system and code alone.
+        Existing codings are looked up in a single query, and any
+        missing inserted together, ignoring conflicts with concurrent
+        inserts.  Extension codings are resolved first, likewise.
+
+        :param codings: iterable of FHIR coding dictionaries
+        :returns: dictionary of coding ids, keyed by ``Coding.key()``
+
+        """
+        codings = list(codings)
+        extensions = []
+        for data in codings:
+            if data.get('extension'):
+                # Only allow a single extension at this time
+                if len(data['extension']) > 1:
+                    raise ValueError(
+                        "codings model holds a single, optional extension")
+                extensions.append(data['extension'][0]['valueCoding'])
+        ids = cls.bulk_ids(extensions) if extensions else {}
+
+        rows = {}
+        for data in codings:
+            extension_id = None
+            if data.get('extension'):
+                extension_id = ids[cls.key(
+                    data['extension'][0]['valueCoding'])]
+            rows.setdefault(cls.key(data), {
+                'system': str(data['system']) if 'system' in data else None,
+                'code': str(data['code']) if 'code' in data else None,
+                'display': (
+                    str(data['display']) if 'display' in data else None),
+                'extension_id': extension_id})
+
+        def lookup(keys):
+            return {
+                (system, code): id for id, system, code in
+                cls.query.filter(tuple_(cls.system, cls.code).in_(
+                    list(keys))).with_entities(cls.id, cls.system, cls.code)}
+
+        found = lookup(rows.keys()) if rows else {}
+        missing = [key for key in rows if key not in found]
+        if missing:
+            db.session.execute(insert(cls.__table__).values(
+                [rows[key] for key in missing]).on_conflict_do_nothing(
+                constraint='_system_code'))
+            found.update(lookup(missing))
+        ids.update(found)
+        return ids
+
     def as_fhir(self):
         """Return self in JSON FHIR formatted string"""
         d = {}
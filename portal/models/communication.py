@@ -8,17 +8,18 @@ from string import Formatter
 
 from flask import current_app, url_for
 from flask_babel import force_locale, gettext as _
-from sqlalchemy import UniqueConstraint
+from sqlalchemy import UniqueConstraint, inspect
 from sqlalchemy.dialects.postgresql import ENUM
 from sqlalchemy.orm.exc import NoResultFound
 
 from ..audit import auditable_event
 from ..database import db
 from ..date_tools import localize_datetime
+from ..stage_timing import stage_timer
 from ..trace import dump_trace, establish_trace, trace
 from .app_text import MailResource
 from .intervention import INTERVENTION
-from .message import EmailMessage
+from .message import EmailMessage, send_message_batch
 from .overall_status import OverallStatus
 from .practitioner import Practitioner
 from .questionnaire_bank import QuestionnaireBank
@@ -52,29 +53,125 @@ def locale_closure(locale_code, fn):
     return function_with_forced_locale
 
 
+class TemplateArgsPrefetch(object):
+    """Data for ``load_template_args`` lookups, loaded for a batch of users
+
+    Without, each message queries its own practitioner, top level
+    organization, system user and due date, and generates (and audits)
+    a new URL token for every link.  Construct once for a batch of
+    users, and pass as ``load_template_args(prefetch=)``.
+
+    """
+
+    def __init__(self, users, questionnaire_banks=None):
+        """Load data for users in bulk
+
+        :param users: list of users for whom args will be loaded
+        :param questionnaire_banks: optional iterable of
+          (questionnaire_bank_id, qb_iteration) tuples, for which the
+          users' due dates may be needed
+
+        """
+        from .organization import Organization, OrgTree
+        from .qb_timeline import QBT  # avoid cycle
+
+        user_ids = [u.id for u in users]
+        self.system_user = User.query.filter_by(email='__system__').first()
+        self._tokens = {}
+
+        practitioner_ids = {
+            u.practitioner_id for u in users if u.practitioner_id}
+        self.practitioners = {}
+        if practitioner_ids:
+            self.practitioners = {p.id: p for p in Practitioner.query.filter(
+                Practitioner.id.in_(practitioner_ids))}
+
+        ot = OrgTree()
+        first_org = {
+            u.id: next((o.id for o in u.organizations if o.id), None)
+            for u in users}
+        top_ids = {
+            user_id: ot.find(org_id).top_level()
+            for user_id, org_id in first_org.items() if org_id}
+        top_orgs = {}
+        if top_ids:
+            top_orgs = {o.id: o for o in Organization.query.filter(
+                Organization.id.in_(set(top_ids.values())))}
+        self.top_orgs = {
+            user_id: top_orgs.get(org_id)
+            for user_id, org_id in top_ids.items()}
+
+        self.due_starts, self.questionnaire_banks = {}, {}
+        questionnaire_banks = set(questionnaire_banks or ())
+        qb_ids = {qb_id for qb_id, _ in questionnaire_banks if qb_id}
+        if qb_ids and user_ids:
+            self.questionnaire_banks = {
+                qb.id: qb for qb in QuestionnaireBank.query.filter(
+                    QuestionnaireBank.id.in_(qb_ids))}
+            for qbt in QBT.query.filter(QBT.user_id.in_(user_ids)).filter(
+                    QBT.qb_id.in_(qb_ids)).filter(
+                    QBT.status == OverallStatus.due):
+                if (qbt.qb_id, qbt.qb_iteration) in questionnaire_banks:
+                    self.due_starts[
+                        (qbt.user_id, qbt.qb_id, qbt.qb_iteration)] = qbt.at
+
+    def url_token(self, user_id):
+        """Return URL token for user, generated and audited once"""
+        if user_id not in self._tokens:
+            self._tokens[user_id] = url_token(user_id)
+            auditable_event(
+                "generated URL token for user {} to embed in email".format(
+                    user_id),
+                user_id=(
+                    self.system_user.id if self.system_user else user_id),
+                subject_id=user_id, context='authentication')
+        return self._tokens[user_id]
+
+
 def load_template_args(
-        user, questionnaire_bank_id=None, qb_iteration=None):
+        user, questionnaire_bank_id=None, qb_iteration=None,
+        variables=None, prefetch=None):
     """Capture known variable lookup functions and values
 
     To add additional template variable lookup functions, name the
     local function with the `_lookup_` prefix to match, i.e::
         `_lookup_first_name` -> `first_name`
 
+    :param variables: optional list of variable names in use, such as
+      ``MailResource.variable_list``, to limit the lookups captured
+    :param prefetch: optional ``TemplateArgsPrefetch`` including user,
+      for lookups from data loaded in bulk
+
     """
     from .qb_status import NoCurrentQB
     from .qb_timeline import QBT  # avoid cycle
 
     def access_link(next_step):
-        token = url_token(user.id)
-        auditable_event(
-            "generated URL token {} for access_link, next: {}".format(
-                token, next_step), user_id=user.id, subject_id=user.id,
-            context='authentication')
+        if prefetch:
+            token = prefetch.url_token(user.id)
+        else:
+            token = url_token(user.id)
+            auditable_event(
+                "generated URL token {} for access_link, next: {}".format(
+                    token, next_step), user_id=user.id, subject_id=user.id,
+                context='authentication')
 
         return url_for(
             'portal.access_via_token', token=token,
             next_step=next_step, _external=True)
 
+    def embedded_token():
+        if prefetch:
+            return prefetch.url_token(user.id)
+        token = url_token(user.id)
+        system_user = User.query.filter_by(email='__system__').one()
+        auditable_event(
+            "generated URL token for user {} to embed in email".format(
+                user.id),
+            user_id=system_user.id, subject_id=user.id,
+            context='authentication')
+        return token
+
     def make_button(text, inline=False):
         if inline:
             match = re.search(r'href=([^>]+)>([^<]*)', text)
@@ -124,16 +221,9 @@ def load_template_args(
         return make_button(_lookup_decision_support_via_access_link())
 
     def _lookup_decision_support_via_access_link():
-        token = url_token(user.id)
         url = url_for(
-            'portal.access_via_token', token=token,
+            'portal.access_via_token', token=embedded_token(),
             next_step='decision_support', _external=True)
-        system_user = User.query.filter_by(email='__system__').one()
-        auditable_event(
-            "generated URL token for user {} to embed in email".format(
-                user.id),
-            user_id=system_user.id, subject_id=user.id,
-            context='authentication')
         label = _('TrueNTH P3P')
         return '<a href="{url}">{label}</a>'.format(url=url, label=label)
 
@@ -163,7 +253,10 @@ def load_template_args(
         return name
 
     def _lookup_parent_org():
-        org = user.first_top_organization()
+        if prefetch:
+            org = prefetch.top_orgs.get(user.id)
+        else:
+            org = user.first_top_organization()
         if org:
             return _(org.name)
         return ""
@@ -181,7 +274,10 @@ def load_template_args(
     def _lookup_practitioner_name():
         if not user.practitioner_id:
             return ''
-        practitioner = Practitioner.query.get(user.practitioner_id)
+        if prefetch and user.practitioner_id in prefetch.practitioners:
+            practitioner = prefetch.practitioners[user.practitioner_id]
+        else:
+            practitioner = Practitioner.query.get(user.practitioner_id)
         return practitioner.display_name
 
     def _lookup_questionnaire_due_date():
@@ -189,21 +285,28 @@ def load_template_args(
             return ''
 
         # Lookup due date for matching qb, iteration
-        try:
-            qbt = QBT.query.filter(QBT.user_id == user.id).filter(
-                QBT.qb_id == questionnaire_bank_id).filter(
-                QBT.qb_iteration == qb_iteration).filter(
-                QBT.status == OverallStatus.due).one()
-        except NoResultFound:
-            raise NoCurrentQB("no applicable QB{}:{} for {}".format(
-                questionnaire_bank_id, qb_iteration, user))
+        start = None
+        if prefetch:
+            start = prefetch.due_starts.get(
+                (user.id, questionnaire_bank_id, qb_iteration))
+        if start is None:
+            try:
+                start = QBT.query.filter(QBT.user_id == user.id).filter(
+                    QBT.qb_id == questionnaire_bank_id).filter(
+                    QBT.qb_iteration == qb_iteration).filter(
+                    QBT.status == OverallStatus.due).one().at
+            except NoResultFound:
+                raise NoCurrentQB("no applicable QB{}:{} for {}".format(
+                    questionnaire_bank_id, qb_iteration, user))
 
         # Due and start are synonymous in all contexts other than
         # communicating the "due" date to the user.  Adjust what is
         # really the start date IFF the qb happens to have a
         # defined due
-        utc_due = QuestionnaireBank.query.get(qbt.qb_id).calculated_due(
-            qbt.at)
+        qb = (prefetch and prefetch.questionnaire_banks.get(
+            questionnaire_bank_id)) or QuestionnaireBank.query.get(
+            questionnaire_bank_id)
+        utc_due = qb.calculated_due(start)
         trace("UTC due date: {}".format(utc_due))
         due_date = localize_datetime(utc_due, user)
         tz = user.timezone or 'UTC'
@@ -225,15 +328,9 @@ def load_template_args(
         return make_button(_lookup_verify_account_link(), inline=True)
 
     def _lookup_verify_account_link():
-        token = url_token(user.id)
         url = url_for(
-            'portal.access_via_token', token=token, _external=True)
-        system_user = User.query.filter_by(email='__system__').one()
-        auditable_event(
-            "generated URL token for user {} to embed in email".format(
-                user.id),
-            user_id=system_user.id, subject_id=user.id,
-            context='authentication')
+            'portal.access_via_token', token=embedded_token(),
+            _external=True)
         label = _('Verify Account')
         return '<a href="{url}">{label}</a>'.format(url=url, label=label)
 
@@ -244,11 +341,14 @@ def load_template_args(
     # Avoid `dictionary changed size during iteration` error by
     # copying locals
     locs = locals().copy()
+    wanted = set(variables) if variables is not None else None
     for fname, function in locs.items():
         if fname.startswith('_lookup_'):
             # chop the prefix and assign to the function
-            args[fname[len('_lookup_'):]] = locale_closure(
-                locale_code=lc, fn=function)
+            name = fname[len('_lookup_'):]
+            if wanted is not None and name not in wanted:
+                continue
+            args[name] = locale_closure(locale_code=lc, fn=function)
     return args
 
 
@@ -292,18 +392,27 @@ class Communication(db.Model):
             'Communication for user {0.user_id}'
             ' of {0.communication_request.name}'.format(self))
 
-    def generate_message(self):
-        """Collate message details into EmailMessage"""
+    def generate_message(self, prefetch=None):
+        """Collate message details into EmailMessage
+
+        :param prefetch: optional ``TemplateArgsPrefetch``, when generating
+          a batch of messages
+
+        """
         user = User.query.get(self.user_id)
 
         qb_id = self.communication_request.questionnaire_bank_id
-        args = load_template_args(
-            user=user, questionnaire_bank_id=qb_id,
-            qb_iteration=self.communication_request.qb_iteration)
-        mailresource = MailResource(
-            url=self.communication_request.content_url,
-            locale_code=user.locale_code,
-            variables=args)
+        with stage_timer('communication', 'mail_resource'):
+            mailresource = MailResource(
+                url=self.communication_request.content_url,
+                locale_code=user.locale_code)
+        with stage_timer('communication', 'template_args'):
+            # only capture lookups for variables used in the template
+            args = load_template_args(
+                user=user, questionnaire_bank_id=qb_id,
+                qb_iteration=self.communication_request.qb_iteration,
+                variables=mailresource.variable_list, prefetch=prefetch)
+        mailresource.variables = args
 
         missing = set(mailresource.variable_list) - set(args)
         if missing:
@@ -321,8 +430,16 @@ class Communication(db.Model):
 
         return msg
 
-    def generate_and_send(self):
-        """Collate message details and send"""
+    def prepare_message(self, prefetch=None):
+        """Collate message details, ready to send
+
+        :param prefetch: optional ``TemplateArgsPrefetch``, when preparing
+          a batch of messages
+        :returns: the generated EmailMessage, or None if the communication
+          was suspended, as the user has since withdrawn
+        :raises ValueError: if the user isn't ready for email
+
+        """
         from .qb_timeline import qb_status_visit_name
 
         if current_app.config.get('DEBUG_EMAIL', False):
@@ -341,33 +458,47 @@ class Communication(db.Model):
                     user=user, reason=reason))
 
         rs_id = self.communication_request.questionnaire_bank.research_study_id
-        qb_status = qb_status_visit_name(
-            self.user_id, rs_id, datetime.utcnow())
+        with stage_timer('communication', 'qb_status'):
+            qb_status = qb_status_visit_name(
+                self.user_id, rs_id, datetime.utcnow())
         if qb_status['status'] == OverallStatus.withdrawn:
             current_app.logger.info(
                 "Skipping message send for withdrawn {}".format(user))
             self.status = 'suspended'
-            return
+            return None
 
         trace("load variables for {user} & UUID {uuid} on {request}".format(
             user=user,
             uuid=self.communication_request.lr_uuid,
             request=self.communication_request.name))
 
-        self.message = self.generate_message()
+        self.message = self.generate_message(prefetch=prefetch)
+        return self.message
+
+    def recipients_refused(self, exc):
+        """Record failure to deliver, as the recipient was refused"""
+        user = User.query.get(self.user_id)
+        msg = ("Error sending Communication {} to {}: "
+               "{}".format(self.id, user.email, exc))
+        current_app.logger.error(msg)
+        sys = User.query.filter_by(email='__system__').first()
+        auditable_event(message=msg,
+                        user_id=(sys.id if sys else user.id),
+                        subject_id=user.id,
+                        context="user")
+        self.status = 'aborted'
+
+    def generate_and_send(self):
+        """Collate message details and send"""
+        if not self.prepare_message():
+            return
+
         try:
-            self.message.send_message()
+            with stage_timer('communication', 'smtp'):
+                self.message.send_message()
             self.status = 'completed'
         except SMTPRecipientsRefused as exc:
-            msg = ("Error sending Communication {} to {}: "
-                   "{}".format(self.id, user.email, exc))
-            current_app.logger.error(msg)
-            sys = User.query.filter_by(email='__system__').first()
-            auditable_event(message=msg,
-                            user_id=(sys.id if sys else user.id),
-                            subject_id=user.id,
-                            context="user")
-            self.status = 'aborted'
+            self.recipients_refused(exc)
 
     def preview(self):
         """Collate message details and return preview (DOES NOT SEND)"""
@@ -377,6 +508,79 @@ class Communication(db.Model):
         return msg
 
 
+def send_communications(communications):
+    """Collate and send a batch of communications
+
+    Messages are generated for each communication, and then sent together
+    over a single SMTP connection via ``send_message_batch()``.
+
+    Communications are marked `completed` on success or `aborted` if the
+    recipient was refused.  On any other failure, including errors
+    preparing the message such as template rendering problems, the
+    communication remains in `preparation`, for a subsequent attempt to
+    retry, and the rest of the batch proceeds.
+
+    :param communications: list of Communication instances
+    :returns: list of (communication, exception) for those failing
+
+    """
+    if not communications:
+        return []
+    failures = []
+    prepared = []
+    prefetch = TemplateArgsPrefetch(
+        users=User.query.filter(User.id.in_(
+            {c.user_id for c in communications})).all(),
+        questionnaire_banks={(
+            c.communication_request.questionnaire_bank_id,
+            c.communication_request.qb_iteration) for c in communications})
+
+    def drop_message(communication):
+        """Drop any unsent message, leaving communication for retry
+
+        The message may already have been flushed or committed along with
+        the audit rows of the batch, in which case the row is deleted.
+
+        """
+        message = communication.message
+        communication.message = None
+        if message is None:
+            return
+        state = inspect(message)
+        if state.persistent:
+            db.session.delete(message)
+        elif state.pending:
+            db.session.expunge(message)
+
+    for communication in communications:
+        try:
+            if communication.prepare_message(prefetch=prefetch):
+                prepared.append(communication)
+        except ValueError as ve:
+            failures.append((communication, ve))
+        except Exception as exc:
+            # don't let one bad communication block the rest of the batch
+            current_app.logger.exception(
+                "Error preparing Communication %d", communication.id)
+            drop_message(communication)
+            failures.append((communication, exc))
+
+    with stage_timer('communication', 'smtp_batch'):
+        results = send_message_batch([c.message for c in prepared])
+    for communication, exc in zip(prepared, results):
+        if exc is None:
+            communication.status = 'completed'
+        elif isinstance(exc, SMTPRecipientsRefused):
+            communication.recipients_refused(exc)
+        else:
+            # leave in preparation; drop the unsent message for retry
+            current_app.logger.error(
+                "Error sending Communication %d: %s", communication.id, exc)
+            drop_message(communication)
+            failures.append((communication, exc))
+    return failures
+
+
 class DynamicDictLookup(MutableMapping):
     """Dictionary like interface with lazy lookup of values"""
 
@@ -209,25 +209,98 @@ def queue_outstanding_messages(user, questionnaire_bank, iteration_count):
     Messages are queued by adding to the Communications table, with
     'preparation' status.
 
+    To process a number of users, see ``queue_outstanding_messages_batch()``
+
     """
-    if not user.email_ready()[0]:
+    trace("process {}; iteration {}".format(
+        questionnaire_bank, iteration_count))
+
+    from .qb_status import qb_status
+    research_study_id = questionnaire_bank.research_study_id
+    qstats = qb_status(user=user, research_study_id=research_study_id)
+    qbd = qstats.current_qbd()
+    if not qbd:
+        trace("no current QB found, can't continue")
+        return
+    queue_outstanding_messages_batch([(user, qbd, qstats)])
+
+
+def email_ready_user_ids(users):
+    """Bulk form of ``User.email_ready()`` for a collection of users
+
+    :returns: set of user ids ready to receive email
+
+    """
+    from .user_preference import UserPreference
+
+    suppressed = {
+        user_id for user_id, in UserPreference.query.filter(
+            UserPreference.user_id.in_([u.id for u in users])).filter(
+            UserPreference.preference_name == 'suppress_email'
+        ).with_entities(UserPreference.user_id)}
+
+    # preferences are checked above, in bulk
+    return {
+        u.id for u in users if u.id not in suppressed and
+        u.email_ready(ignore_preference=True)[0]}
+
+
+def queue_outstanding_messages_batch(batch):
+    """Lookup and queue outstanding communications for a batch of users
+
+    Set based form of ``queue_outstanding_messages()``.  Existing
+    communications and email readiness are looked up once for the
+    entire batch, and any new communications bulk inserted.
+
+    :param batch: list of (user, qbd, qb_status) tuples, where qbd is
+      the user's current QBD and qb_status the QB_Status from which it
+      was obtained, for the research study in question
+
+    """
+    batch = [(user, qbd, qstats) for user, qbd, qstats in batch if qbd]
+    if not batch:
+        return
+
+    ready_ids = email_ready_user_ids([user for user, _, _ in batch])
+    batch = [item for item in batch if item[0].id in ready_ids]
+    if not batch:
         # don't queue/send message if user isn't ready to receive them
-        trace("user isn't 'email_ready, abort")
+        trace("no users are 'email_ready', abort")
         return
 
-    trace("process {}; iteration {}".format(
-        questionnaire_bank, iteration_count))
+    request_ids = {
+        request.id for _, qbd, _ in batch
+        for request in qbd.questionnaire_bank.communication_requests}
+    existing = set(Communication.query.filter(
+        Communication.user_id.in_({user.id for user, _, _ in batch})).filter(
+        Communication.communication_request_id.in_(request_ids)
+    ).with_entities(
+        Communication.user_id, Communication.communication_request_id))
 
-    def existing_communication(user_id, communication_request_id):
-        """Return a matching communication, if found"""
-        existing = Communication.query.filter(
-            Communication.user_id == user_id
-        ).filter(
-            Communication.communication_request_id == communication_request_id
-        ).first()
-        if existing:
-            trace('found existing communication for this request')
-        return existing
+    now = datetime.utcnow()
+    mappings = []
+    for user, qbd, qstats in batch:
+        mappings.extend(_outstanding_communications(
+            user=user, qbd=qbd, qstats=qstats, existing=existing, now=now))
+
+    if mappings:
+        db.session.bulk_insert_mappings(Communication, mappings)
+        db.session.commit()
+
+
+def _outstanding_communications(user, qbd, qstats, existing, now):
+    """Determine communications to queue for the given user
+
+    :param existing: set of (user_id, communication_request_id) for
+      communications previously generated
+    :returns: list of mappings to insert as Communications
+
+    """
+    questionnaire_bank = qbd.questionnaire_bank
+    trace("computed start {} with expiry {} for QB {} iteration {}".format(
+        qbd.relative_start,
+        qbd.relative_start + RelativeDelta(questionnaire_bank.expired),
+        questionnaire_bank.name, qbd.iteration))
 
     def unfinished_work(qstats):
         """Return True if user has outstanding work and valid time remains
@@ -247,38 +320,22 @@ def queue_outstanding_messages(user, questionnaire_bank, iteration_count):
         return unfinished_work
 
     def queue_communication(user, communication_request):
-        """Create new communication object in preparation state"""
+        """Create new communication mapping in preparation state"""
 
         if not user.email or '@' not in user.email:
             raise ValueError(
                 "can't send communication to user w/o valid email address")
 
-        communication = Communication(
-            user_id=user.id,
-            status='preparation',
-            communication_request_id=communication_request.id)
+        communication = {
+            'user_id': user.id,
+            'status': 'preparation',
+            'communication_request_id': communication_request.id}
         current_app.logger.debug(
             "communication prepared for {}".format(user.id))
-        db.session.add(communication)
-        trace('added {}'.format(communication))
+        trace('added communication for user {} of {}'.format(
+            user.id, communication_request.name))
         return communication
 
-    now = datetime.utcnow()
-    from .qb_status import QB_Status
-    research_study_id = questionnaire_bank.research_study_id
-    qstats = QB_Status(
-        user=user,
-        research_study_id=research_study_id,
-        as_of_date=datetime.utcnow())
-    qbd = qstats.current_qbd()
-    if not qbd:
-        trace("no current QB found, can't continue")
-        return
-    trace("computed start {} with expiry {} for QB {} iteration {}".format(
-        qbd.relative_start,
-        qbd.relative_start + RelativeDelta(questionnaire_bank.expired),
-        qbd.questionnaire_bank.name, qbd.iteration))
-
     newly_crafted = []  # holds tuples (notify_date, communication)
     if not len(questionnaire_bank.communication_requests):
         trace("zero communication requests in questionnaire_bank")
@@ -295,9 +352,8 @@ def queue_outstanding_messages(user, questionnaire_bank, iteration_count):
             continue
 
         # Continue if matching message was already generated
-        if existing_communication(
-                user_id=user.id,
-                communication_request_id=request.id):
+        if (user.id, request.id) in existing:
+            trace('found existing communication for this request')
             continue
 
         # Confirm reason for message remains
@@ -332,8 +388,7 @@ def queue_outstanding_messages(user, questionnaire_bank, iteration_count):
             if d > newest[0]:
                 newest = (d, c)
         for _, c in newly_crafted:
-            if c != newest[1]:
-                c.status = 'suspended'
+            if c is not newest[1]:
+                c['status'] = 'suspended'
 
-    if newly_crafted:
-        db.session.commit()
+    return [c for _, c in newly_crafted]
@@ -1,14 +1,16 @@
 """Intervention Module"""
 from flask import current_app
-from sqlalchemy import and_
+from sqlalchemy import and_, event
 from sqlalchemy.dialects.postgresql import ENUM
 from sqlalchemy.ext.hybrid import hybrid_property
+from sqlalchemy.orm import object_session
 from sqlalchemy.orm.exc import NoResultFound
 from werkzeug.exceptions import BadRequest
 
 from ..database import db
 from ..dict_tools import strip_empties
 from .lazy import query_by_name
+from .reference_data import mark_reference_data_stale
 from .role import ROLE
 
 LOGOUT_EVENT = 0b001
@@ -356,6 +358,14 @@ STATIC_INTERVENTIONS = {
 }
 
 
+@event.listens_for(Intervention, 'after_insert')
+@event.listens_for(Intervention, 'after_update')
+@event.listens_for(Intervention, 'after_delete')
+def _intervention_written(mapper, connection, target):
+    # registry snapshots, i.e. ``INTERVENTION.X.client``, must reload
+    mark_reference_data_stale(object_session(target))
+
+
 def add_static_interventions():
     """Seed database with default static interventions
 
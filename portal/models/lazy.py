@@ -46,35 +46,27 @@ def lazyprop(fn):
 
 
 def query_by_name(cls, name):
-    """returns a lazy load function capable of caching object
+    """returns a lazy load function for the named reference data object
 
     Use this alternative for classes with dynamic attributes (names
     not hardcoded in class definition), as property decorators
     (i.e. @lazyprop) don't function properly.
 
-    As the SQLAlchemy session is NOT thread safe, we include the thread
-    identifier in the key
-
-    NB - attribute instances must be unique over (cls.__name__, name)
-    within the containing class to avoid collisions.
+    The instance is served by the process wide ``ReferenceData``
+    registry and merged into the current session without a query, so no
+    per-thread or per-instance caching is necessary.
 
-    @param cls: ORM class to query
+    @param cls: ORM reference data class, see ``reference_data``
     @param name: name field in ORM class to uniquely define object
 
     """
-    attr_name = '_lazy_{}_{}.{}'.format(
-        cls.__name__, name, _thread.get_ident())
-
     def lookup(self):
-        if not hasattr(self, attr_name):
-            setattr(self, attr_name, cls.query.filter_by(name=name).one())
-        attr = getattr(self, attr_name)
+        from .reference_data import lookup_by_name
 
-        # ORM objects (especially in testing) are occasionally detached
-        if attr not in db.session:
-            # reload - merge fails on collected objs
+        attr = lookup_by_name(cls, name)
+        if attr is None:
+            # not (yet) in registry - raises NoResultFound if missing
             attr = cls.query.filter_by(name=name).one()
-            setattr(self, attr_name, attr)
         return attr
 
     return lookup
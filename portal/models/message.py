@@ -1,15 +1,18 @@
 """Model classes for message data"""
 
 from datetime import datetime
+from smtplib import SMTPException, SMTPServerDisconnected
 from flask import current_app
+from sqlalchemy import func
 from sqlalchemy.ext.hybrid import hybrid_property
 from textwrap import fill
 
 from flask_mail import Message, email_dispatched
 
-from ..audit import auditable_event
+from ..audit import AUDIT, auditable_event
 from ..database import db
 from ..extensions import mail
+from .audit import Audit
 from .user import INVITE_PREFIX, User
 
 
@@ -141,13 +144,11 @@ class EmailMessage(db.Model):
         return '{header}{body}{footer}'.format(
             header=EMAIL_HEADER, body=body, footer=EMAIL_FOOTER)
 
-    def send_message(self, cc_address=None):
-        """Send the message
+    def mail_message(self, cc_address=None):
+        """Generate the styled flask_mail Message for transmission
 
         :param cc_address: include valid email address to send a carbon copy
 
-        NB the cc isn't persisted with the rest of the record.
-
         """
         message = Message(
             subject=self.subject,
@@ -158,6 +159,27 @@ class EmailMessage(db.Model):
         body = self.style_message(self.body)
         message.html = fill(
             body, width=280, break_long_words=False, break_on_hyphens=False)
+        return message
+
+    def audit_message(self, exc=None):
+        """Return text for audit entry on send; include exception if given"""
+        audit_msg = ("EmailMessage '{0.subject}' sent to "
+                     "{0.recipients} from {0.sender}".format(self))
+        if exc:
+            audit_msg = "ERROR {}; {}".format(str(exc), audit_msg)
+        return audit_msg
+
+    def send_message(self, cc_address=None):
+        """Send the message
+
+        :param cc_address: include valid email address to send a carbon copy
+
+        NB the cc isn't persisted with the rest of the record.
+
+        To send a number of messages, see ``send_message_batch()``
+
+        """
+        message = self.mail_message(cc_address=cc_address)
         exc = None
         try:
             mail.send(message)
@@ -171,11 +193,7 @@ class EmailMessage(db.Model):
         subject_id = subject.id if subject else self.user_id
 
         if user_id and subject_id:
-            audit_msg = ("EmailMessage '{0.subject}' sent to "
-                         "{0.recipients} from {0.sender}".format(self))
-            if exc:
-                audit_msg = "ERROR {}; {}".format(str(exc), audit_msg)
-            auditable_event(message=audit_msg, user_id=user_id,
+            auditable_event(message=self.audit_message(exc), user_id=user_id,
                             subject_id=subject_id, context="user")
         else:
             # This should never happen, alert if it does
@@ -198,3 +216,101 @@ class EmailMessage(db.Model):
             'body': self.body, 'sent_at': self.sent_at,
             'user_id': self.user_id}
         return d
+
+
+def user_ids_by_email(emails):
+    """Bulk form of ``User.find_by_email``, for a collection of addresses
+
+    :returns: dictionary mapping each lower case email to a user id, for
+      those found.  Exact matches are preferred over invited users.
+
+    """
+    lowered = {e.lower() for e in emails if '@' in e}
+    if not lowered:
+        return {}
+    candidates = lowered | {f"{INVITE_PREFIX}{e}".lower() for e in lowered}
+    found = dict(User.query.filter(
+        func.lower(User._email).in_(candidates)).with_entities(
+        func.lower(User._email), User.id))
+    results = {}
+    for email in lowered:
+        user_id = found.get(email) or found.get(
+            f"{INVITE_PREFIX}{email}".lower())
+        if user_id:
+            results[email] = user_id
+    return results
+
+
+def send_message_batch(email_messages):
+    """Send a batch of EmailMessages over one persistent SMTP connection
+
+    Unlike calling ``send_message()`` on each, the audit actors are looked
+    up once for the batch, and the audit rows are bulk inserted.  Should
+    the server drop the connection, a new one is opened and the send
+    retried once.
+
+    NB the audit rows are added to the session, commit is left to the
+    caller as with any pending EmailMessages.
+
+    :param email_messages: list of EmailMessage instances to send
+    :returns: list of exceptions, one per email_message, None on success
+
+    """
+    if not email_messages:
+        return []
+    results = [None] * len(email_messages)
+
+    def close(connection):
+        try:
+            connection.__exit__(None, None, None)
+        except SMTPException:
+            pass  # already disconnected
+
+    index, retried = 0, False
+    while index < len(email_messages):
+        try:
+            connection = mail.connect()
+            connection.__enter__()
+        except Exception as exc:
+            # unable to (re)connect; fail the remainder of the batch
+            current_app.logger.error("unable to connect to SMTP: %s", exc)
+            for i in range(index, len(email_messages)):
+                results[i] = exc
+            break
+
+        while index < len(email_messages):
+            try:
+                connection.send(email_messages[index].mail_message())
+            except SMTPServerDisconnected as exc:
+                if not retried:
+                    retried = True
+                    break  # reconnect and retry this message
+                results[index] = exc
+            except Exception as exc:
+                results[index] = exc
+            index += 1
+            retried = False
+        close(connection)
+
+    system_user = User.query.filter_by(email='__system__').first()
+    subject_ids = user_ids_by_email(
+        [m.recipients.split()[0] for m in email_messages])
+    audits = []
+    for email_message, exc in zip(email_messages, results):
+        recipient = email_message.recipients.split()[0]
+        subject_id = subject_ids.get(recipient.lower(), email_message.user_id)
+        if not (system_user and subject_id):
+            # This should never happen, alert if it does
+            current_app.logger.error(
+                "Unable to generate audit log for email to %s: %s",
+                recipient, email_message.subject)
+            continue
+        comment = email_message.audit_message(exc)
+        current_app.logger.log(
+            AUDIT, "performed by {0} on {1}: user: {2}".format(
+                system_user.id, subject_id, comment))
+        audits.append(Audit(
+            user_id=system_user.id, subject_id=subject_id, comment=comment,
+            context='user'))
+    db.session.bulk_save_objects(audits)
+    return results
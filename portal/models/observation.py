@@ -1,4 +1,7 @@
 from datetime import datetime
+import json
+
+from sqlalchemy.dialects.postgresql import insert
 
 from ..database import db
 from ..date_tools import FHIR_datetime, as_fhir
@@ -127,10 +130,60 @@ class Observation(db.Model):
 
     @classmethod
     def parse_obs_bundle(cls, obs_bundle):
+        """Persist the Observations from a bundle, such as SDC $extract
+
+        Codings and concepts for the entire bundle are resolved in bulk,
+        and the Observations inserted in a single statement.  Any entry
+        including a valueQuantity or performer takes the slower path
+        via ``update_from_fhir()``.
+
+        """
+        bulk = []
         for obs in obs_bundle['entry']:
+            if 'code' in obs and not (
+                    'valueQuantity' in obs or 'performer' in obs):
+                bulk.append(obs)
+                continue
             observation = cls()
             observation.update_from_fhir(obs)
             db.session.add(observation)
+        if not bulk:
+            return
+
+        coding_ids = Coding.bulk_ids(
+            [coding for obs in bulk for coding in obs['code']['coding']] +
+            [obs['valueCoding'] for obs in bulk if 'valueCoding' in obs])
+        concept_ids = CodeableConcept.bulk_ids(
+            [obs['code'] for obs in bulk], coding_ids=coding_ids)
+
+        derived_from = {}  # all entries typically derive from one QNR
+        rows = []
+        for obs in bulk:
+            row = {
+                'issued': datetime.utcnow(),
+                'status': obs.get('status'),
+                'codeable_concept_id': concept_ids[
+                    CodeableConcept.key(obs['code'])],
+                'value_coding_id': None,
+                'derived_from': None}
+            if 'issued' in obs:
+                row['issued'] = FHIR_datetime.parse(
+                    obs['issued']) if obs['issued'] else None
+            if 'valueCoding' in obs:
+                row['value_coding_id'] = coding_ids[
+                    Coding.key(obs['valueCoding'])]
+            if 'derivedFrom' in obs:
+                if len(obs['derivedFrom']) != 1:
+                    raise ValueError(
+                        "only single QuestionnareResponse reference "
+                        "supported in Observation.derivedFrom")
+                ref_key = json.dumps(obs['derivedFrom'][0], sort_keys=True)
+                if ref_key not in derived_from:
+                    derived_from[ref_key] = Reference.parse(
+                        obs['derivedFrom'][0]).id
+                row['derived_from'] = derived_from[ref_key]
+            rows.append(row)
+        db.session.execute(insert(cls.__table__).values(rows))
 
 
 class UserObservation(db.Model):
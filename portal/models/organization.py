@@ -3,14 +3,15 @@
 Designed around FHIR guidelines for representation of organizations, locations
 and healthcare services which are used to describe hospitals and clinics.
 """
-from flask import current_app, url_for
-from sqlalchemy import UniqueConstraint, and_
+from flask import current_app, has_app_context, url_for
+from sqlalchemy import UniqueConstraint, and_, event
 from sqlalchemy.ext.associationproxy import association_proxy
 from sqlalchemy.ext.hybrid import hybrid_property
-from sqlalchemy.orm import backref
+from sqlalchemy.orm import Session, backref, object_session
 from werkzeug.exceptions import BadRequest, NotFound, Unauthorized
 
 from . import address
+from ..cache import cache
 from ..database import db
 from ..date_tools import FHIR_datetime
 from ..dict_tools import strip_empties
@@ -30,7 +31,7 @@ from .fhir import bundle_results
 from .identifier import Identifier
 from .reference import Reference
 from .research_protocol import ResearchProtocol
-from .role import ROLE, Role
+from .role import ROLE
 from .telecom import ContactPoint, Telecom
 
 USE_SPECIFIC_CODINGS_MASK = 0b0001
@@ -38,6 +39,58 @@ RACE_CODINGS_MASK = 0b0010
 ETHNICITY_CODINGS_MASK = 0b0100
 INDIGENOUS_CODINGS_MASK = 0b1000
 
+ORGANIZATION_FHIR_GENERATION_KEY = 'organization_fhir_generation'
+ORGANIZATION_FHIR_STALE = 'organization_fhir_stale'  # session.info key
+
+
+def organization_fhir_generation():
+    """Return the current generation of stored organization documents"""
+    return cache.get(ORGANIZATION_FHIR_GENERATION_KEY) or 0
+
+
+def organization_fhir_key(organization_id, include_empties, generation):
+    """Cache key for the serialized FHIR form of an organization"""
+    return "organization_fhir::{}::{}::{}".format(
+        generation, organization_id, bool(include_empties))
+
+
+def invalidate_organization_fhir():
+    """Retire all stored organization FHIR documents
+
+    Advances the generation included in the document keys, so documents
+    stored under a prior generation, including any stored concurrently
+    from state read before a change, are never read again (and expire
+    with ``ORGANIZATION_FHIR_CACHE_TIMEOUT``).  Documents are regenerated
+    on next request, see ``Organization.generate_bundle()``.
+
+    Called after commit of any change to organizations, see
+    ``mark_organization_fhir_stale()``.
+
+    """
+    cache.inc(ORGANIZATION_FHIR_GENERATION_KEY)
+
+
+def mark_organization_fhir_stale(session):
+    """Retire stored organization documents once the session commits
+
+    Writes to the organizations table are noted automatically; call for
+    changes to related state which alters organization documents.
+
+    """
+    session.info[ORGANIZATION_FHIR_STALE] = True
+
+
+@event.listens_for(Session, 'after_commit')
+def _retire_organization_fhir(session):
+    if session.info.pop(ORGANIZATION_FHIR_STALE, None) and (
+            has_app_context()):
+        invalidate_organization_fhir()
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_organization_fhir_stale(session):
+    session.info.pop(ORGANIZATION_FHIR_STALE, None)
+
 
 class Organization(db.Model):
     """Model representing a FHIR organization
@@ -298,18 +351,22 @@ class Organization(db.Model):
         Designed to allow for cache invalidation or other flushing needed
         on state changes.  As organizations define users affiliation with
         questionnaires via research protocol, such a change means flush
-        any existing qb_timeline rows for member users
+        any existing qb_timeline rows, and pending work summarized from
+        them, for member users
 
         """
+        from .pending_work import forget_users_pending_work
         from .user import UserRoles
         from .qb_timeline import QBT
 
         # no easy way to determine what changed - don't take a chance
         # on leaving behind invalid cache data - purge any qb_timeline
         # rows that may be affected.
+        from .reference_data import ReferenceData
+
         org_ids = OrgTree().here_and_below_id(self.id)
-        patient_role = Role.query.filter(
-            Role.name == ROLE.PATIENT.value).one()
+        patient_role = ReferenceData.current().roles.by_name(
+            ROLE.PATIENT.value)
         patient_ids = UserOrganization.query.join(
             UserRoles, UserOrganization.user_id == UserRoles.user_id).filter(
             UserRoles.role_id == patient_role.id).filter(
@@ -317,6 +374,10 @@ class Organization(db.Model):
             UserOrganization.user_id)
         QBT.query.filter(QBT.user_id.in_(patient_ids)).delete(
             synchronize_session=False)
+        forget_users_pending_work(patient_ids)
+
+        # Change may not yet be committed; retire stored documents on commit
+        mark_organization_fhir_stale(db.session)
 
     @classmethod
     def from_fhir(cls, data):
@@ -427,21 +488,62 @@ class Organization(db.Model):
             return strip_empties(d)
         return d
 
+    def store_fhir(self, generation=None):
+        """Serialize and store FHIR documents for use in bundles
+
+        Called on write, once the organization state is committed.  Both
+        the full and stripped (no empties) forms are stored, until the
+        generation advances on the next change to any organization, or
+        ``ORGANIZATION_FHIR_CACHE_TIMEOUT`` passes.
+
+        :param generation: generation read prior to loading the state
+          being stored, defaults to the current
+        :returns: dictionary of stored documents keyed by `include_empties`
+
+        """
+        if generation is None:
+            generation = organization_fhir_generation()
+        docs = {
+            include_empties: self.as_fhir(include_empties=include_empties)
+            for include_empties in (True, False)}
+        for include_empties, doc in docs.items():
+            cache.set(
+                organization_fhir_key(self.id, include_empties, generation),
+                doc,
+                timeout=current_app.config['ORGANIZATION_FHIR_CACHE_TIMEOUT'])
+        return docs
+
     @classmethod
     def generate_bundle(cls, limit_to_ids=None, include_empties=True):
         """Generate a FHIR bundle of existing orgs ordered by ID
 
+        Assembled from the documents stored by ``store_fhir()``, any
+        organization missing a stored document is serialized and stored.
+
         :param limit_to_ids: if defined, only return the matching set,
           otherwise all organizations found
         :param include_empties: set to include empty attributes
         :return:
 
         """
-        query = Organization.query.order_by(Organization.id)
+        # read the generation first; should a change commit meanwhile,
+        # documents stored below are under the retired generation
+        generation = organization_fhir_generation()
+        query = Organization.query.order_by(
+            Organization.id).with_entities(Organization.id)
         if limit_to_ids:
             query = query.filter(Organization.id.in_(limit_to_ids))
-
-        orgs = [o.as_fhir(include_empties=include_empties) for o in query]
+        org_ids = [org_id for org_id, in query]
+
+        docs = cache.get_many(*[
+            organization_fhir_key(org_id, include_empties, generation)
+            for org_id in org_ids]) if org_ids else []
+        orgs = []
+        for org_id, doc in zip(org_ids, docs):
+            if doc is None:
+                doc = Organization.query.get(org_id).store_fhir(
+                    generation=generation)[include_empties]
+            orgs.append(doc)
 
         search_link = {
             'rel': 'self',
@@ -708,6 +810,13 @@ class OrganizationIdentifier(db.Model):
         'Identifier', cascade="save-update", foreign_keys=[identifier_id])
 
 
+@event.listens_for(Organization, 'after_insert')
+@event.listens_for(Organization, 'after_update')
+@event.listens_for(Organization, 'after_delete')
+def _organization_written(mapper, connection, target):
+    mark_organization_fhir_stale(object_session(target))
+
+
 class OrgNode(object):
     """Node in tree of organizations - used by org tree
 
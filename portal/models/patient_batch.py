@@ -0,0 +1,304 @@
+"""Patient Batch module
+
+``update_patient_loop`` visits every patient, in batches handed off to
+celery.  The ``PatientBatchScheduler`` streams patient ids from the
+database, sizes batches from the observed cost of prior batches, and
+tracks patients with work in flight in redis, so overlapping runs of the
+same kind of job skip rather than duplicate the effort.  Claims older than
+``UPDATE_PATIENT_IN_FLIGHT_TIMEOUT``, such as those of a killed worker or
+lost task, lapse, so said patients are picked up by a later run.
+
+"""
+from datetime import datetime, timedelta
+import time
+from uuid import uuid4
+
+from flask import current_app
+import redis
+from sqlalchemy import and_
+
+from ..database import db
+from .qb_timeline import QBT
+from .reference_data import ReferenceData
+from .role import ROLE
+from .user import User, UserRoles
+
+IN_FLIGHT_KEY = 'update_patients_claims::{kind}'  # sorted set, by time
+COST_KEY = 'update_patients_cost'
+PROGRESS_KEY = 'update_patients_progress::{run_id}'
+
+# weight given the latest observation in the per patient cost average
+COST_SMOOTHING = 0.3
+
+# Release only claims still held at the given claim time; a lapsed claim
+# may since have been taken by another run
+RELEASE_SCRIPT = """
+local released = 0
+for i = 2, #ARGV do
+    local score = redis.call('zscore', KEYS[1], ARGV[i])
+    if score and tonumber(score) == tonumber(ARGV[1]) then
+        released = released + redis.call('zrem', KEYS[1], ARGV[i])
+    end
+end
+return released
+"""
+
+
+def job_kind(update_cache, queue_messages):
+    """Returns name for the kind of update, to scope in flight claims"""
+    return '+'.join(name for name, enabled in (
+        ('update_cache', update_cache),
+        ('queue_messages', queue_messages)) if enabled)
+
+
+def patient_query():
+    """Returns query for ids of all valid (not deleted) patients"""
+    patient_role_id = ReferenceData.current().roles.by_name(
+        ROLE.PATIENT.value).id
+    return User.query.join(UserRoles).filter(and_(
+        User.id == UserRoles.user_id,
+        User.deleted_id.is_(None),
+        UserRoles.role_id == patient_role_id)).with_entities(User.id)
+
+
+def priority_patient_ids(within):
+    """Returns set of patient ids with a QB transition coming up
+
+    :param within: timedelta from now, defining the window of interest
+
+    """
+    now = datetime.utcnow()
+    upcoming = db.session.query(QBT.user_id).filter(
+        QBT.at.between(now, now + within)).distinct()
+    return {user_id for user_id, in patient_query().filter(
+        User.id.in_(upcoming))}
+
+
+def stream_patient_ids(page_size, priority=None):
+    """Generator yielding patient ids, via keyset pagination
+
+    Avoids loading all ids up front, reading `page_size` ids at a time
+    in id order.
+
+    :param page_size: number of ids to fetch per query
+    :param priority: optional set of ids to yield first
+
+    """
+    priority = priority or set()
+    for patient_id in sorted(priority):
+        yield patient_id
+
+    query = patient_query().order_by(User.id)
+    last_id = 0
+    while True:
+        page = [user_id for user_id, in query.filter(
+            User.id > last_id).limit(page_size)]
+        if not page:
+            return
+        for patient_id in page:
+            if patient_id not in priority:
+                yield patient_id
+        last_id = page[-1]
+
+
+class PatientBatchScheduler(object):
+    """Plans and tracks the batches of an ``update_patient_loop`` run
+
+    Batch size targets ``UPDATE_PATIENT_TASK_TARGET_SECONDS`` per batch,
+    given the moving average of seconds per patient recorded by prior
+    batches, bounded by ``UPDATE_PATIENT_TASK_MAX_BATCH_SIZE``.  Until a
+    cost has been observed, ``UPDATE_PATIENT_TASK_BATCH_SIZE`` is used.
+
+    :param run_id: identifies the run progress is recorded against; set
+      by ``start_run()`` and passed along to the batch tasks
+    :param kind: kind of update, from ``job_kind()``; runs only skip
+      patients in flight for the same kind
+
+    """
+    redis = None
+
+    def __init__(self, run_id=None, kind=job_kind(True, True)):
+        if self.redis is None:
+            self.redis = redis.StrictRedis.from_url(
+                current_app.config['REDIS_URL'])
+        self.in_flight_timeout = current_app.config[
+            'UPDATE_PATIENT_IN_FLIGHT_TIMEOUT']
+        self.in_flight_key = IN_FLIGHT_KEY.format(kind=kind)
+        self.run_id = run_id
+
+    def cost(self):
+        """Returns moving average of seconds per patient, or None"""
+        value = self.redis.get(COST_KEY)
+        return float(value) if value else None
+
+    def record_cost(self, patient_count, seconds):
+        """Fold observed duration of a batch into the moving average"""
+        if not patient_count:
+            return
+        observed = seconds / patient_count
+        previous = self.cost()
+        if previous is not None:
+            observed = (
+                COST_SMOOTHING * observed +
+                (1 - COST_SMOOTHING) * previous)
+        self.redis.set(COST_KEY, observed)
+
+    def batch_size(self):
+        """Returns number of patients to include in the next batch"""
+        config = current_app.config
+        cost = self.cost()
+        if not cost:
+            return config['UPDATE_PATIENT_TASK_BATCH_SIZE']
+        size = int(config['UPDATE_PATIENT_TASK_TARGET_SECONDS'] / cost)
+        return max(1, min(size, config['UPDATE_PATIENT_TASK_MAX_BATCH_SIZE']))
+
+    def claim(self, patient_ids, now=None):
+        """Mark patients in flight, returning those not already claimed
+
+        Patients already in flight, i.e. queued by an overlapping run and
+        not yet complete, are excluded from the returned list.  Claims
+        older than the in flight timeout are pruned first, so patients
+        left behind by a killed worker or lost task are claimed anew.
+
+        :param now: claim time, in epoch seconds; defaults to current
+
+        """
+        if not patient_ids:
+            return []
+        now = time.time() if now is None else now
+        pipe = self.redis.pipeline()
+        pipe.zremrangebyscore(
+            self.in_flight_key, '-inf', now - self.in_flight_timeout)
+        for patient_id in patient_ids:
+            pipe.zadd(self.in_flight_key, {patient_id: now}, nx=True)
+        pipe.expire(self.in_flight_key, self.in_flight_timeout)
+        added = pipe.execute()[1:-1]
+        return [p for p, new in zip(patient_ids, added) if new]
+
+    def release(self, patient_ids, claimed_at=None):
+        """Clear patients from the in flight set, once complete
+
+        :param claimed_at: claim time of the batch, as passed to
+          ``claim()``; when given, only claims still held from that time
+          are released, leaving any since taken by another run
+
+        """
+        if not patient_ids:
+            return
+        if claimed_at is None:
+            self.redis.zrem(self.in_flight_key, *patient_ids)
+            return
+        self.redis.eval(
+            RELEASE_SCRIPT, 1, self.in_flight_key, repr(claimed_at),
+            *patient_ids)
+
+    def in_flight(self):
+        """Returns set of patient ids currently in flight"""
+        return {int(p) for p in self.redis.zrangebyscore(
+            self.in_flight_key, time.time() - self.in_flight_timeout,
+            '+inf')}
+
+    @property
+    def progress_key(self):
+        return PROGRESS_KEY.format(run_id=self.run_id)
+
+    def start_run(self):
+        """Begin a new run, with its own progress counters
+
+        :returns: the new run id, for batches to record progress against
+
+        """
+        self.run_id = uuid4().hex
+        pipe = self.redis.pipeline()
+        pipe.hset(
+            self.progress_key, 'started', datetime.utcnow().isoformat())
+        pipe.expire(self.progress_key, self.in_flight_timeout)
+        pipe.execute()
+        return self.run_id
+
+    def record_progress(self, **counts):
+        """Increment named progress counters, i.e. queued=16
+
+        No-op without a run id, such as for batches queued prior to
+        progress being tracked per run.
+
+        """
+        if self.run_id is None:
+            return
+        pipe = self.redis.pipeline()
+        for name, count in counts.items():
+            pipe.hincrby(self.progress_key, name, count)
+        pipe.execute()
+
+    def progress(self):
+        """Returns dictionary of progress counters for this run"""
+        if self.run_id is None:
+            return {}
+        return {
+            k.decode('utf-8'): v.decode('utf-8') for k, v in
+            self.redis.hgetall(self.progress_key).items()}
+
+    def batches(self, page_size=1000):
+        """Generator yielding (patient_ids, claimed_at) of claimed batches
+
+        Patients with a QB transition due within
+        ``UPDATE_PATIENT_PRIORITY_WINDOW`` hours are streamed first.
+        Patients in flight from an overlapping run are skipped.  The
+        claim time is to be passed along to ``release()``.
+
+        """
+        priority = priority_patient_ids(within=timedelta(
+            hours=current_app.config['UPDATE_PATIENT_PRIORITY_WINDOW']))
+        size = self.batch_size()
+        pending = []
+        for patient_id in stream_patient_ids(page_size, priority):
+            pending.append(patient_id)
+            if len(pending) < size:
+                continue
+            claimed_at = time.time()
+            claimed = self.claim(pending, now=claimed_at)
+            self.record_progress(skipped=len(pending) - len(claimed))
+            pending = []
+            if claimed:
+                yield claimed, claimed_at
+
+        claimed_at = time.time()
+        claimed = self.claim(pending, now=claimed_at)
+        self.record_progress(skipped=len(pending) - len(claimed))
+        if claimed:
+            yield claimed, claimed_at
+
+
+class timed_batch(object):
+    """Context manager to release and record cost of a batch on exit
+
+    :param patient_ids: the batch
+    :param run_id: run the batch belongs to, for progress tracking
+    :param kind: kind of update, from ``job_kind()``
+    :param claimed_at: claim time of the batch; the claims are only
+      released when given, otherwise they lapse, as for batches queued
+      prior to claims being tracked by time
+
+    """
+
+    def __init__(
+            self, patient_ids, run_id=None, kind=job_kind(True, True),
+            claimed_at=None):
+        self.patient_ids = patient_ids
+        self.claimed_at = claimed_at
+        self.scheduler = PatientBatchScheduler(run_id=run_id, kind=kind)
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.claimed_at is not None:
+            self.scheduler.release(
+                self.patient_ids, claimed_at=self.claimed_at)
+        if exc_type is None:
+            self.scheduler.record_cost(
+                len(self.patient_ids), time.time() - self.start)
+            self.scheduler.record_progress(completed=len(self.patient_ids))
+        else:
+            self.scheduler.record_progress(failed=len(self.patient_ids))
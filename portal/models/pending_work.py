@@ -0,0 +1,225 @@
+"""Pending work summary, for fast lookup of a patient's outstanding work
+
+Determining the instruments a patient needs to complete requires a
+``QB_Status``, which syncs the timeline and queries the patient's
+QuestionnaireResponses, including a lookup per in-progress instrument
+for its resume identifier.  The results are summarized in a single row
+per (user, research study), so frequent callers such as
+``/api/present-needed`` needn't repeat the work.
+
+A summary is replaced when the timeline is rebuilt, and deleted on any
+write to the user's QuestionnaireResponses or consents, or invalidation
+of their timeline, to be recomputed on next lookup.  As status also
+changes with time, each summary is only valid until the user's next
+timeline transition (such as a questionnaire bank coming due or
+expiring).
+
+A lookup may race a write, computing its summary before the write
+commits, to store it after the write deleted the previous summary.  Each
+deletion therefore advances the user's ``PendingWorkGeneration``; a
+summary is only stored if the generation is unchanged since the lookup
+began.
+
+NB - summaries reflect status as of now; lookups for other points in
+time are computed from a ``QB_Status`` and not persisted.
+
+"""
+from datetime import datetime
+
+from sqlalchemy import UniqueConstraint, event, literal, select
+from sqlalchemy.dialects.postgresql import JSONB, insert
+
+from ..database import db
+from .overall_status import OverallStatus
+from .qb_status import qb_status
+from .qb_timeline import QBT
+from .questionnaire_response import QuestionnaireResponse
+from .user import User
+from .user_consent import UserConsent
+
+
+class PendingWork(db.Model):
+    """Summary of a user's outstanding work in a research study"""
+    __tablename__ = 'pending_work'
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.ForeignKey(
+        'users.id', ondelete='cascade'), nullable=False)
+    research_study_id = db.Column(db.ForeignKey(
+        'research_studies.id', ondelete='cascade'), nullable=False)
+    withdrawn = db.Column(db.Boolean, nullable=False, default=False)
+    needed = db.Column(
+        JSONB, nullable=False, default=[],
+        doc="ordered list of instruments needing full assessment")
+    resume_identifiers = db.Column(
+        JSONB, nullable=False, default=[],
+        doc="document identifiers of instruments in progress")
+    valid_until = db.Column(
+        db.DateTime, nullable=True,
+        doc="time of user's next timeline transition; null if none")
+
+    __table_args__ = (UniqueConstraint(
+        'user_id', 'research_study_id', name='_pending_work_user_study'),)
+
+    def __str__(self):
+        return "PendingWork for user {} on research study {}".format(
+            self.user_id, self.research_study_id)
+
+    @property
+    def ready(self):
+        """True if the user has work they can immediately do"""
+        return bool(self.needed or self.resume_identifiers)
+
+    def is_current(self, as_of_date):
+        return self.valid_until is None or as_of_date < self.valid_until
+
+
+class PendingWorkGeneration(db.Model):
+    """Count of deletions of a user's pending work, to detect races"""
+    __tablename__ = 'pending_work_generations'
+    user_id = db.Column(db.ForeignKey(
+        'users.id', ondelete='cascade'), primary_key=True)
+    generation = db.Column(db.Integer, nullable=False, default=0)
+
+
+def current_generation(user_id, lock=False):
+    """Return the user's pending work generation
+
+    :param lock: set to lock the generation against change until commit,
+      waiting out any write in progress
+
+    """
+    # insert if missing; waits on a concurrent write inserting the same
+    db.session.execute(insert(PendingWorkGeneration).values(
+        user_id=user_id, generation=0).on_conflict_do_nothing())
+    query = PendingWorkGeneration.query.filter(
+        PendingWorkGeneration.user_id == user_id).with_entities(
+        PendingWorkGeneration.generation)
+    if lock:
+        query = query.with_for_update(read=True)
+    return query.scalar()
+
+
+def summarize(user, research_study_id, as_of_date=None):
+    """Compute pending work values from the user's QB_Status
+
+    :returns: dictionary of ``PendingWork`` column values
+    """
+    status = qb_status(
+        user, research_study_id=research_study_id, as_of_date=as_of_date)
+    next_transition = QBT.query.filter(QBT.user_id == user.id).filter(
+        QBT.research_study_id == research_study_id).filter(
+        QBT.at > status.as_of_date).with_entities(
+        db.func.min(QBT.at)).scalar()
+    values = {
+        'user_id': user.id,
+        'research_study_id': research_study_id,
+        'withdrawn': status.overall_status == OverallStatus.withdrawn,
+        'needed': [],
+        'resume_identifiers': [],
+        'valid_until': next_transition,
+    }
+    if not values['withdrawn']:
+        values['needed'] = status.instruments_needing_full_assessment(
+            classification='all')
+        values['resume_identifiers'] = status.instruments_in_progress(
+            classification='all')
+    return values
+
+
+def refresh_pending_work(user, research_study_id):
+    """Compute and persist the user's pending work for the research study
+
+    Should a write invalidate the user's pending work while computing,
+    the summary isn't persisted, leaving the next lookup to recompute.
+
+    :returns: the up to date ``PendingWork``, transient if not persisted
+    """
+    generation = current_generation(user.id)
+    db.session.commit()
+    values = summarize(user, research_study_id)
+    if current_generation(user.id, lock=True) == generation:
+        columns = dict(values)
+        del columns['user_id'], columns['research_study_id']
+        # upsert, as concurrent lookups may race to refresh the same row
+        db.session.execute(
+            insert(PendingWork).values(**values).on_conflict_do_update(
+                constraint='_pending_work_user_study', set_=columns))
+    db.session.commit()
+    work = PendingWork.query.filter(PendingWork.user_id == user.id).filter(
+        PendingWork.research_study_id == research_study_id).first()
+    return work or PendingWork(**values)
+
+
+def pending_work(user, research_study_id, as_of_date=None):
+    """Return the user's pending work for the research study
+
+    :param user: subject of lookup
+    :param research_study_id: research study of interest
+    :param as_of_date: point in time of interest, defaults to now, the
+      only point in time for which the summary is persisted
+    :returns: ``PendingWork``, computed as needed.  Instances for points
+      in time other than now are transient.
+
+    """
+    if as_of_date is not None:
+        return PendingWork(**summarize(user, research_study_id, as_of_date))
+
+    work = PendingWork.query.filter(PendingWork.user_id == user.id).filter(
+        PendingWork.research_study_id == research_study_id).first()
+    if work and work.is_current(datetime.utcnow()):
+        return work
+    return refresh_pending_work(user, research_study_id)
+
+
+def forget_pending_work(user_id, research_study_id='all'):
+    """Delete the user's pending work, for recomputation on next lookup
+
+    :param research_study_id: limit to the given study, or the default
+      'all' to delete for every study
+
+    """
+    _delete_pending_work(
+        db.session, [user_id], research_study_id=research_study_id)
+
+
+def forget_users_pending_work(user_ids):
+    """Bulk form of ``forget_pending_work()``, for every study
+
+    :param user_ids: list or query of user ids
+
+    """
+    _delete_pending_work(db.session, user_ids)
+
+
+def _delete_pending_work(executor, user_ids, research_study_id='all'):
+    """Advance the users' generations and delete their pending work
+
+    :param executor: the session, or within a flush, its connection
+
+    """
+    generations = PendingWorkGeneration.__table__
+    executor.execute(insert(generations).from_select(
+        ['user_id', 'generation'],
+        select([User.id, literal(1)]).where(User.id.in_(user_ids))
+    ).on_conflict_do_update(
+        index_elements=[generations.c.user_id],
+        set_={'generation': generations.c.generation + 1}))
+
+    delete = PendingWork.__table__.delete().where(
+        PendingWork.user_id.in_(user_ids))
+    if research_study_id != 'all':
+        delete = delete.where(
+            PendingWork.research_study_id == research_study_id)
+    executor.execute(delete)
+
+
+@event.listens_for(QuestionnaireResponse, 'after_insert')
+@event.listens_for(QuestionnaireResponse, 'after_update')
+def _qnr_written(mapper, connection, target):
+    _delete_pending_work(connection, [target.subject_id])
+
+
+@event.listens_for(UserConsent, 'after_insert')
+@event.listens_for(UserConsent, 'after_update')
+def _consent_written(mapper, connection, target):
+    _delete_pending_work(connection, [target.user_id])
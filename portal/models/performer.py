@@ -48,20 +48,26 @@ class Performer(db.Model):
         return self.reference_txt
 
     @classmethod
-    def from_fhir(cls, fhir):
+    def from_fhir(cls, fhir, in_batch=False):
         """Return performer instance from JSON FHIR formatted string
 
         See note in `as_fhir`, the format of a performer depends on
         context.  Populate `self.codeable_concept` only if it's included
         as a *role*.
 
+        :param in_batch: set when adding as part of a larger transaction,
+          to resolve any role without committing
+
         :returns: new performer instance from values in given *fhir*
 
         """
         instance = cls()
         if 'actor' in fhir:
             instance.reference_txt = json.dumps(fhir['actor'])
-            if 'role' in fhir:
+            if 'role' in fhir and in_batch:
+                instance.codeable_concept = CodeableConcept.resolve(
+                    fhir['role'])
+            elif 'role' in fhir:
                 cc = CodeableConcept.from_fhir(fhir['role'])
                 instance.codeable_concept = cc.add_if_not_found()
         else:
@@ -0,0 +1,247 @@
+"""Post submission pipeline for QuestionnaireResponses
+
+Once a QuestionnaireResponse is persisted, the remaining work runs
+through the stages of this pipeline, inline unless
+``POST_SUBMISSION_ASYNC`` is enabled, in which case a celery worker
+must consume the ``post_submission`` queue:
+
+ - qb_assignment: associate the QNR with its questionnaire bank
+ - timeline: rebuild the subject's QB timeline for assigned studies
+ - observations: queues ``extract_observations_task`` for SDC
+   extraction and, from the extracted Observations, EMPRO trigger
+   evaluation
+
+Each submission bumps the subject's version counter; the pipeline marks
+the version processed once the timeline is rebuilt.  Views presenting
+state derived from submissions, such as ``/api/present-needed``, wait
+briefly for outstanding versions via ``await_submissions()``, for
+read-your-writes behavior.
+
+"""
+import time
+
+from flask import current_app
+import redis
+
+from ..database import db
+from ..stage_timing import stage_timer
+
+SUBMITTED_KEY = 'post_submission::{user_id}::submitted'
+PROCESSED_KEY = 'post_submission::{user_id}::processed'
+
+# Only ever advance the processed version; pipelines may finish out of order
+MARK_PROCESSED_SCRIPT = """
+local current = tonumber(redis.call('get', KEYS[1]) or 0)
+if current < tonumber(ARGV[1]) then
+    redis.call('set', KEYS[1], ARGV[1], 'EX', ARGV[2])
+end
+"""
+
+
+class SubmissionVersion(object):
+    """Per user counters of submitted and processed QNR versions"""
+
+    def __init__(self, user_id):
+        self.user_id = user_id
+        self.redis = redis.StrictRedis.from_url(
+            current_app.config['REDIS_URL'])
+        self.ttl = current_app.config['POST_SUBMISSION_VERSION_TTL']
+        self.submitted_key = SUBMITTED_KEY.format(user_id=user_id)
+        self.processed_key = PROCESSED_KEY.format(user_id=user_id)
+
+    def submit(self):
+        """Increment and return the user's submitted version"""
+        pipe = self.redis.pipeline()
+        pipe.incr(self.submitted_key)
+        pipe.expire(self.submitted_key, self.ttl)
+        return pipe.execute()[0]
+
+    def mark_processed(self, version):
+        """Record all submissions up to and including version processed"""
+        self.redis.eval(
+            MARK_PROCESSED_SCRIPT, 1, self.processed_key, version, self.ttl)
+
+    def versions(self):
+        """Return tuple (submitted, processed) versions"""
+        submitted, processed = self.redis.mget(
+            self.submitted_key, self.processed_key)
+        return int(submitted or 0), int(processed or 0)
+
+    def wait(self, version=None, timeout=None, interval=0.1):
+        """Wait for processing to catch up to version
+
+        :param version: version to wait on, defaults to latest submitted
+        :param timeout: seconds to wait, defaults to configured
+          ``POST_SUBMISSION_WAIT_SECONDS``
+        :returns: True if processed, False on timeout
+
+        """
+        if timeout is None:
+            timeout = current_app.config['POST_SUBMISSION_WAIT_SECONDS']
+        deadline = time.monotonic() + timeout
+        while True:
+            submitted, processed = self.versions()
+            if processed >= (version or submitted):
+                return True
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(interval)
+
+
+def needs_observations(qnr):
+    """Determine if the QNR is scored via SDC extraction"""
+    # TODO: only extract QuestionnaireResponses where the corresponding
+    #  Questionnaire has the SDC extension
+    qn_name = qnr.document.get("questionnaire", {}).get(
+        "reference", '').split('/')[-1]
+    return qn_name == 'ironman_ss' and qnr.status == 'completed'
+
+
+def rebuild_timeline(user_id):
+    """Replace the user's QB timeline for each assigned research study
+
+    Builds the rows, and the pending work summary from them, now, so the
+    next status lookup needn't.  Only patients have a timeline; for
+    others, any rows are invalidated.
+
+    """
+    from .pending_work import refresh_pending_work
+    from .qb_timeline import invalidate_users_QBT, update_users_QBT
+    from .research_study import ResearchStudy
+    from .role import ROLE
+    from .user import User
+
+    invalidate_users_QBT(user_id, research_study_id='all')
+    user = User.query.get(user_id)
+    if not user.has_role(ROLE.PATIENT.value):
+        return
+
+    for research_study_id in ResearchStudy.assigned_to(user):
+        update_users_QBT(user_id, research_study_id=research_study_id)
+        refresh_pending_work(user, research_study_id=research_study_id)
+
+
+def process_submissions(
+        questionnaire_response_ids, acting_user_id, version, as_task=True):
+    """Run the post submission pipeline for the given QNRs
+
+    Each QNR is assigned its questionnaire bank, then the subject's
+    timeline is rebuilt just once for the lot, and observation extraction
+    queued for those scored via SDC.
+
+    :param questionnaire_response_ids: the persisted QNRs, all for the
+      same subject
+    :param acting_user_id: user submitting the QNRs, for audit purposes
+    :param version: subject's submission version to mark processed once
+      the timeline stage completes, regardless of outcome, as waiting
+      readers can't wait forever.  Extraction isn't waited on.
+    :param as_task: set when running in a celery worker, to rebuild the
+      timeline inline.  Otherwise, as a request is waiting, the timeline
+      is only invalidated for a lazy rebuild.
+
+    """
+    from .qb_timeline import invalidate_users_QBT
+    from .questionnaire_response import QuestionnaireResponse
+    from ..tasks import extract_observations_task
+
+    qnrs = QuestionnaireResponse.query.filter(
+        QuestionnaireResponse.id.in_(questionnaire_response_ids)).order_by(
+        QuestionnaireResponse.authored).all()
+    subject_ids = {qnr.subject_id for qnr in qnrs}
+    if len(subject_ids) != 1:
+        raise ValueError(
+            "submissions must belong to a single subject, found {}".format(
+                subject_ids))
+    subject_id = subject_ids.pop()
+    try:
+        with stage_timer('post_submission', 'qb_assignment'):
+            for qnr in qnrs:
+                qnr.assign_qb_relationship(acting_user_id=acting_user_id)
+            db.session.commit()
+
+        with stage_timer('post_submission', 'timeline'):
+            if as_task:
+                rebuild_timeline(subject_id)
+            else:
+                invalidate_users_QBT(subject_id, research_study_id='all')
+    except Exception:
+        # fall back to a lazy timeline rebuild on next lookup
+        db.session.rollback()
+        invalidate_users_QBT(subject_id, research_study_id='all')
+        raise
+    finally:
+        SubmissionVersion(subject_id).mark_processed(version)
+
+    # extraction failures needn't invalidate the rebuilt timeline
+    with stage_timer('post_submission', 'observations'):
+        for qnr in qnrs:
+            if needs_observations(qnr):
+                extract_observations_task.apply_async(
+                    kwargs={'questionnaire_response_id': qnr.id})
+
+
+def submit_for_processing(qnr, acting_user_id):
+    """Queue the post submission pipeline for the persisted QNR
+
+    Runs inline when ``POST_SUBMISSION_ASYNC`` is disabled.
+
+    :returns: the subject's submission version, for clients to pass
+      along when reading state dependent on the submission
+
+    """
+    return submit_batch_for_processing(
+        qnrs=[qnr], acting_user_id=acting_user_id)[qnr.subject_id]
+
+
+def submit_batch_for_processing(qnrs, acting_user_id):
+    """Queue the post submission pipeline for a batch of persisted QNRs
+
+    The pipeline runs once per subject, covering all of the subject's
+    QNRs in the batch.
+
+    :returns: dictionary keyed by subject id, of each subject's
+      submission version
+
+    """
+    by_subject = {}
+    for qnr in qnrs:
+        by_subject.setdefault(qnr.subject_id, []).append(qnr.id)
+
+    versions = {}
+    for subject_id, qnr_ids in by_subject.items():
+        versions[subject_id] = SubmissionVersion(subject_id).submit()
+        kwargs = {
+            'questionnaire_response_ids': qnr_ids,
+            'acting_user_id': acting_user_id,
+            'version': versions[subject_id]}
+        if current_app.config['POST_SUBMISSION_ASYNC']:
+            from ..tasks import post_submission_task
+            post_submission_task.apply_async(kwargs=kwargs)
+        else:
+            process_submissions(as_task=False, **kwargs)
+    return versions
+
+
+def await_submissions(user_id, version=None):
+    """Wait briefly for the user's submissions to be processed
+
+    Should the pipeline not finish in time, the user's timeline is
+    invalidated, so status lookups rebuild from current data, and the
+    version is marked processed, so subsequent readers needn't wait on
+    a lost or failed pipeline.
+
+    :param version: submission version to wait on, defaults to latest
+    :returns: True if processing completed, False otherwise
+
+    """
+    from .qb_timeline import invalidate_users_QBT
+
+    submission_version = SubmissionVersion(user_id)
+    if submission_version.wait(version=version):
+        return True
+    current_app.logger.warning(
+        "post submission pipeline for user %d still pending", user_id)
+    invalidate_users_QBT(user_id, research_study_id='all')
+    submission_version.mark_processed(
+        version or submission_version.versions()[0])
+    return False
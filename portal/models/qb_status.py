@@ -3,14 +3,22 @@
 API to lookup user's status with respect to assigned questionnaire banks.
 
 """
+from datetime import datetime
+from time import time
+
+from flask import current_app, g, has_app_context
+from sqlalchemy import event
+
 from ..trace import trace
 from .overall_status import OverallStatus
 from .qb_timeline import QBT, ordered_qbs, update_users_QBT
 from .questionnaire_response import (
     QNR_indef_results,
     QNR_results,
+    QuestionnaireResponse,
     qnr_document_id,
 )
+from .user_consent import UserConsent
 
 
 class NoCurrentQB(Exception):
@@ -483,15 +491,70 @@ class QB_Status(object):
         query = QuestionnaireResponse.query.filter(
             QuestionnaireResponse.subject_id == self.user.id).filter(
             QuestionnaireResponse.status == 'completed').filter(
-            QuestionnaireResponse.document[
-                ('questionnaire', 'reference')].astext.endswith(
-                requested_indef)).count()
+            QuestionnaireResponse.instrument_id == requested_indef).count()
         if query != 0:
             current_app.logger.error(
                 f"Caught TN-2747 in action!  User {self.user.id} completed"
                 f" {requested_indef} already!")
 
 
+def qb_status(user, research_study_id, as_of_date=None):
+    """Return the shared QB_Status for the current request or task
+
+    Building a QB_Status syncs the timeline and runs a number of queries,
+    so instances are kept for the life of the app context (a request or
+    celery task) and shared by all callers with matching parameters.
+    Without an ``as_of_date``, the current time is used, and instances
+    are shared through each ``QB_STATUS_NOW_BUCKET_SECONDS`` interval.
+
+    Instances for a user are discarded on write of one of their
+    QuestionnaireResponses or consents, or invalidation of their
+    timeline.
+
+    """
+    if not has_app_context():
+        return QB_Status(
+            user, research_study_id, as_of_date or datetime.utcnow())
+
+    if as_of_date is None:
+        bucket_seconds = current_app.config['QB_STATUS_NOW_BUCKET_SECONDS']
+        if not bucket_seconds:
+            return QB_Status(user, research_study_id, datetime.utcnow())
+        as_of_key = ('now', int(time() // bucket_seconds))
+    else:
+        as_of_key = as_of_date
+
+    registry = g.setdefault('qb_status_registry', {})
+    key = (user.id, research_study_id, as_of_key)
+    if key not in registry:
+        registry[key] = QB_Status(
+            user, research_study_id, as_of_date or datetime.utcnow())
+    return registry[key]
+
+
+def forget_qb_status(user_id):
+    """Discard any shared QB_Status instances for the given user"""
+    if not has_app_context():
+        return
+    registry = g.get('qb_status_registry')
+    if not registry:
+        return
+    for key in [k for k in registry if k[0] == user_id]:
+        del registry[key]
+
+
+@event.listens_for(QuestionnaireResponse, 'after_insert')
+@event.listens_for(QuestionnaireResponse, 'after_update')
+def _qnr_written(mapper, connection, target):
+    forget_qb_status(target.subject_id)
+
+
+@event.listens_for(UserConsent, 'after_insert')
+@event.listens_for(UserConsent, 'after_update')
+def _consent_written(mapper, connection, target):
+    forget_qb_status(target.user_id)
+
+
 def patient_research_study_status(patient, ignore_QB_status=False):
     """Returns details regarding patient readiness for available studies
 
@@ -514,9 +577,8 @@ def patient_research_study_status(patient, ignore_QB_status=False):
          "ready"
 
     """
-    from datetime import datetime
+    from .pending_work import pending_work
     from .research_study import EMPRO_RS_ID, ResearchStudy
-    as_of_date = datetime.utcnow()
 
     results = {}
     # check studies in required order - first found with pending work
@@ -538,18 +600,12 @@ def patient_research_study_status(patient, ignore_QB_status=False):
             # Bootstrap issues, can't yet check QB_Status.
             continue
 
-        assessment_status = QB_Status(
-            patient, research_study_id=rs, as_of_date=as_of_date)
-        if assessment_status.overall_status == OverallStatus.withdrawn:
+        work = pending_work(patient, research_study_id=rs)
+        if work.withdrawn:
             rs_status['errors'].append('Withdrawn')
             continue
 
-        needing_full = assessment_status.instruments_needing_full_assessment(
-            classification='all')
-        resume_ids = assessment_status.instruments_in_progress(
-            classification='all')
-
-        if needing_full or resume_ids:
+        if work.ready:
             # work to be done in this study
             rs_status['ready'] = True
 
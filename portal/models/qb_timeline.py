@@ -741,6 +741,11 @@ def invalidate_users_QBT(user_id, research_study_id):
       use string 'all' to invalidate all QBT rows for a user
 
     """
+    from .pending_work import forget_pending_work
+    from .qb_status import forget_qb_status
+    forget_qb_status(user_id)
+    forget_pending_work(user_id, research_study_id=research_study_id)
+
     if research_study_id == 'all':
         QBT.query.filter(QBT.user_id == user_id).delete()
     else:
@@ -846,6 +851,7 @@ def update_users_QBT(user_id, research_study_id, invalidate_existing=False):
     """
     def attempt_update(user_id, research_study_id, invalidate_existing):
         """Updates user's QBT or raises if lock is unattainable"""
+        from .pending_work import forget_pending_work
         from .qb_status import patient_research_study_status
 
         # acquire a multiprocessing lock to prevent multiple requests
@@ -858,6 +864,8 @@ def update_users_QBT(user_id, research_study_id, invalidate_existing=False):
             if invalidate_existing:
                 QBT.query.filter(QBT.user_id == user_id).filter(
                     QBT.research_study_id == research_study_id).delete()
+                forget_pending_work(
+                    user_id, research_study_id=research_study_id)
 
             # if any rows are found, assume this user/study is current
             if QBT.query.filter(QBT.user_id == user_id).filter(
@@ -42,6 +42,12 @@ class Questionnaire(db.Model):
     @classmethod
     def find_by_name(cls, name):
         """Shortcut to fetch by named identifier with common system"""
+        from .reference_data import lookup_by_name
+
+        found = lookup_by_name(cls, name)
+        if found:
+            return found
+
         identifier = Identifier(
             _value=name,
             system=TRUENTH_QUESTIONNAIRE_CODE_SYSTEM,
@@ -153,8 +159,7 @@ class Questionnaire(db.Model):
         """Map of Questionnaire codes to corresponding option text"""
 
         code_text_map = {}
-        questionnaire_fhir = self.as_fhir()
-        for question in questionnaire_fhir.get('item', ()):
+        for question in self.item or ():
             for option in question.get('option', ()):
                 if 'valueCoding' not in option:
                     continue
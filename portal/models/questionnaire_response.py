@@ -1,16 +1,17 @@
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+import binascii
 from collections import namedtuple
-import copy
 from datetime import datetime
 from dateutil.relativedelta import relativedelta
 from html.parser import HTMLParser
 import json
 
 from flask import current_app, has_request_context, url_for
-from flask_swagger import swagger
-import jsonschema
-from sqlalchemy import or_
+from sqlalchemy import tuple_
 from sqlalchemy.dialects.postgresql import ENUM, JSONB
+from sqlalchemy.orm import validates
 
+from ..api_spec import validate
 from ..database import db
 from ..date_tools import FHIR_datetime
 from ..system_uri import (
@@ -32,6 +33,7 @@ from .questionnaire_bank import (
 )
 from .research_study import research_study_id_from_questionnaire
 from .reference import Reference
+from .reference_data import ReferenceData
 from .user import User, current_user, patients_query
 from .user_consent import consent_withdrawal_dates
 
@@ -41,6 +43,13 @@ class NoFutureDates(ValueError):
     pass
 
 
+def instrument_id_from_reference(reference):
+    """Extract the instrument (Questionnaire name) from its reference"""
+    if not reference:
+        return None
+    return reference.split('/')[-1]
+
+
 class QuestionnaireResponse(db.Model):
 
     def default_status(context):
@@ -70,6 +79,39 @@ class QuestionnaireResponse(db.Model):
         ),
         default=default_status
     )
+    # Maintained from document on assignment, see ``_derive_columns()``
+    instrument_id = db.Column(db.Text)
+    authored = db.Column(db.DateTime)
+    # Time of last write, for incremental readers; see ``paged_responses()``
+    updated = db.Column(
+        db.DateTime, nullable=False, default=datetime.utcnow,
+        onupdate=datetime.utcnow)
+
+    __table_args__ = (
+        db.Index(
+            'ix_questionnaire_responses_subject_authored',
+            'subject_id', 'authored'),
+        db.Index(
+            'ix_questionnaire_responses_instrument_authored',
+            'instrument_id', 'authored'),
+        db.Index(
+            'ix_questionnaire_responses_updated_id', 'updated', 'id'),
+    )
+
+    @validates('document')
+    def _derive_columns(self, key, document):
+        """Keep columns derived from the document in sync on assignment
+
+        NB - as with all JSONB use, in place changes to ``document``
+        aren't detected; assign a modified copy.
+
+        """
+        data = document or {}
+        self.instrument_id = instrument_id_from_reference(
+            data.get('questionnaire', {}).get('reference'))
+        self.authored = FHIR_datetime.parse(
+            data.get('authored'), error_subject='authored', none_safe=True)
+        return document
 
     @property
     def qb_id(self):
@@ -99,9 +141,8 @@ class QuestionnaireResponse(db.Model):
           Takes ``as_of_date`` and ``classification`` parameters
 
         """
-        authored = FHIR_datetime.parse(self.document['authored'])
-        qn_ref = self.document.get("questionnaire").get("reference")
-        qn_name = qn_ref.split("/")[-1] if qn_ref else None
+        authored = self.authored
+        qn_name = self.instrument_id
         qn = Questionnaire.find_by_name(name=qn_name)
 
         if qn_name == 'ironman_ss_post_tx':
@@ -109,14 +150,14 @@ class QuestionnaireResponse(db.Model):
             from ..trigger_states.empro_states import empro_staff_qbd_accessor
             qbd_accessor = empro_staff_qbd_accessor(self)
         elif qbd_accessor is None:
-            from .qb_status import QB_Status  # avoid cycle
+            from .qb_status import qb_status  # avoid cycle
             if self.questionnaire_bank is not None:
                 research_study_id = self.questionnaire_bank.research_study_id
             else:
                 research_study_id = research_study_id_from_questionnaire(
                     qn_name)
 
-            qbstatus = QB_Status(
+            qbstatus = qb_status(
                 self.subject,
                 research_study_id=research_study_id,
                 as_of_date=authored)
@@ -279,42 +320,45 @@ class QuestionnaireResponse(db.Model):
     @staticmethod
     def validate_document(document):
         """Validate given JSON document against our swagger schema"""
-        swag = swagger(current_app)
-
-        draft4_schema = {
-            '$schema': 'http://json-schema.org/draft-04/schema#',
-            'type': 'object',
-            'definitions': swag['definitions'],
-        }
-
-        validation_schema = 'QuestionnaireResponse'
-        # Copy desired schema (to validate against) to outermost dict
-        draft4_schema.update(swag['definitions'][validation_schema])
-        jsonschema.validate(document, draft4_schema)
+        validate(document, 'QuestionnaireResponse')
 
     @property
     def document_answered(self):
         """ Return a modified copy of self.document including answer text
 
         QuestionnaireResponse populated with text answers based on codes
-        in valueCoding.  This always returns a *copy* of the document so
-        any local or subsequent mutations aren't persisted or found in db
-        session cached objects.
+        in valueCoding.  The returned document is a new structure down to
+        the modified answers; unmodified branches are shared with
+        self.document and must not be mutated in place, lest changes be
+        persisted or found in db session cached objects.
 
         """
         instrument_id = self.document['questionnaire']['reference'].split(
             '/')[-1]
-        questionnaire = Questionnaire.find_by_name(name=instrument_id)
-        document = copy.deepcopy(self.document)
-
-        # return copy of original document if no reference Questionnaire
-        # available
-        if not questionnaire:
+        questionnaire_map = ReferenceData.current().questionnaire_code_map(
+            instrument_id)
+        document = dict(self.document)
+        if 'group' not in document:
             return document
 
-        questionnaire_map = questionnaire.questionnaire_code_map()
-
-        for question in document.get('group', {}).get('question', ()):
+        def extension_as_list(answer):
+            """Extensions should be a list, correct if need be"""
+            # todo: migrate towards FHIR spec in persisted data
+            extension = answer.get('valueCoding', {}).get('extension')
+            if extension is None or isinstance(extension, (tuple, list)):
+                return answer
+            return dict(answer, valueCoding=dict(
+                answer['valueCoding'], extension=[extension]))
+
+        questions = []
+        for question in document['group'].get('question', ()):
+            # without a reference Questionnaire, answers are as submitted
+            # but for the extension correction
+            if questionnaire_map is None:
+                questions.append(dict(question, answer=[
+                    extension_as_list(answer)
+                    for answer in question.get('answer', ())]))
+                continue
 
             combined_answers = consolidate_answer_pairs(question['answer'])
 
@@ -333,9 +377,10 @@ class QuestionnaireResponse(db.Model):
 
                     text_and_coded_answers.append({'valueString': text_answer})
 
-                text_and_coded_answers.append(answer)
-            question['answer'] = text_and_coded_answers
+                text_and_coded_answers.append(extension_as_list(answer))
+            questions.append(dict(question, answer=text_and_coded_answers))
 
+        document['group'] = dict(document['group'], question=questions)
         return document
 
     def extensions(self):
@@ -426,11 +471,10 @@ class QNR_results(object):
             QuestionnaireResponse.questionnaire_bank_id,
             QuestionnaireResponse.qb_iteration,
             QuestionnaireResponse.status,
-            QuestionnaireResponse.document[
-                ('questionnaire', 'reference')].label('instrument_id'),
-            QuestionnaireResponse.document['authored'].label('authored'),
+            QuestionnaireResponse.instrument_id,
+            QuestionnaireResponse.authored,
             QuestionnaireResponse.encounter_id).order_by(
-            QuestionnaireResponse.document['authored'])
+            QuestionnaireResponse.authored)
         if self.qb_ids:
             query = query.filter(
                 QuestionnaireResponse.questionnaire_bank_id.in_(self.qb_ids))
@@ -438,33 +482,20 @@ class QNR_results(object):
                 query = query.filter(
                     QuestionnaireResponse.qb_iteration == self.qb_iteration)
         self._qnrs = []
-        prev_auth = None
         for qnr in query:
             # Cheaper to toss those from the wrong research study now
-            instrument = qnr.instrument_id.split('/')[-1]
             research_study_id = research_study_id_from_questionnaire(
-                instrument)
+                qnr.instrument_id)
             if research_study_id != self.research_study_id:
                 continue
 
-            # confirm a timezone extension in authored didn't foil the sort
-            auth_datetime = FHIR_datetime.parse(qnr.authored)
-            if prev_auth and prev_auth > auth_datetime:
-                message = (
-                    "String sort order for"
-                    " `questionnaire_response.document['authored']`"
-                    " differs from datetime sort.  Review authored values"
-                    f" for user {self.user.id}")
-                current_app.logger.error(message)
-            prev_auth = auth_datetime
-
             self._qnrs.append(QNR(
                 qnr_id=qnr.id,
                 qb_id=qnr.questionnaire_bank_id,
                 iteration=qnr.qb_iteration,
                 status=qnr.status,
-                instrument=instrument,
-                authored=auth_datetime,
+                instrument=qnr.instrument_id,
+                authored=qnr.authored,
                 encounter_id=qnr.encounter_id))
         return self._qnrs
 
@@ -693,11 +724,10 @@ class QNR_indef_results(QNR_results):
             QuestionnaireResponse.questionnaire_bank_id,
             QuestionnaireResponse.qb_iteration,
             QuestionnaireResponse.status,
-            QuestionnaireResponse.document[
-                ('questionnaire', 'reference')].label('instrument_id'),
-            QuestionnaireResponse.document['authored'].label('authored'),
+            QuestionnaireResponse.instrument_id,
+            QuestionnaireResponse.authored,
             QuestionnaireResponse.encounter_id).order_by(
-            QuestionnaireResponse.document['authored'])
+            QuestionnaireResponse.authored)
 
         self._qnrs = []
         for qnr in query:
@@ -706,8 +736,8 @@ class QNR_indef_results(QNR_results):
                 qb_id=qnr.questionnaire_bank_id,
                 iteration=qnr.qb_iteration,
                 status=qnr.status,
-                instrument=qnr.instrument_id.split('/')[-1],
-                authored=FHIR_datetime.parse(qnr.authored),
+                instrument=qnr.instrument_id,
+                authored=qnr.authored,
                 encounter_id=qnr.encounter_id))
 
     def completed_qs(self, qb_id, iteration):
@@ -742,6 +772,59 @@ class QNR_indef_results(QNR_results):
         return [q.name for q in qb.questionnaires]
 
 
+def annotated_response(
+        questionnaire_response, research_study_id, patch_dstu2=False):
+    """Return the QNR document annotated for bulk export
+
+    Adds answer text, the encounter, subject details and the timepoint
+    to the document, as included in ``aggregate_responses()`` bundles.
+
+    """
+    from .qb_timeline import qb_status_visit_name  # avoid cycle
+
+    patient_fields = ("careProvider", "identifier")
+    system_filter = current_app.config.get('REPORTING_IDENTIFIER_SYSTEMS')
+
+    document = questionnaire_response.document_answered.copy()
+    subject = questionnaire_response.subject
+    encounter = questionnaire_response.encounter
+    encounter_fhir = encounter.as_fhir()
+    document["encounter"] = encounter_fhir
+
+    document["subject"] = {
+        k: v for k, v in subject.as_fhir().items() if k in patient_fields
+    }
+
+    if subject.organizations:
+        providers = []
+        for org in subject.organizations:
+            org_ref = Reference.organization(org.id).as_fhir()
+            identifiers = [i.as_fhir() for i in org.identifiers if
+                           i.system in system_filter]
+            if identifiers:
+                org_ref['identifier'] = identifiers
+            providers.append(org_ref)
+        document["subject"]["careProvider"] = providers
+
+    qb_status = qb_status_visit_name(
+        subject.id, research_study_id, questionnaire_response.authored)
+    document["timepoint"] = qb_status['visit_name']
+
+    # Hack: add missing "resource" wrapper for DTSU2 compliance
+    # Remove when all interventions compliant
+    if patch_dstu2:
+        document = {
+            'resource': document,
+            # Todo: return URL to individual QuestionnaireResponse resource
+            'fullUrl': url_for(
+                '.assessment',
+                patient_id=subject.id,
+                _external=True,
+            ),
+        }
+    return document
+
+
 def aggregate_responses(
         instrument_ids, current_user, research_study_id, patch_dstu2=False,
         celery_task=None):
@@ -755,8 +838,6 @@ def aggregate_responses(
     :param celery_task: if defined, send occasional progress updates
 
     """
-    from .qb_timeline import qb_status_visit_name  # avoid cycle
-
     # Gather up the patient IDs for whom current user has 'view' permission
     user_ids = patients_query(
         current_user, include_test_role=False).with_entities(User.id)
@@ -764,65 +845,20 @@ def aggregate_responses(
     annotated_questionnaire_responses = []
     questionnaire_responses = QuestionnaireResponse.query.filter(
         QuestionnaireResponse.subject_id.in_(user_ids)).order_by(
-        QuestionnaireResponse.document['authored'].desc())
+        QuestionnaireResponse.authored.desc())
 
     if instrument_ids:
-        instrument_filters = (
-            QuestionnaireResponse.document[
-                ("questionnaire", "reference")
-            ].astext.endswith(instrument_id)
-            for instrument_id in instrument_ids
-        )
         questionnaire_responses = questionnaire_responses.filter(
-            or_(*instrument_filters))
+            QuestionnaireResponse.instrument_id.in_(instrument_ids))
 
-    patient_fields = ("careProvider", "identifier")
-    system_filter = current_app.config.get('REPORTING_IDENTIFIER_SYSTEMS')
     if celery_task:
         current, total = 0, questionnaire_responses.count()
 
     for questionnaire_response in questionnaire_responses:
-        document = questionnaire_response.document_answered.copy()
-        subject = questionnaire_response.subject
-        encounter = questionnaire_response.encounter
-        encounter_fhir = encounter.as_fhir()
-        document["encounter"] = encounter_fhir
-
-        document["subject"] = {
-            k: v for k, v in subject.as_fhir().items() if k in patient_fields
-        }
-
-        if subject.organizations:
-            providers = []
-            for org in subject.organizations:
-                org_ref = Reference.organization(org.id).as_fhir()
-                identifiers = [i.as_fhir() for i in org.identifiers if
-                               i.system in system_filter]
-                if identifiers:
-                    org_ref['identifier'] = identifiers
-                providers.append(org_ref)
-            document["subject"]["careProvider"] = providers
-
-        qb_status = qb_status_visit_name(
-            subject.id,
-            research_study_id,
-            FHIR_datetime.parse(questionnaire_response.document['authored']))
-        document["timepoint"] = qb_status['visit_name']
-
-        # Hack: add missing "resource" wrapper for DTSU2 compliance
-        # Remove when all interventions compliant
-        if patch_dstu2:
-            document = {
-                'resource': document,
-                # Todo: return URL to individual QuestionnaireResponse resource
-                'fullUrl': url_for(
-                    '.assessment',
-                    patient_id=subject.id,
-                    _external=True,
-                ),
-            }
-
-        annotated_questionnaire_responses.append(document)
+        annotated_questionnaire_responses.append(annotated_response(
+            questionnaire_response,
+            research_study_id=research_study_id,
+            patch_dstu2=patch_dstu2))
 
         if celery_task:
             current += 1
@@ -834,6 +870,75 @@ def aggregate_responses(
     return bundle_results(elements=annotated_questionnaire_responses)
 
 
+def encode_cursor(updated, qnr_id):
+    """Encode the keyset position after the given row as an opaque cursor"""
+    # isoformat, unlike as_fhir(), retains microseconds
+    position = json.dumps([updated.isoformat(), qnr_id])
+    return urlsafe_b64encode(position.encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor):
+    """Decode an opaque cursor to its (updated, qnr_id) keyset position
+
+    :raises ValueError: if the cursor is malformed
+
+    """
+    try:
+        updated, qnr_id = json.loads(
+            urlsafe_b64decode(cursor.encode('ascii')))
+        return datetime.fromisoformat(updated), int(qnr_id)
+    except (TypeError, ValueError, binascii.Error) as e:
+        raise ValueError("invalid cursor {}: {}".format(cursor, e))
+
+
+def paged_responses(
+        instrument_ids, current_user, research_study_id, count,
+        since=None, cursor=None, patch_dstu2=False):
+    """Return a page of annotated QuestionnaireResponses
+
+    Keyset paged form of ``aggregate_responses()``, ordered by (updated,
+    id) so a client can walk the entire set, or resume from the last
+    cursor seen to pick up only responses written since, including
+    those back dated (such as paper entry) or modified.  A modified
+    response moves to the end of the order.
+
+    :param count: maximum number of responses in the page
+    :param since: if given, only include responses written at or after
+    :param cursor: opaque position returned with the previous page
+    :returns: tuple (list of annotated responses, cursor for next page or
+      None if this is the last page)
+
+    """
+    user_ids = patients_query(
+        current_user, include_test_role=False).with_entities(User.id)
+    query = QuestionnaireResponse.query.filter(
+        QuestionnaireResponse.subject_id.in_(user_ids))
+    if instrument_ids:
+        query = query.filter(
+            QuestionnaireResponse.instrument_id.in_(instrument_ids))
+    if since:
+        query = query.filter(QuestionnaireResponse.updated >= since)
+    if cursor:
+        query = query.filter(tuple_(
+            QuestionnaireResponse.updated, QuestionnaireResponse.id) >
+            tuple_(*decode_cursor(cursor)))
+
+    # fetch one extra to learn if another page follows
+    page = query.order_by(
+        QuestionnaireResponse.updated, QuestionnaireResponse.id).limit(
+        count + 1).all()
+    next_cursor = None
+    if len(page) > count:
+        page = page[:count]
+        next_cursor = encode_cursor(page[-1].updated, page[-1].id)
+
+    return [
+        annotated_response(
+            qnr, research_study_id=research_study_id,
+            patch_dstu2=patch_dstu2)
+        for qnr in page], next_cursor
+
+
 def qnr_document_id(
         subject_id, questionnaire_bank_id, questionnaire_name, iteration,
         status):
@@ -848,9 +953,7 @@ def qnr_document_id(
     qnr = QuestionnaireResponse.query.filter(
         QuestionnaireResponse.status == status).filter(
         QuestionnaireResponse.subject_id == subject_id).filter(
-        QuestionnaireResponse.document[
-            ('questionnaire', 'reference')
-        ].astext.endswith(questionnaire_name)).filter(
+        QuestionnaireResponse.instrument_id == questionnaire_name).filter(
         QuestionnaireResponse.questionnaire_bank_id ==
         questionnaire_bank_id).with_entities(
         QuestionnaireResponse.document[(
@@ -875,10 +978,11 @@ def consolidate_answer_pairs(answers):
     last_answer = None
     for answer in answers:
         # answer pair detected, only yield coded value
+        # NB - answers may belong to a persisted document, don't mutate
         if 'valueCoding' in answer and last_answer and 'valueString' in last_answer:
-            answer['valueCoding']['text'] = last_answer['valueString']
+            yield dict(answer, valueCoding=dict(
+                answer['valueCoding'], text=last_answer['valueString']))
             last_answer = None
-            yield answer
             continue
 
         # no pair, yield last answer before storing another
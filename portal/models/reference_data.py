@@ -0,0 +1,301 @@
+"""Reference Data module
+
+Roles, interventions, research studies, questionnaires and questionnaire
+banks are effectively static between ``sync`` runs, yet are looked up
+constantly.  The ``ReferenceData`` registry holds immutable snapshots of
+these rows, indexed by id and name, loaded once per process.
+
+The registry is versioned by a generation counter kept in redis.  Any
+process changing reference data (i.e. ``seed``) calls
+``ReferenceData.bump_generation()``, and all processes reload on their
+next check, at most every ``REFERENCE_DATA_CHECK_INTERVAL`` seconds.
+Reference data changed at runtime, such as an intervention's client,
+calls ``mark_reference_data_stale()`` to bump the generation on commit.
+
+Snapshots are plain (slotted) named tuples, safe to share across threads
+and free of any database session.  Lookups returning ``None`` should fall
+back to the database, as the row may have been added since the last load.
+
+For lookups needing ORM instances, such as ``INTERVENTION.CARE_PLAN``,
+the registry also keeps detached instances built from the loaded column
+values, merged into the caller's session on lookup without a query.
+
+"""
+from collections import namedtuple
+import time
+from types import MappingProxyType
+
+from flask import current_app, has_app_context
+import redis
+from redis.exceptions import ConnectionError
+from sqlalchemy import event
+from sqlalchemy.orm import (
+    Session,
+    class_mapper,
+    make_transient_to_detached,
+)
+
+from ..database import db
+from ..timeout_lock import LockTimeout, TimeoutLock
+
+REFERENCE_DATA_GENERATION_KEY = 'reference_data_generation'
+REFERENCE_DATA_LOCK_KEY = 'ReferenceData-LOCK'
+REFERENCE_DATA_STALE = 'reference_data_stale'  # session.info key
+
+RoleRef = namedtuple('RoleRef', ('id', 'name'))
+InterventionRef = namedtuple('InterventionRef', ('id', 'name'))
+ResearchStudyRef = namedtuple('ResearchStudyRef', ('id', 'title', 'status'))
+QuestionnaireRef = namedtuple('QuestionnaireRef', ('id', 'name'))
+QuestionnaireBankRef = namedtuple('QuestionnaireBankRef', (
+    'id', 'name', 'classification', 'research_protocol_id',
+    'intervention_id'))
+
+
+class ReferenceIndex(object):
+    """Immutable lookup by id or name over a set of snapshots"""
+    __slots__ = ('_by_id', '_by_name')
+
+    def __init__(self, snapshots, name_attr='name'):
+        self._by_id = {s.id: s for s in snapshots}
+        self._by_name = {getattr(s, name_attr): s for s in snapshots}
+
+    def get(self, id):
+        """Return snapshot by id, or None if not found"""
+        return self._by_id.get(id)
+
+    def by_name(self, name):
+        """Return snapshot by name, or None if not found"""
+        return self._by_name.get(name)
+
+    def __iter__(self):
+        return iter(self._by_id.values())
+
+    def __len__(self):
+        return len(self._by_id)
+
+
+def detached_instances(cls, query=None, extra_entities=()):
+    """Build detached ORM instances of `cls` from column values
+
+    As if freshly loaded and expunged, the instances belong to no session,
+    for sessions to ``merge(load=False)`` without a query.  Relationships
+    are left unloaded, to lazy load once merged.
+
+    :param query: optional base query, defaults to ``cls.query``
+    :param extra_entities: additional entities to select, returned
+      alongside each instance
+    :returns: list of instances, or (instance, extra, ...) tuples if
+      ``extra_entities`` were given
+
+    """
+    mapper = class_mapper(cls)
+    keys = [attr.key for attr in mapper.column_attrs]
+    query = query if query is not None else cls.query
+    results = []
+    for row in query.with_entities(
+            *[getattr(cls, key) for key in keys], *extra_entities):
+        instance = mapper.class_manager.new_instance()
+        for key, value in zip(keys, row):
+            setattr(instance, key, value)
+        make_transient_to_detached(instance)
+        if extra_entities:
+            results.append((instance,) + tuple(row[len(keys):]))
+        else:
+            results.append(instance)
+    return results
+
+
+def _redis():
+    return redis.StrictRedis.from_url(current_app.config['REDIS_URL'])
+
+
+class ReferenceData(object):
+    """Process wide registry of reference data snapshots
+
+    Use ``ReferenceData.current()`` to obtain the registry, which loads
+    on first request and again whenever the redis generation changes.
+
+    """
+    __slots__ = (
+        'generation',
+        'roles',
+        'interventions',
+        'research_studies',
+        'questionnaires',
+        'questionnaire_banks',
+        '_code_maps',
+        '_instances')
+
+    # Singleton registry and time of last generation check
+    _current = None
+    _checked_at = 0
+
+    def __init__(self, generation):
+        from .intervention import Intervention
+        from .questionnaire import Questionnaire, QuestionnaireIdentifier
+        from .questionnaire_bank import QuestionnaireBank
+        from .research_study import ResearchStudy
+        from .role import Role
+        from .identifier import Identifier
+        from ..system_uri import TRUENTH_QUESTIONNAIRE_CODE_SYSTEM
+
+        self.generation = generation
+        self._code_maps = {}
+        self.roles = ReferenceIndex([
+            RoleRef(*row) for row in
+            Role.query.with_entities(Role.id, Role.name)])
+        self.interventions = ReferenceIndex([
+            InterventionRef(*row) for row in
+            Intervention.query.with_entities(
+                Intervention.id, Intervention.name)])
+        self.research_studies = ReferenceIndex([
+            ResearchStudyRef(*row) for row in
+            ResearchStudy.query.with_entities(
+                ResearchStudy.id, ResearchStudy.title,
+                ResearchStudy.status)], name_attr='title')
+        self.questionnaires = ReferenceIndex([
+            QuestionnaireRef(*row) for row in
+            Questionnaire.query.join(QuestionnaireIdentifier).join(
+                Identifier).filter(
+                Identifier.system == TRUENTH_QUESTIONNAIRE_CODE_SYSTEM
+            ).with_entities(Questionnaire.id, Identifier._value)])
+        self.questionnaire_banks = ReferenceIndex([
+            QuestionnaireBankRef(*row) for row in
+            QuestionnaireBank.query.with_entities(
+                QuestionnaireBank.id, QuestionnaireBank.name,
+                QuestionnaireBank.classification,
+                QuestionnaireBank.research_protocol_id,
+                QuestionnaireBank.intervention_id)])
+
+        # detached instances by class and name, for ``lookup_by_name()``
+        self._instances = {
+            cls.__name__: MappingProxyType(
+                {i.name: i for i in detached_instances(cls)})
+            for cls in (Role, Intervention, QuestionnaireBank)}
+        self._instances['Questionnaire'] = MappingProxyType({
+            name: q for q, name in detached_instances(
+                Questionnaire,
+                query=Questionnaire.query.join(
+                    QuestionnaireIdentifier).join(Identifier).filter(
+                    Identifier.system == TRUENTH_QUESTIONNAIRE_CODE_SYSTEM),
+                extra_entities=(Identifier._value,))})
+
+    def instance(self, cls, name):
+        """Return detached instance of `cls` by name, or None if not found
+
+        NB - never use the returned instance directly; merge it into a
+        session, as does ``lookup_by_name()``.
+
+        """
+        return self._instances[cls.__name__].get(name)
+
+    def questionnaire_code_map(self, name):
+        """Return compiled map of option codes to text for questionnaire
+
+        Compiled on first request and kept for the life of this
+        registry, i.e. until the reference data generation changes.
+
+        :param name: questionnaire name, i.e. instrument_id
+        :returns: read only mapping, or None if no such questionnaire
+
+        """
+        if name not in self._code_maps:
+            from .questionnaire import Questionnaire
+
+            questionnaire = Questionnaire.find_by_name(name=name)
+            if not questionnaire:
+                return None
+            self._code_maps[name] = MappingProxyType(
+                questionnaire.questionnaire_code_map())
+        return self._code_maps[name]
+
+    @classmethod
+    def current(cls):
+        """Return the current registry, (re)loading as needed"""
+        now = time.time()
+        interval = current_app.config['REFERENCE_DATA_CHECK_INTERVAL']
+        if cls._current is not None and now - cls._checked_at < interval:
+            return cls._current
+
+        generation = cls.current_generation()
+        cls._checked_at = now
+        if cls._current is None or cls._current.generation != generation:
+            # loading is cheap; lock only to avoid a thundering herd
+            try:
+                with TimeoutLock(key=REFERENCE_DATA_LOCK_KEY, expires=60):
+                    cls._current = cls(generation)
+            except LockTimeout:
+                current_app.logger.error(
+                    f"couldn't acquire {REFERENCE_DATA_LOCK_KEY}")
+                cls._current = cls(generation)
+        return cls._current
+
+    @staticmethod
+    def current_generation():
+        """Return the redis managed generation of reference data"""
+        try:
+            value = _redis().get(REFERENCE_DATA_GENERATION_KEY)
+        except ConnectionError as ce:
+            current_app.logger.error(
+                "reference data generation unavailable: {}".format(ce))
+            return None
+        return int(value) if value else 0
+
+    @staticmethod
+    def bump_generation():
+        """Signal all processes to reload reference data"""
+        ReferenceData.invalidate_cache()
+        return _redis().incr(REFERENCE_DATA_GENERATION_KEY)
+
+    @classmethod
+    def invalidate_cache(cls):
+        """Drop this process' registry, reloaded on next request"""
+        cls._current = None
+
+
+def mark_reference_data_stale(session):
+    """Bump the reference data generation once the session commits
+
+    Called from mapper events of reference data changed at runtime.
+
+    """
+    session.info[REFERENCE_DATA_STALE] = True
+
+
+@event.listens_for(Session, 'after_commit')
+def _bump_reference_data(session):
+    if not (session.info.pop(REFERENCE_DATA_STALE, None) and
+            has_app_context()):
+        return
+    try:
+        ReferenceData.bump_generation()
+    except ConnectionError as ce:
+        # the change is committed; other processes catch up on restart
+        current_app.logger.error(
+            "reference data generation not bumped: {}".format(ce))
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_reference_data_stale(session):
+    session.info.pop(REFERENCE_DATA_STALE, None)
+
+
+def lookup_by_name(cls, name):
+    """Return ORM instance of reference data class `cls` by name
+
+    Served from the registry without a query; the registry's detached
+    instance is merged into the current session, unless the session
+    already holds the row, in which case that instance is returned.
+
+    :returns: ORM instance or None if not found in the registry; callers
+      should fall back to a query in this case
+
+    """
+    detached = ReferenceData.current().instance(cls, name)
+    if detached is None:
+        return None
+    existing = db.session.identity_map.get(
+        db.session.identity_key(cls, detached.id))
+    if existing is not None:
+        return existing
+    return db.session.merge(detached, load=False)
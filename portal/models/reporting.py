@@ -9,11 +9,14 @@ from werkzeug.exceptions import Unauthorized
 
 from ..audit import auditable_event
 from ..cache import cache
+from ..database import db
 from ..date_tools import FHIR_datetime
+from ..stage_timing import stage_timer
 from ..trigger_states.models import TriggerStatesReporting
 from .app_text import MailResource, SiteSummaryEmail_ATMA, app_text
-from .communication import load_template_args
-from .message import EmailMessage
+from .communication import TemplateArgsPrefetch, load_template_args
+from .communication_request import email_ready_user_ids
+from .message import EmailMessage, send_message_batch
 from .organization import Organization, OrgTree
 from .overall_status import OverallStatus
 from .questionnaire_response import aggregate_responses
@@ -357,8 +360,22 @@ def overdue_stats_by_org():
 
 
 def generate_and_send_summaries(org_id):
+    with stage_timer('site_summary', 'total'):
+        return _generate_and_send_summaries(org_id)
+
+
+def _generate_and_send_summaries(org_id):
+    """Render and send the site summary to all staff under org_id
+
+    Staff with the same locale and set of visible organizations receive
+    the same overdue table, so recipients are grouped, rendering the
+    table and fetching the mail template once per group.  Messages for
+    all groups are sent over a single SMTP connection.
+
+    """
     from ..views.reporting import generate_overdue_table_html
-    ostats = overdue_stats_by_org()
+    with stage_timer('site_summary', 'overdue_stats'):
+        ostats = overdue_stats_by_org()
     error_emails = set()
 
     ot = OrgTree()
@@ -367,46 +384,89 @@ def generate_and_send_summaries(org_id):
         raise ValueError("No org with ID {} found.".format(org_id))
     name_key = SiteSummaryEmail_ATMA.name_key(org=top_org.name)
 
-    for staff_user in User.query.join(
-            UserRoles).join(Role).filter(
-            Role.name == ROLE.STAFF.value).filter(
-            User.id == UserRoles.user_id).filter(
-            Role.id == UserRoles.role_id).filter(
-            User.deleted_id.is_(None)):
-        if not(
-                staff_user.email_ready()[0] and
-                top_org in ot.find_top_level_orgs(staff_user.organizations)):
+    staff = User.query.join(
+        UserRoles).join(Role).filter(
+        Role.name == ROLE.STAFF.value).filter(
+        User.id == UserRoles.user_id).filter(
+        Role.id == UserRoles.role_id).filter(
+        User.deleted_id.is_(None)).all()
+    ready_ids = email_ready_user_ids(staff)
+
+    # group recipients by (locale, visible org ids under top_org)
+    report_org_ids = {
+        ostat_org_id for ostat_org_id, _ in ostats
+        if ot.at_or_below_ids(top_org.id, [ostat_org_id])}
+    visible_by_orgs = {}
+    groups = defaultdict(list)
+    for staff_user in staff:
+        user_org_ids = frozenset(
+            o.id for o in staff_user.organizations if o.id)
+        if not (
+                staff_user.id in ready_ids and
+                ot.at_or_below_ids(top_org.id, user_org_ids)):
             continue
-
-        args = load_template_args(user=staff_user)
-        with force_locale(staff_user.locale_code):
-            args['eproms_site_summary_table'] = generate_overdue_table_html(
+        if user_org_ids not in visible_by_orgs:
+            visible = set()
+            for user_org_id in user_org_ids:
+                visible.update(ot.here_and_below_id(user_org_id))
+            visible_by_orgs[user_org_ids] = frozenset(
+                visible & report_org_ids)
+        groups[(staff_user.locale_code, visible_by_orgs[user_org_ids])
+               ].append(staff_user)
+
+    prefetch = TemplateArgsPrefetch(
+        users=[u for members in groups.values() for u in members])
+    messages, recipients = [], []
+    for (locale_code, visible_org_ids), members in groups.items():
+        with force_locale(locale_code), stage_timer(
+                'site_summary', 'overdue_table'):
+            table = generate_overdue_table_html(
                 overdue_stats=ostats,
-                user=staff_user,
+                user=members[0],
                 top_org=top_org,
+                visible_org_ids=visible_org_ids,
             )
-        summary_email = MailResource(
-            app_text(name_key), locale_code=staff_user.locale_code,
-            variables=args)
-        em = EmailMessage(recipients=staff_user.email,
-                          sender=current_app.config['MAIL_DEFAULT_SENDER'],
-                          subject=summary_email.subject,
-                          body=summary_email.body)
-        try:
-            em.send_message()
-        except SMTPRecipientsRefused as exc:
-            msg = ("Error sending site summary email to {}: "
-                   "{}".format(staff_user.email, exc))
+        with stage_timer('site_summary', 'mail_resource'):
+            summary_email = MailResource(
+                app_text(name_key), locale_code=locale_code)
+
+        for staff_user in members:
+            with stage_timer('site_summary', 'template_args'):
+                args = load_template_args(
+                    user=staff_user, prefetch=prefetch,
+                    variables=summary_email.variable_list)
+            args['eproms_site_summary_table'] = table
+            summary_email.variables = args
+            messages.append(EmailMessage(
+                recipients=staff_user.email,
+                sender=current_app.config['MAIL_DEFAULT_SENDER'],
+                subject=summary_email.subject,
+                body=summary_email.body))
+            recipients.append(staff_user)
+
+    with stage_timer('site_summary', 'smtp_batch'):
+        results = send_message_batch(messages)
+    db.session.commit()
+
+    for staff_user, exc in zip(recipients, results):
+        if exc is None:
+            continue
+        if not isinstance(exc, SMTPRecipientsRefused):
+            current_app.logger.error(
+                "Error sending site summary email to %s: %s",
+                staff_user.email, exc)
+            continue
+        msg = ("Error sending site summary email to {}: "
+               "{}".format(staff_user.email, exc))
 
-            sys = User.query.filter_by(email='__system__').first()
+        sys = User.query.filter_by(email='__system__').first()
 
-            auditable_event(message=msg,
-                            user_id=(sys.id if sys else staff_user.id),
-                            subject_id=staff_user.id,
-                            context="user")
+        auditable_event(message=msg,
+                        user_id=(sys.id if sys else staff_user.id),
+                        subject_id=staff_user.id,
+                        context="user")
 
-            current_app.logger.error(msg)
-            for email in exc[0]:
-                error_emails.add(email)
+        current_app.logger.error(msg)
+        error_emails.update(exc.recipients)
 
     return error_emails or None
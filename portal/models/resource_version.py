@@ -0,0 +1,240 @@
+"""Resource versions, for conditional GET of frequently polled resources
+
+Each tracked resource (or per patient aggregate, such as a patient's
+consents) has a last modified time kept in redis, advanced after any
+commit which inserts, updates or deletes rows it's built from.  Read
+endpoints check the request's ``If-None-Match`` and ``If-Modified-Since``
+validators against the version before building the document, returning
+``304 Not Modified`` when the client's copy is current.
+
+Versions advance only after commit, so a version never precedes the
+data it describes.  Versions missing from redis (i.e. expired) restart
+at the current time, so clients simply refetch.  Each advance is also
+published, for those waiting on changes via ``subscribe()``.
+
+NB - changes made outside the ORM's unit of work, such as bulk or raw
+SQL updates, must call ``mark_modified()`` explicitly.
+
+"""
+from datetime import datetime
+import time
+
+from flask import current_app, has_app_context, request
+import redis
+from sqlalchemy import event
+from sqlalchemy.orm import Session, object_session
+
+from .identifier import Identifier, UserIdentifier
+from .observation import Observation, UserObservation
+from .organization import Organization, UserOrganization
+from .questionnaire_response import QuestionnaireResponse
+from .telecom import ContactPoint
+from .user import User, UserEthnicity, UserIndigenous, UserRace
+from .user_clinician import UserClinician
+from .user_consent import UserConsent
+
+VERSION_KEY = 'resource_version::{kind}::{key}'
+PENDING = 'modified_resources'  # session.info key
+
+_version_store = None
+
+
+def version_store():
+    """Returns the redis client, created on first use and shared"""
+    global _version_store
+    if _version_store is None:
+        _version_store = redis.StrictRedis.from_url(
+            current_app.config['REDIS_URL'])
+    return _version_store
+
+
+class ResourceVersion(object):
+    """Last modified time of a resource, with HTTP validators from it
+
+    :param kind: type of resource or aggregate, such as ``consent``
+    :param key: identifies the particular resource, typically an id
+
+    """
+
+    def __init__(self, kind, key):
+        self.kind = kind
+        self.key = key
+        redis_key = VERSION_KEY.format(kind=kind, key=key)
+        # look up, or start from now if unknown
+        pipe = version_store().pipeline()
+        pipe.set(
+            redis_key, time.time(), nx=True,
+            ex=current_app.config['RESOURCE_VERSION_TTL'])
+        pipe.get(redis_key)
+        self.timestamp = float(pipe.execute()[1])
+
+    @property
+    def etag(self):
+        return "{}-{}-{}".format(
+            self.kind, self.key, int(self.timestamp * 1000000))
+
+    @property
+    def last_modified(self):
+        """Naive UTC datetime of last modification, to the second"""
+        return datetime.utcfromtimestamp(int(self.timestamp))
+
+    def is_current(self):
+        """Determine if the request's validators match this version
+
+        As per RFC 7232, ``If-Modified-Since`` is ignored when the request
+        includes ``If-None-Match``.  Clients should prefer the latter, as
+        ``Last-Modified`` can't distinguish changes within a second.
+
+        """
+        if request.if_none_match:
+            return request.if_none_match.contains_weak(self.etag)
+        if request.if_modified_since:
+            return self.last_modified <= request.if_modified_since.replace(
+                tzinfo=None)
+        return False
+
+    def tag(self, response):
+        """Add validators to the response, to enable conditional requests"""
+        response.set_etag(self.etag, weak=True)
+        response.last_modified = self.last_modified
+        response.cache_control.no_cache = True
+        return response
+
+    def not_modified(self):
+        """Return ``304 Not Modified`` response if client's copy is current
+
+        :returns: the response if applicable, None otherwise
+
+        """
+        if not self.is_current():
+            return None
+        return self.tag(current_app.response_class(status=304))
+
+
+def mark_modified(session, kind, key):
+    """Note the resource as modified, advancing its version on commit"""
+    session.info.setdefault(PENDING, set()).add((kind, key))
+
+
+def advance_versions(resources):
+    """Advance versions of the resources, notifying any subscribers
+
+    Typically called on commit, for resources marked modified.  Call
+    directly for changes not persisted through the session.
+
+    :param resources: iterable of (kind, key) tuples
+
+    """
+    now = time.time()
+    ttl = current_app.config['RESOURCE_VERSION_TTL']
+    pipe = version_store().pipeline()
+    for kind, key in resources:
+        redis_key = VERSION_KEY.format(kind=kind, key=key)
+        pipe.set(redis_key, now, ex=ttl)
+        pipe.publish(redis_key, now)
+    pipe.execute()
+
+
+def subscribe(kind, key):
+    """Subscribe to version changes of the resource
+
+    :returns: redis ``PubSub`` receiving a message as each new version
+      is advanced; caller is responsible for closing
+
+    """
+    pubsub = version_store().pubsub(ignore_subscribe_messages=True)
+    pubsub.subscribe(VERSION_KEY.format(kind=kind, key=key))
+    return pubsub
+
+
+@event.listens_for(Session, 'after_commit')
+def _advance_versions(session):
+    pending = session.info.pop(PENDING, None)
+    if not pending or not has_app_context():
+        return
+    advance_versions(pending)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_pending(session):
+    session.info.pop(PENDING, None)
+
+
+@event.listens_for(User, 'after_insert')
+@event.listens_for(User, 'after_update')
+def _user_written(mapper, connection, target):
+    mark_modified(object_session(target), 'patient', target.id)
+
+
+def _user_link_written(mapper, connection, target):
+    """Link rows persisted directly, rather than via a User collection"""
+    user_id = (
+        target.patient_id if isinstance(target, UserClinician)
+        else target.user_id)
+    mark_modified(object_session(target), 'patient', user_id)
+
+
+for _link in (
+        UserClinician, UserEthnicity, UserIdentifier, UserIndigenous,
+        UserOrganization, UserRace):
+    for _name in ('after_insert', 'after_update', 'after_delete'):
+        event.listen(_link, _name, _user_link_written)
+
+
+@event.listens_for(ContactPoint, 'after_update')
+@event.listens_for(ContactPoint, 'after_delete')
+def _contact_point_written(mapper, connection, target):
+    # i.e. ``User.phone`` updates the existing row in place
+    user_ids = connection.execute(
+        User.__table__.select().with_only_columns([User.id]).where(
+            (User.phone_id == target.id) |
+            (User.alt_phone_id == target.id)))
+    for user_id, in user_ids:
+        mark_modified(object_session(target), 'patient', user_id)
+
+
+@event.listens_for(Identifier, 'after_update')
+def _identifier_written(mapper, connection, target):
+    user_ids = connection.execute(
+        UserIdentifier.__table__.select().with_only_columns(
+            [UserIdentifier.user_id]).where(
+            UserIdentifier.identifier_id == target.id))
+    for user_id, in user_ids:
+        mark_modified(object_session(target), 'patient', user_id)
+
+
+@event.listens_for(UserConsent, 'after_insert')
+@event.listens_for(UserConsent, 'after_update')
+@event.listens_for(UserConsent, 'after_delete')
+def _consent_written(mapper, connection, target):
+    mark_modified(object_session(target), 'consent', target.user_id)
+
+
+@event.listens_for(UserObservation, 'after_insert')
+@event.listens_for(UserObservation, 'after_update')
+@event.listens_for(UserObservation, 'after_delete')
+def _user_observation_written(mapper, connection, target):
+    mark_modified(object_session(target), 'clinical', target.user_id)
+
+
+@event.listens_for(Observation, 'after_update')
+def _observation_written(mapper, connection, target):
+    user_ids = connection.execute(
+        UserObservation.__table__.select().with_only_columns(
+            [UserObservation.user_id]).where(
+            UserObservation.observation_id == target.id))
+    for user_id, in user_ids:
+        mark_modified(object_session(target), 'clinical', user_id)
+
+
+@event.listens_for(QuestionnaireResponse, 'after_update')
+@event.listens_for(QuestionnaireResponse, 'after_delete')
+def _qnr_written(mapper, connection, target):
+    mark_modified(object_session(target), 'questionnaire_response', target.id)
+
+
+@event.listens_for(Organization, 'after_insert')
+@event.listens_for(Organization, 'after_update')
+@event.listens_for(Organization, 'after_delete')
+def _organization_written(mapper, connection, target):
+    mark_modified(object_session(target), 'organization', 'all')
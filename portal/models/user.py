@@ -926,28 +926,44 @@ class User(db.Model, UserMixin):
         else:
             return None
 
-    def add_observation(self, fhir, audit):
-        if 'coding' not in fhir['code']:
+    def add_observation(self, fhir, audit, encounter=None, in_batch=False):
+        """Add observation from given FHIR
+
+        :param encounter: encounter to associate, by default the acting
+          user's current encounter
+        :param in_batch: set when adding as part of a larger transaction;
+          new rows are flushed rather than committed, and the caller is
+          responsible for invalidating the user's timeline.  NB - values
+          such as ``issued`` are expected to be previously validated
+        :returns: tuple (status code, message)
+
+        """
+        if 'coding' not in fhir.get('code', {}):
             return 400, "requires at least one CodeableConcept"
         if 'valueQuantity' not in fhir:
             return 400, "missing required 'valueQuantity'"
 
-        cc = CodeableConcept.from_fhir(fhir['code']).add_if_not_found()
+        if in_batch:
+            cc = CodeableConcept.resolve(fhir['code'])
+        else:
+            cc = CodeableConcept.from_fhir(fhir['code']).add_if_not_found()
 
         v = fhir['valueQuantity']
         vq = ValueQuantity(value=v.get('value'),
                            units=v.get('units'),
                            system=v.get('system'),
-                           code=v.get('code')).add_if_not_found(True)
+                           code=v.get('code')).add_if_not_found(not in_batch)
 
         issued = (
             fhir.get('issued') and
             parser.parse(fhir.get('issued')) or None)
         status = fhir.get('status')
-        observation = self.save_observation(cc, vq, audit, status, issued)
+        observation = self.save_observation(
+            cc, vq, audit, status, issued, encounter=encounter,
+            in_batch=in_batch)
         if 'performer' in fhir:
             for p in fhir['performer']:
-                performer = Performer.from_fhir(p)
+                performer = Performer.from_fhir(p, in_batch=in_batch)
                 observation.performers.append(performer)
         return 200, "added {} to user {}".format(observation, self.id)
 
@@ -1069,28 +1085,40 @@ class User(db.Model, UserMixin):
         return newest
 
     def save_observation(
-            self, codeable_concept, value_quantity, audit, status, issued):
-        """Helper method for creating new observations"""
+            self, codeable_concept, value_quantity, audit, status, issued,
+            encounter=None, in_batch=False):
+        """Helper method for creating new observations
+
+        See ``add_observation()`` for ``encounter`` and ``in_batch``
+
+        """
         from .qb_timeline import invalidate_users_QBT  # avoid cycle
 
         # User may not have persisted concept or value - CYA
         codeable_concept = codeable_concept.add_if_not_found()
         value_quantity = value_quantity.add_if_not_found()
+        if in_batch:
+            db.session.flush()
 
         observation = Observation(
             codeable_concept_id=codeable_concept.id,
             status=status,
             issued=issued,
-            value_quantity_id=value_quantity.id).add_if_not_found(True)
-        # The audit defines the acting user, to which the current
-        # encounter is attached.
-        acting_user = User.query.get(audit.user_id)
-        encounter = acting_user.current_encounter()
+            value_quantity_id=value_quantity.id).add_if_not_found(
+            not in_batch)
+        if in_batch:
+            db.session.flush()
+        if encounter is None:
+            # The audit defines the acting user, to which the current
+            # encounter is attached.
+            acting_user = User.query.get(audit.user_id)
+            encounter = acting_user.current_encounter()
         db.session.add(UserObservation(
             user_id=self.id, encounter=encounter, audit=audit,
             observation_id=observation.id))
-        # TODO: limit invalidation to set of observations that may alter QBT
-        invalidate_users_QBT(self.id, research_study_id='all')
+        if not in_batch:
+            # TODO: limit invalidation to observations that may alter QBT
+            invalidate_users_QBT(self.id, research_study_id='all')
         return observation
 
     def clinical_history(self, requestURL=None, patch_dstu2=False):
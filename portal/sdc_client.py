@@ -0,0 +1,130 @@
+"""Client for the SDC (Structured Data Capture) service
+
+QuestionnaireResponses are posted to the SDC ``$extract`` operation,
+which returns a Bundle of the scored Observations.  The client shares a
+pooled session across requests, bounds each request with the configured
+timeouts, and retries failed requests with jittered exponential backoff.
+
+In bulk mode, a batch Bundle of QuestionnaireResponses is posted in a
+single request, the response Bundle holding an Observation Bundle entry
+for each, in the same order.
+
+"""
+import random
+import time
+
+from flask import current_app
+import requests
+from requests.adapters import HTTPAdapter
+from requests.exceptions import ConnectionError, HTTPError, Timeout
+
+# Process wide session, shared by all SDC requests for connection reuse
+_sdc_session = None
+
+# Response codes worth another attempt; others are raised immediately
+RETRY_STATUS_CODES = (429, 502, 503, 504)
+
+
+class SDCError(Exception):
+    """Raised when the SDC service fails to extract after all retries"""
+
+
+def sdc_session():
+    """Return the pooled HTTP session used for SDC requests"""
+    global _sdc_session
+    if _sdc_session is None:
+        pool_size = current_app.config['SDC_HTTP_POOL_SIZE']
+        adapter = HTTPAdapter(
+            pool_connections=pool_size, pool_maxsize=pool_size)
+        session = requests.Session()
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        _sdc_session = session
+    return _sdc_session
+
+
+def backoff_delay(attempt, base, cap):
+    """Return seconds to wait before the given (zero indexed) retry
+
+    Uses "full jitter", a random delay up to the exponential bound, so
+    workers failing together don't retry together.
+
+    """
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+class SDCClient(object):
+    """Posts QuestionnaireResponses to the SDC ``$extract`` operation"""
+
+    def __init__(self, base_url=None):
+        config = current_app.config
+        self.url = "{}/$extract".format(base_url or config['SDC_BASE_URL'])
+        self.timeout = (
+            config['SDC_CONNECT_TIMEOUT'], config['SDC_READ_TIMEOUT'])
+        self.retries = config['SDC_RETRIES']
+        self.backoff = config['SDC_BACKOFF_SECONDS']
+        self.backoff_cap = config['SDC_BACKOFF_CAP_SECONDS']
+
+    def _post(self, payload):
+        """POST payload, retrying on connection errors and busy responses
+
+        :returns: the parsed JSON response
+        :raises SDCError: if all attempts fail
+
+        """
+        attempt = 0
+        while True:
+            try:
+                response = sdc_session().post(
+                    self.url, json=payload, timeout=self.timeout)
+                if response.status_code not in RETRY_STATUS_CODES:
+                    response.raise_for_status()
+                    return response.json()
+                error = "{} {}".format(
+                    response.status_code, response.reason)
+            except (ConnectionError, Timeout) as e:
+                error = str(e)
+            except HTTPError as e:
+                raise SDCError("SDC $extract failed: {}".format(e))
+
+            if attempt >= self.retries:
+                raise SDCError("SDC $extract failed after {} attempts: "
+                               "{}".format(attempt + 1, error))
+            delay = backoff_delay(attempt, self.backoff, self.backoff_cap)
+            current_app.logger.warning(
+                "SDC $extract attempt %d failed (%s); retry in %.2fs",
+                attempt + 1, error, delay)
+            time.sleep(delay)
+            attempt += 1
+
+    def extract(self, qnr_json):
+        """Extract Observations from a single QuestionnaireResponse
+
+        :param qnr_json: QuestionnaireResponse in SDC FHIR form
+        :returns: Bundle of Observations
+
+        """
+        return self._post(qnr_json)
+
+    def extract_bundle(self, qnr_jsons):
+        """Extract Observations from several QuestionnaireResponses at once
+
+        :param qnr_jsons: list of QuestionnaireResponses in SDC FHIR form
+        :returns: list of Observation Bundles, one per given
+          QuestionnaireResponse, in the same order
+
+        """
+        bundle = {
+            'resourceType': 'Bundle',
+            'type': 'batch',
+            'entry': [{
+                'resource': qnr_json,
+                'request': {'method': 'POST', 'url': '$extract'}}
+                for qnr_json in qnr_jsons]}
+        response = self._post(bundle)
+        entries = response.get('entry', [])
+        if len(entries) != len(qnr_jsons):
+            raise SDCError(
+                "SDC $extract returned {} entries for {} "
+                "QuestionnaireResponses".format(len(entries), len(qnr_jsons)))
+        return [entry['resource'] for entry in entries]
@@ -0,0 +1,110 @@
+"""Module for recording per stage timings of multi step pipelines
+
+Where ``trace`` captures free text detail for a single request, stage
+timing captures durations of the named stages in a pipeline, such as
+the template args, content fetch and SMTP stages of sending a
+communication.  The most recent ``STAGE_TIMING_SAMPLES`` durations of
+each stage are kept in redis, from which percentiles are reported.
+
+"""
+from contextlib import contextmanager
+import time
+
+from flask import current_app
+import redis
+from redis.exceptions import ConnectionError
+
+STAGE_INDEX_KEY = 'stage_timing::stages'
+PERCENTILES = (50, 90, 99)
+
+_stage_redis = None
+
+
+def _redis():
+    """Returns the redis client, created on first use and shared"""
+    global _stage_redis
+    if _stage_redis is None:
+        _stage_redis = redis.StrictRedis.from_url(
+            current_app.config['REDIS_URL'])
+    return _stage_redis
+
+
+def _key(pipeline, stage):
+    return 'stage_timing::{}::{}'.format(pipeline, stage)
+
+
+@contextmanager
+def stage_timer(pipeline, stage):
+    """Context manager to record the duration of the enclosed stage
+
+    :param pipeline: name of the pipeline, i.e. 'communication'
+    :param stage: name of the stage within the pipeline, i.e. 'smtp'
+
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_timing(pipeline, stage, time.perf_counter() - start)
+
+
+def record_timing(pipeline, stage, seconds):
+    """Record a single duration for the named pipeline stage"""
+    if not current_app.config.get('STAGE_TIMING_ENABLED'):
+        return
+    key = _key(pipeline, stage)
+    try:
+        pipe = _redis().pipeline()
+        pipe.lpush(key, seconds)
+        pipe.ltrim(key, 0, current_app.config['STAGE_TIMING_SAMPLES'] - 1)
+        pipe.sadd(STAGE_INDEX_KEY, '{}::{}'.format(pipeline, stage))
+        pipe.execute()
+    except ConnectionError as ce:
+        # timings are informational only; never fail the pipeline
+        current_app.logger.warning(
+            "unable to record stage timing: {}".format(ce))
+
+
+def percentile(ordered, pct):
+    """Return the nearest rank percentile from the ordered samples"""
+    rank = max(0, int(round(pct / 100 * len(ordered))) - 1)
+    return ordered[min(rank, len(ordered) - 1)]
+
+
+def timing_report(pipeline=None):
+    """Summarize the recorded timings, per pipeline stage
+
+    :param pipeline: restrict report to the named pipeline, if given
+    :returns: dictionary keyed by pipeline, of dictionaries keyed by stage,
+      each holding the sample count, mean, max and percentiles in seconds
+
+    """
+    r = _redis()
+    report = {}
+    for member in sorted(r.smembers(STAGE_INDEX_KEY)):
+        name, stage = member.decode('utf-8').split('::', 1)
+        if pipeline and name != pipeline:
+            continue
+        samples = sorted(
+            float(s) for s in r.lrange(_key(name, stage), 0, -1))
+        if not samples:
+            continue
+        stats = {
+            'count': len(samples),
+            'mean': sum(samples) / len(samples),
+            'max': samples[-1]}
+        for pct in PERCENTILES:
+            stats['p{}'.format(pct)] = percentile(samples, pct)
+        report.setdefault(name, {})[stage] = stats
+    return report
+
+
+def reset_timings(pipeline=None):
+    """Clear recorded timings, for the named pipeline or all if None"""
+    r = _redis()
+    for member in r.smembers(STAGE_INDEX_KEY):
+        name, stage = member.decode('utf-8').split('::', 1)
+        if pipeline and name != pipeline:
+            continue
+        r.delete(_key(name, stage))
+        r.srem(STAGE_INDEX_KEY, member)
@@ -12,19 +12,27 @@ from functools import wraps
 import json
 from traceback import format_exc
 
+from celery import chord
 from celery.utils.log import get_task_logger
 from flask import current_app
 import redis
-from requests import Request, Session, post
+from requests import Request, Session
 from requests.exceptions import RequestException
-from sqlalchemy import and_
 
 from .database import db
 from .factories.app import create_app
 from .factories.celery import create_celery
-from .models.communication import Communication
-from .models.communication_request import queue_outstanding_messages
+from .models.communication import Communication, send_communications
+from .models.communication_request import (
+    queue_outstanding_messages,
+    queue_outstanding_messages_batch,
+)
 from .models.observation import Observation
+from .models.patient_batch import (
+    PatientBatchScheduler,
+    job_kind,
+    timed_batch,
+)
 from .models.qb_status import QB_Status
 from .models.qb_timeline import invalidate_users_QBT, update_users_QBT
 from .models.reporting import (
@@ -33,16 +41,17 @@ from .models.reporting import (
     research_report,
 )
 from .models.research_study import ResearchStudy
-from .models.role import ROLE, Role
 from .models.scheduled_job import check_active, update_job_status
 from .models.tou import update_tous
-from .models.user import User, UserRoles
+from .models.user import User
+from .sdc_client import SDCClient
 
 # To debug, stop the celeryd running out of /etc/init, start in console:
 #   celery worker -A portal.celery_worker.celery --loglevel=debug
 # or for tasks in the low_priority queue:
 #   celery worker -A portal.celery_worker.celery -Q low_priority \
 #       --loglevel=debug
+# (likewise, -Q post_submission for QuestionnaireResponse processing)
 #
 # Import rdb and use like pdb:
 #   from celery.contrib import rdb
@@ -53,6 +62,7 @@ logger = get_task_logger(__name__)
 
 celery = create_celery(create_app())
 LOW_PRIORITY = 'low_priority'
+POST_SUBMISSION = 'post_submission'
 
 
 def scheduled_task(func):
@@ -115,6 +125,54 @@ def research_report_task(self, **kwargs):
     return research_report(**kwargs)
 
 
+@celery.task(bind=True, track_started=True, queue=LOW_PRIORITY)
+def bulk_export_task(self, **kwargs):
+    """Launch parallel chunk tasks for a bulk export
+
+    The task is replaced by a chord of ``export_chunk_task`` calls, the
+    manifest from ``export_manifest_task`` becoming this task's result.
+
+    """
+    from .models.bulk_export import export_chunks, export_manifest
+    logger.debug("launch bulk export task: %s", self.request.id)
+    chunks = export_chunks(
+        acting_user_id=kwargs['acting_user_id'],
+        resource_types=kwargs['resource_types'],
+        since=kwargs['since'],
+        export_id=kwargs['export_id'])
+    manifest_kwargs = {
+        k: kwargs[k] for k in (
+            'export_id', 'acting_user_id', 'request_url',
+            'transaction_time', 'lock_key')}
+    if not chunks:
+        return export_manifest(chunk_results=[], **manifest_kwargs)
+
+    self.replace(chord(
+        [export_chunk_task.s(**chunk) for chunk in chunks],
+        export_manifest_task.s(**manifest_kwargs)))
+
+
+@celery.task(queue=LOW_PRIORITY)
+def export_chunk_task(**kwargs):
+    from .models.bulk_export import write_chunk
+    return write_chunk(**kwargs)
+
+
+@celery.task(queue=LOW_PRIORITY)
+def export_manifest_task(chunk_results, **kwargs):
+    from .models.bulk_export import export_manifest
+    return export_manifest(chunk_results=chunk_results, **kwargs)
+
+
+@celery.task(queue=LOW_PRIORITY)
+@scheduled_task
+def purge_exports_task(**kwargs):
+    """Remove expired bulk export files; see ``bulk_export.purge_exports``"""
+    from .models.bulk_export import purge_exports
+    purged = purge_exports()
+    return "Purged {} expired exports".format(len(purged))
+
+
 @celery.task(name="tasks.post_request", bind=True)
 def post_request(self, url, data, timeout=10, retries=3):
     """Wrap requests.post for asynchronous posts - includes timeout & retry"""
@@ -146,6 +204,22 @@ def post_request(self, url, data, timeout=10, retries=3):
         logger.error("Unexpected exception on {} : {}".format(url, exc))
 
 
+@celery.task(name="tasks.refresh_remote_content_task", queue=LOW_PRIORITY)
+def refresh_remote_content_task(url, locale_code):
+    """Revalidate stale remote content, see `app_text.cached_request()`"""
+    from .cache import cache
+    from .models.app_text import (
+        content_revalidation_key,
+        refresh_remote_content,
+    )
+    try:
+        refresh_remote_content(url, locale_code)
+    except RequestException as exc:
+        logger.warning("failed to refresh content {}: {}".format(url, exc))
+    finally:
+        cache.delete(content_revalidation_key(url, locale_code))
+
+
 @celery.task
 @scheduled_task
 def test(**kwargs):
@@ -168,14 +242,15 @@ def cache_assessment_status(**kwargs):
     stale cache.  Expected to be called as a scheduled job.
 
     """
-    update_patient_loop(update_cache=True, queue_messages=False, as_task=True)
+    return update_patient_loop(
+        update_cache=True, queue_messages=False, as_task=True)
 
 
 @celery.task(queue=LOW_PRIORITY)
 @scheduled_task
 def prepare_communications(**kwargs):
     """Move any ready communications into prepared state """
-    update_patient_loop(
+    return update_patient_loop(
         update_cache=False, queue_messages=True, as_task=True)
 
 
@@ -183,57 +258,69 @@ def update_patient_loop(
         update_cache=True, queue_messages=True, as_task=False):
     """Function to loop over valid patients and update as per settings
 
+    Patients are streamed in batches by the ``PatientBatchScheduler``,
+    skipping any still in flight from an overlapping run of the same kind.
+
     Typically called as a scheduled_job - also directly from tests
+
+    :returns: summary of batches queued, for the job status
     """
-    patient_role_id = Role.query.filter(
-        Role.name == ROLE.PATIENT.value).with_entities(Role.id).first()[0]
-    valid_patients = User.query.join(UserRoles).filter(and_(
-        User.id == UserRoles.user_id,
-        User.deleted_id.is_(None),
-        UserRoles.role_id == patient_role_id)).with_entities(User.id)
-
-    patients = [r[0] for r in valid_patients.all()]
-    j = 0
-    batchsize = current_app.config['UPDATE_PATIENT_TASK_BATCH_SIZE']
-
-    while True:
-        sublist = patients[j:j+batchsize]
-        if not sublist:
-            break
+    scheduler = PatientBatchScheduler(
+        kind=job_kind(update_cache, queue_messages))
+    run_id = scheduler.start_run()
+    batch_count, patient_count = 0, 0
+    for sublist, claimed_at in scheduler.batches():
         logger.debug("Sending sublist {} to update_patients".format(sublist))
-        j += batchsize
+        batch_count += 1
+        patient_count += len(sublist)
+        scheduler.record_progress(queued=len(sublist))
         kwargs = {
             'patient_list': sublist, 'update_cache': update_cache,
-            'queue_messages': queue_messages}
+            'queue_messages': queue_messages, 'run_id': run_id,
+            'claimed_at': claimed_at}
         if as_task:
             update_patients_task.apply_async(priority=9, kwargs=kwargs)
         else:
             update_patients(**kwargs)
 
+    skipped = scheduler.progress().get('skipped', 0)
+    return "queued {} patients in {} batches; {} skipped as in flight".format(
+        patient_count, batch_count, skipped)
+
 
 @celery.task(name="tasks.update_patients_task", queue=LOW_PRIORITY)
-def update_patients_task(patient_list, update_cache, queue_messages):
+def update_patients_task(
+        patient_list, update_cache, queue_messages, run_id=None,
+        claimed_at=None):
     """Task form - wraps call to testable function `update_patients` """
-    update_patients(patient_list, update_cache, queue_messages)
-
-
-def update_patients(patient_list, update_cache, queue_messages):
-    now = datetime.utcnow()
-    for user_id in patient_list:
-        user = User.query.get(user_id)
-        for research_study_id in ResearchStudy.assigned_to(user):
-            if update_cache:
-                update_users_QBT(user_id, research_study_id)
-            if queue_messages:
-                qbstatus = QB_Status(user, research_study_id, now)
-                qbd = qbstatus.current_qbd()
-                if qbd:
-                    queue_outstanding_messages(
-                        user=user,
-                        questionnaire_bank=qbd.questionnaire_bank,
-                        iteration_count=qbd.iteration)
-
-            db.session.commit()
+    update_patients(
+        patient_list, update_cache, queue_messages, run_id, claimed_at)
+
+
+def update_patients(
+        patient_list, update_cache, queue_messages, run_id=None,
+        claimed_at=None):
+    with timed_batch(
+            patient_list, run_id=run_id,
+            kind=job_kind(update_cache, queue_messages),
+            claimed_at=claimed_at):
+        now = datetime.utcnow()
+        outstanding = []  # (user, qbd, qb_status) to queue messages for
+        for user_id in patient_list:
+            user = User.query.get(user_id)
+            for research_study_id in ResearchStudy.assigned_to(user):
+                if update_cache:
+                    update_users_QBT(user_id, research_study_id)
+                if queue_messages:
+                    qbstatus = QB_Status(user, research_study_id, now)
+                    qbd = qbstatus.current_qbd()
+                    if qbd:
+                        outstanding.append((user, qbd, qbstatus))
+
+                db.session.commit()
+
+        if outstanding:
+            queue_outstanding_messages_batch(outstanding)
 
 
 @celery.task(queue=LOW_PRIORITY)
@@ -247,16 +334,22 @@ def send_messages(as_task=False):
     """Function to send all queued messages
 
     Typically called as a scheduled_job - also directly from tests
+
+    Messages are sent in batches of SEND_COMMUNICATION_BATCH_SIZE, each
+    batch sharing a single SMTP connection.
     """
-    ready = Communication.query.filter(
-        Communication.status == 'preparation').with_entities(Communication.id)
+    ready = [c_id for c_id, in Communication.query.filter(
+        Communication.status == 'preparation').with_entities(
+        Communication.id).order_by(Communication.id)]
 
-    for communication_id in ready:
+    batch_size = current_app.config['SEND_COMMUNICATION_BATCH_SIZE']
+    for i in range(0, len(ready), batch_size):
+        batch = ready[i:i + batch_size]
         if as_task:
-            send_communication_task.apply_async(
-                priority=9, kwargs={'communication_id': communication_id})
+            send_communications_batch_task.apply_async(
+                priority=9, kwargs={'communication_ids': batch})
         else:
-            send_communication(communication_id)
+            send_communications_batch(batch)
 
 
 @celery.task(name="tasks.send_communication_task", queue=LOW_PRIORITY)
@@ -270,6 +363,26 @@ def send_communication(communication_id):
     db.session.commit()
 
 
+@celery.task(
+    name="tasks.send_communications_batch_task", queue=LOW_PRIORITY)
+def send_communications_batch_task(communication_ids):
+    send_communications_batch(communication_ids)
+
+
+def send_communications_batch(communication_ids):
+    """Send the batch of communications over a single SMTP connection"""
+    communications = Communication.query.filter(
+        Communication.id.in_(communication_ids)).filter(
+        Communication.status == 'preparation').order_by(
+        Communication.id).all()
+    failures = send_communications(communications)
+    db.session.commit()
+    for communication, exc in failures:
+        logger.error(
+            "send_communications_batch failed on %d: %s",
+            communication.id, exc)
+
+
 def send_user_messages(user, force_update=False):
     """Send queued messages to only given user (if found)
 
@@ -359,32 +472,83 @@ def celery_beat_health_check(**kwargs):
     )
 
 
+@celery.task(name="tasks.post_submission_task", queue=POST_SUBMISSION)
+def post_submission_task(
+        acting_user_id, version, questionnaire_response_ids=None,
+        questionnaire_response_id=None):
+    """Task wrapper for the QuestionnaireResponse post submission pipeline
+
+    Tasks queued prior to batch support name a single
+    ``questionnaire_response_id``; accepted for compatibility.
+
+    """
+    from .models.post_submission import process_submissions
+    if questionnaire_response_ids is None:
+        questionnaire_response_ids = [questionnaire_response_id]
+    process_submissions(
+        questionnaire_response_ids=questionnaire_response_ids,
+        acting_user_id=acting_user_id,
+        version=version)
+
+
+SDC_PENDING_KEY = 'sdc_extract_pending'
+
+
 @celery.task(name="tasks.extract_observations_task", queue=LOW_PRIORITY)
 def extract_observations_task(questionnaire_response_id):
-    """Task wrapper for extract_observations"""
-    extract_observations(questionnaire_response_id)
+    """Task wrapper for extract_pending_observations"""
+    extract_pending_observations(questionnaire_response_id)
+
+
+def extract_pending_observations(questionnaire_response_id):
+    """Extract observations for the QNR, in bulk if so configured
+
+    With SDC_BULK_EXTRACT configured, the id joins the pending list, and
+    whatever backlog of pending QNRs is found is extracted in a single
+    SDC request.  Should another worker have claimed the id in the
+    meantime, there's nothing left to do.
+
+    """
+    if not current_app.config['SDC_BULK_EXTRACT']:
+        extract_observations(questionnaire_response_id)
+        return
+
+    rs = redis.StrictRedis.from_url(current_app.config['REDIS_URL'])
+    rs.rpush(SDC_PENDING_KEY, questionnaire_response_id)
+    pipe = rs.pipeline()
+    batch_size = current_app.config['SDC_BULK_SIZE']
+    pipe.lrange(SDC_PENDING_KEY, 0, batch_size - 1)
+    pipe.ltrim(SDC_PENDING_KEY, batch_size, -1)
+    pending = [int(qnr_id) for qnr_id in pipe.execute()[0]]
+    if len(pending) > 1:
+        extract_observations_batch(pending)
+    elif pending:
+        extract_observations(pending[0])
 
 
 def extract_observations(questionnaire_response_id):
     """Format and submit QuestionnaireResponse to SDC service; store returned Observations"""
     from .models.questionnaire_response import QuestionnaireResponse
     from .trigger_states.empro_states import (
+        abandon_trigger_critical_section,
         enter_user_trigger_critical_section,
         evaluate_triggers,
         fire_trigger_events,
     )
+    from .trigger_states.models import DomainScore
     qnr = QuestionnaireResponse.query.get(questionnaire_response_id)
+    subject_id = qnr.subject_id
 
-    enter_user_trigger_critical_section(user_id=qnr.subject_id)
-
-    qnr_json = qnr.as_sdc_fhir()
-
-    SDC_BASE_URL = current_app.config['SDC_BASE_URL']
-    response = post(f"{SDC_BASE_URL}/$extract", json=qnr_json)
-    response.raise_for_status()
-
-    Observation.parse_obs_bundle(response.json())
-    db.session.commit()
+    enter_user_trigger_critical_section(user_id=subject_id)
+    try:
+        obs_bundle = SDCClient().extract(qnr.as_sdc_fhir())
+        Observation.parse_obs_bundle(obs_bundle)
+        DomainScore.record(qnr, obs_bundle)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        abandon_trigger_critical_section(subject_id)
+        raise
 
     # As scoring is complete, pass baton to evaluation process
     # which also frees the locked critical section on completion
@@ -394,6 +558,97 @@ def extract_observations(questionnaire_response_id):
     fire_trigger_events()
 
 
+def extract_observations_batch(questionnaire_response_ids):
+    """Bulk form of ``extract_observations``; one SDC request for all QNRs
+
+    The given ids were claimed from the shared pending list, so each must
+    be seen through here, as no other task will.  As each QNR holds its
+    subject's trigger critical section until evaluated, the bulk request
+    includes only the first QNR per subject; any others are extracted
+    singly afterwards.  Should the bulk request fail, its QNRs are also
+    extracted singly, with their subjects' trigger states restored.
+
+    :raises: the first exception raised for any QNR, once all have been
+      attempted
+
+    """
+    from .models.questionnaire_response import QuestionnaireResponse
+    from .trigger_states.empro_states import (
+        abandon_trigger_critical_section,
+        enter_user_trigger_critical_section,
+        evaluate_triggers,
+        fire_trigger_events,
+    )
+    from .trigger_states.models import DomainScore
+    qnrs = QuestionnaireResponse.query.filter(
+        QuestionnaireResponse.id.in_(questionnaire_response_ids)).order_by(
+        QuestionnaireResponse.id).all()
+
+    bulk, singly, subject_ids = [], [], set()
+    for qnr in qnrs:
+        if qnr.subject_id in subject_ids:
+            singly.append(qnr.id)
+        else:
+            subject_ids.add(qnr.subject_id)
+            bulk.append((qnr.id, qnr.subject_id))
+
+    errors = []
+    entered = []
+    for qnr_id, subject_id in bulk:
+        try:
+            enter_user_trigger_critical_section(user_id=subject_id)
+        except Exception as exc:
+            # as would extracting singly; no point retrying
+            logger.exception("can't process trigger state for QNR %d", qnr_id)
+            db.session.rollback()
+            errors.append(exc)
+            continue
+        entered.append((qnr_id, subject_id))
+
+    extracted = []
+    try:
+        if entered:
+            extracted = QuestionnaireResponse.query.filter(
+                QuestionnaireResponse.id.in_(
+                    [qnr_id for qnr_id, _ in entered])).order_by(
+                QuestionnaireResponse.id).all()
+            obs_bundles = SDCClient().extract_bundle(
+                [qnr.as_sdc_fhir() for qnr in extracted])
+            for qnr, obs_bundle in zip(extracted, obs_bundles):
+                Observation.parse_obs_bundle(obs_bundle)
+                DomainScore.record(qnr, obs_bundle)
+            db.session.commit()
+    except Exception:
+        logger.exception(
+            "bulk SDC extract of %d QNRs failed; extracting singly",
+            len(entered))
+        db.session.rollback()
+        for _, subject_id in entered:
+            abandon_trigger_critical_section(subject_id)
+        singly = [qnr_id for qnr_id, _ in entered] + singly
+        extracted = []
+
+    for qnr in extracted:
+        try:
+            # frees the subject's critical section on completion
+            evaluate_triggers(qnr)
+        except Exception as exc:
+            db.session.rollback()
+            errors.append(exc)
+    if extracted:
+        fire_trigger_events()
+
+    for qnr_id in singly:
+        try:
+            extract_observations(qnr_id)
+        except Exception as exc:
+            logger.exception("failed to extract QNR %d", qnr_id)
+            errors.append(exc)
+
+    if errors:
+        raise errors[0]
+
+
 @celery.task(queue=LOW_PRIORITY)
 @scheduled_task
 def process_triggers_task(**kwargs):
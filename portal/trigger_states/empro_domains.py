@@ -4,6 +4,7 @@ from collections import defaultdict
 from ..date_tools import FHIR_datetime
 from ..models.observation import Observation
 from ..models.questionnaire_response import first_last_like_qnr
+from .models import OBSERVATION_DOMAIN_SYSTEM, DomainScore
 
 # TODO extract from EMPRO Questionnaire - hardcoded for time being
 EMPRO_DOMAINS = (
@@ -93,6 +94,7 @@ class DomainManifold(object):
         self.cur_qnr = qnr
         self.initial_qnr, self.prev_qnr = first_last_like_qnr(qnr)
 
+        qnr_ids = dict()
         for timepoint in 'cur', 'initial', 'prev':
             process_qnr = getattr(self, f"{timepoint}_qnr")
             if process_qnr:
@@ -101,32 +103,48 @@ class DomainManifold(object):
                     getattr(process_qnr, 'id', None))
                 if not qnr_id:
                     raise ValueError(f"Unable to determine qnr_id from {process_qnr}")
-
-                obs = Observation.query.filter(
-                    Observation.derived_from == str(qnr_id)
-                )
-                # Extract useful bits for trigger calc from observations
-                # format as dictionary, keyed by `domain`.  Each domain
-                # will contain a dictionary keyed by `link_id`, with a value
-                # tuple (score, severity)
-                results = dict()
-                for ob in obs:
-                    # acquire the domain
-                    for code in ob.codeable_concept.codings:
-                        if code.system == 'http://us.truenth.org/observation':
-                            domain = code.code
-                    if not domain:
-                        raise ValueError(
-                            f"'domain' not found in observation {ob.id}")
-                    link_id, score = ob.value_coding.code.rsplit('.', 1)
-                    # severity is only present on penultimate, ultimate
-                    severity = None
-                    if ob.value_coding.extension_id:
-                        severity = ob.value_coding.extension.code
-                    if domain not in results:
-                        results[domain] = defaultdict(dict)
-                    results[domain][link_id] = (int(score), severity)
-                setattr(self, f"{timepoint}_obs", results)
+                qnr_ids[timepoint] = qnr_id
+
+        # Scores recorded at ingest cover all but QNRs extracted prior
+        # to the score table; parse Observations for any such QNR
+        scores = DomainScore.scores_by_qnr(qnr_ids.values())
+        for timepoint, qnr_id in qnr_ids.items():
+            results = scores.get(qnr_id)
+            if results is None:
+                results = self.scores_from_observations(qnr_id)
+            setattr(self, f"{timepoint}_obs", results)
+
+    @staticmethod
+    def scores_from_observations(qnr_id):
+        """Extract useful bits for trigger calc from the QNR's observations
+
+        :returns: dictionary, keyed by `domain`.  Each domain will contain
+          a dictionary keyed by `link_id`, with a value tuple (score,
+          severity)
+
+        """
+        obs = Observation.query.filter(
+            Observation.derived_from == str(qnr_id)
+        )
+        results = dict()
+        for ob in obs:
+            # acquire the domain
+            domain = None
+            for code in ob.codeable_concept.codings:
+                if code.system == OBSERVATION_DOMAIN_SYSTEM:
+                    domain = code.code
+            if not domain:
+                raise ValueError(
+                    f"'domain' not found in observation {ob.id}")
+            link_id, score = ob.value_coding.code.rsplit('.', 1)
+            # severity is only present on penultimate, ultimate
+            severity = None
+            if ob.value_coding.extension_id:
+                severity = ob.value_coding.extension.code
+            if domain not in results:
+                results[domain] = defaultdict(dict)
+            results[domain][link_id] = (int(score), severity)
+        return results
 
     def eval_triggers(self):
         triggers = dict()
@@ -1,5 +1,4 @@
 """Module to encapsulate EMPRO messaging details"""
-from datetime import datetime
 from flask import current_app, url_for
 from flask_babel import gettext as _
 
@@ -8,17 +7,14 @@ from portal.models.communication import EmailMessage, load_template_args
 from portal.models.organization import UserOrganization
 from portal.models.role import ROLE, Role
 from portal.models.user import User, UserRoles
-from portal.models.qb_status import QB_Status
+from portal.models.qb_status import qb_status
 
 
 def patient_email(patient, soft_triggers, hard_triggers):
     """Prepare email for patient, depending on trigger status"""
 
     # If the user has a pending questionnaire bank, include for due date
-    qstats = QB_Status(
-        patient,
-        research_study_id=1,
-        as_of_date=datetime.utcnow())
+    qstats = qb_status(patient, research_study_id=1)
     qbd = qstats.current_qbd()
     if qbd:
         qb_id, qb_iteration = qbd.qb_id, qbd.iteration
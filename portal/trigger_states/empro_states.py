@@ -6,6 +6,8 @@ See also:
 import copy
 from datetime import datetime
 from flask import current_app
+import redis
+import time
 from smtplib import SMTPRecipientsRefused
 from statemachine import StateMachine, State
 from statemachine.exceptions import TransitionNotAllowed
@@ -17,7 +19,7 @@ from ..database import db
 from ..date_tools import FHIR_datetime
 from ..models.app_text import MailResource, app_text
 from ..models.communication import load_template_args
-from ..models.message import EmailMessage
+from ..models.message import EmailMessage, send_message_batch
 from ..models.qb_status import QB_Status
 from ..models.qbd import QBD
 from ..models.questionnaire_bank import QuestionnaireBank
@@ -26,6 +28,9 @@ from ..timeout_lock import LockTimeout, TimeoutLock
 
 EMPRO_STUDY_ID = 1
 EMPRO_LOCK_KEY = "empro-trigger-state-lock-{user_id}"
+TRIGGER_CLAIMS_KEY = 'fire_trigger_events_claims'  # sorted set, by claim time
+
+_claims_redis = None  # created on first use
 
 
 class EMPRO_state(StateMachine):
@@ -130,6 +135,68 @@ def users_trigger_state(user_id):
     return ts
 
 
+def await_trigger_state(user_id, pending_state, timeout):
+    """Wait for the user's trigger state to move on from pending_state
+
+    Blocks on notification of the user's trigger state changes, rather
+    than polling.
+
+    :param pending_state: the state to wait out, typically ``inprocess``
+    :param timeout: maximum seconds to wait
+    :returns: the user's TriggerState, as with ``users_trigger_state()``,
+      possibly still in the pending state should the timeout expire
+
+    """
+    from ..models.resource_version import subscribe  # avoid cycle
+
+    deadline = time.monotonic() + timeout
+    # subscribe before checking, lest a change slip in between
+    pubsub = subscribe('trigger_state', user_id)
+    try:
+        ts = users_trigger_state(user_id)
+        while ts.state == pending_state:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            # don't hold a transaction open while waiting
+            db.session.rollback()
+            if pubsub.get_message(timeout=remaining):
+                ts = users_trigger_state(user_id)
+        return ts
+    finally:
+        pubsub.close()
+
+
+def release_trigger_critical_section(user_id):
+    """Free the user's trigger critical section, notifying any waiting"""
+    from ..models.resource_version import advance_versions  # avoid cycle
+
+    critical_section = TimeoutLock(key=EMPRO_LOCK_KEY.format(user_id=user_id))
+    critical_section.__exit__(None, None, None)
+    advance_versions([('trigger_state', user_id)])
+
+
+def abandon_trigger_critical_section(user_id):
+    """Undo ``enter_user_trigger_critical_section()`` on failure to extract
+
+    Returns the user's trigger state from ``inprocess`` to ``due``, so
+    extraction may be attempted again, and frees the critical section.
+
+    """
+    try:
+        ts = TriggerState.query.filter(
+            TriggerState.user_id == user_id).order_by(
+            TriggerState.timestamp.desc()).first()
+        if ts and ts.state == 'inprocess':
+            current_app.logger.debug(
+                f"abandon 'inprocess' trigger_state for {user_id}; "
+                "record state change to 'due'")
+            ts.state = 'due'
+            ts.insert(from_copy=True)
+    finally:
+        release_trigger_critical_section(user_id)
+
+
 def initiate_trigger(user_id):
     """Call when EMPRO becomes available for user or next is due"""
     ts = users_trigger_state(user_id)
@@ -260,9 +327,118 @@ def evaluate_triggers(qnr, override_state=False):
 
     finally:
         # All done, release semaphore for this user
-        critical_section = TimeoutLock(key=EMPRO_LOCK_KEY.format(
-            user_id=qnr.subject_id))
-        critical_section.__exit__(None, None, None)
+        release_trigger_critical_section(qnr.subject_id)
+
+
+def claims_redis():
+    """Returns the redis client holding trigger state claims"""
+    global _claims_redis
+    if _claims_redis is None:
+        _claims_redis = redis.StrictRedis.from_url(
+            current_app.config['REDIS_URL'])
+    return _claims_redis
+
+
+def claim_trigger_states(states, after_id, batch_size):
+    """Claim a batch of trigger state rows for processing
+
+    Claims are recorded in redis, in a sorted set scored by claim time,
+    so they hold across the commits made while processing a batch (such
+    as by timeline updates or auditable events), unlike row locks.
+    Concurrent workers therefore each claim distinct rows, rather than
+    repeating the work, and emails, of another.  Claims older than
+    ``TRIGGER_EVENT_CLAIM_SECONDS``, such as those of a killed worker,
+    lapse.  Release claims on completion via ``release_trigger_states()``.
+
+    :param states: trigger states of interest, i.e. ('processed',)
+    :param after_id: keyset cursor; only rows with a greater id are claimed
+    :param batch_size: maximum number of rows to claim
+    :returns: list of claimed TriggerState rows, ordered by id, still in
+      one of the given states once claimed
+
+    """
+    timeout = current_app.config['TRIGGER_EVENT_CLAIM_SECONDS']
+    query = TriggerState.query.filter(
+        TriggerState.state.in_(states)).order_by(TriggerState.id)
+    while True:
+        candidates = [ts_id for ts_id, in query.filter(
+            TriggerState.id > after_id).with_entities(
+            TriggerState.id).limit(batch_size)]
+        if not candidates:
+            return []
+        after_id = candidates[-1]
+
+        now = time.time()
+        pipe = claims_redis().pipeline()
+        pipe.zremrangebyscore(TRIGGER_CLAIMS_KEY, '-inf', now - timeout)
+        for ts_id in candidates:
+            pipe.zadd(TRIGGER_CLAIMS_KEY, {ts_id: now}, nx=True)
+        pipe.expire(TRIGGER_CLAIMS_KEY, timeout)
+        added = pipe.execute()[1:-1]
+        claimed_ids = [
+            ts_id for ts_id, new in zip(candidates, added) if new]
+        if not claimed_ids:
+            continue
+
+        # another worker may have completed a row prior to our claim
+        claimed = TriggerState.query.filter(
+            TriggerState.id.in_(claimed_ids)).filter(
+            TriggerState.state.in_(states)).order_by(
+            TriggerState.id).populate_existing().all()
+        release_trigger_states(
+            set(claimed_ids) - {ts.id for ts in claimed})
+        if claimed:
+            return claimed
+
+
+def release_trigger_states(ts_ids):
+    """Release claims from ``claim_trigger_states()``, once committed"""
+    ts_ids = list(ts_ids)
+    if ts_ids:
+        claims_redis().zrem(TRIGGER_CLAIMS_KEY, *ts_ids)
+
+
+def send_n_report(pending):
+    """Send emails as a batch, append success/fail w/ context to records
+
+    :param pending: list of (email_message, context, record) tuples, where
+      record is the list to which the result for email_message is appended
+    :returns: list of (record, exception) for any email failing with an
+      unexpected exception, i.e. not a refused recipient.  No result is
+      appended for such emails; callers should leave the respective rows
+      unchanged, for a subsequent run to retry.
+
+    """
+    timestamp = FHIR_datetime.now()
+    results = send_message_batch([em for em, _, _ in pending])
+    sent, unexpected = [], []
+    for (em, context, record), exc in zip(pending, results):
+        result = {'context': context, 'timestamp': timestamp}
+        if exc is None:
+            db.session.add(em)
+            sent.append((result, em))
+        elif isinstance(exc, SMTPRecipientsRefused):
+            msg = ("Error sending trigger email to {}: "
+                   "{}".format(em.recipients, exc))
+            current_app.logger.error(msg)
+            result['error'] = msg
+        else:
+            current_app.logger.error(
+                "Error sending trigger email to %s: %s", em.recipients, exc)
+            unexpected.append((record, exc))
+            continue
+        record.append(result)
+
+    # obtain ids for the sent messages
+    db.session.flush()
+    for result, em in sent:
+        result['email_message_id'] = em.id
+    return unexpected
+
+
+def failed_to_send(record, unexpected):
+    """True if any email for the record is in ``send_n_report()`` failures"""
+    return any(record is failed for failed, _ in unexpected)
 
 
 def fire_trigger_events():
@@ -277,83 +453,144 @@ def fire_trigger_events():
     is transitioned to 'triggered' or should no further action be necessary,
     'resolved'.
 
+    Rows are claimed in batches of ``TRIGGER_EVENT_BATCH_SIZE``, see
+    ``claim_trigger_states()``, allowing any number of concurrent workers.
+    Emails for each batch are sent over a single SMTP connection.  A row
+    failing to prepare is logged and left for the next run, without
+    holding up the rest.
+
     """
-    def send_n_report(em, context, record):
-        """Send email, append success/fail w/ context to record"""
-        result = {'context': context, 'timestamp': FHIR_datetime.now()}
+    batch_size = current_app.config['TRIGGER_EVENT_BATCH_SIZE']
+
+    # seek out any pending "processed" work, i.e. triggers recently
+    # evaluated
+    last_id = 0
+    while True:
+        batch = claim_trigger_states(('processed',), last_id, batch_size)
+        if not batch:
+            break
+        last_id = batch[-1].id
         try:
-            em.send_message()
-            db.session.add(em)
+            unexpected = fire_batch(batch)
+            # commit records those sent prior to raising any unexpected
+            # failure, before the claims are released
             db.session.commit()
-            result['email_message_id'] = em.id
-            record.append(result)
-        except SMTPRecipientsRefused as e:
-            msg = ("Error sending trigger email to {}: "
-                   "{}".format(em.recipients, e))
-            current_app.logger.error(msg)
-            result['error'] = msg
-            record.append(result)
-
-    # as a job, make sure only running one concurrent instance
-    NEVER_WAIT = 0
-    with TimeoutLock(key='fire_trigger_events', timeout=NEVER_WAIT):
-        # seek out any pending "processed" work, i.e. triggers recently
-        # evaluated
-        for ts in TriggerState.query.filter(TriggerState.state == 'processed'):
-            # necessary to make deep copy in order to update DB JSON
-            triggers = copy.deepcopy(ts.triggers)
-            triggers['action_state'] = 'not applicable'
-            triggers['actions'] = dict()
-            triggers['actions']['email'] = list()
-
-            # Emails generated for both patient and clinician/staff based
-            # on hard triggers.  Patient gets 'thank you' email regardless.
-            hard_triggers = ts.hard_trigger_list()
-            soft_triggers = ts.soft_trigger_list()
-            pending_emails = []
+        finally:
+            release_trigger_states(ts.id for ts in batch)
+        if unexpected:
+            raise unexpected[0][1]
+
+    # Now seek out any pending actions, such as reminders to staff
+    now = datetime.utcnow()
+    last_id = 0
+    while True:
+        batch = claim_trigger_states(
+            ('triggered', 'resolved'), last_id, batch_size)
+        if not batch:
+            break
+        last_id = batch[-1].id
+        try:
+            unexpected = remind_batch(batch, now)
+            db.session.commit()
+        finally:
+            release_trigger_states(ts.id for ts in batch)
+        if unexpected:
+            raise unexpected[0][1]
+
+
+def failed_to_prepare(ts, context, exc):
+    """Log failure preparing the row's emails, recording in its triggers
+
+    The row is otherwise left unchanged, for a subsequent run to retry.
+
+    """
+    msg = "Error preparing {} for {}: {}".format(context, ts, exc)
+    current_app.logger.exception(msg)
+    triggers = copy.deepcopy(ts.triggers)
+    triggers['actions'] = {'email': [{
+        'context': context,
+        'timestamp': FHIR_datetime.now(),
+        'error': msg}]}
+    ts.triggers = triggers
+
+
+def fire_batch(batch):
+    """Send initial emails for a batch of claimed 'processed' rows
+
+    :returns: unexpected send failures, as from ``send_n_report()``
+
+    """
+    pending_emails, fired = [], []
+    for ts in batch:
+        # necessary to make deep copy in order to update DB JSON
+        triggers = copy.deepcopy(ts.triggers)
+        triggers['action_state'] = 'not applicable'
+        triggers['actions'] = dict()
+        triggers['actions']['email'] = list()
+        record = triggers['actions']['email']
+
+        # Emails generated for both patient and clinician/staff based
+        # on hard triggers.  Patient gets 'thank you' email regardless.
+        hard_triggers = ts.hard_trigger_list()
+        soft_triggers = ts.soft_trigger_list()
+        try:
             patient = User.query.get(ts.user_id)
 
             # Patient always gets mail
-            pending_emails.append((
+            row_emails = [(
                 patient_email(patient, soft_triggers, hard_triggers),
-                "patient thank you"))
+                "patient thank you", record)]
 
             if hard_triggers:
                 triggers['action_state'] = 'required'
 
                 # In the event of hard_triggers, clinicians/staff get mail
                 for msg in staff_emails(patient, hard_triggers, True):
-                    pending_emails.append((msg, "initial staff alert"))
+                    row_emails.append((msg, "initial staff alert", record))
+        except Exception as exc:
+            failed_to_prepare(ts, "trigger emails", exc)
+            continue
+        pending_emails.extend(row_emails)
+        fired.append((ts, triggers, hard_triggers))
+
+    unexpected = send_n_report(pending_emails)
+
+    for ts, triggers, hard_triggers in fired:
+        if failed_to_send(triggers['actions']['email'], unexpected):
+            # leave 'processed' for the next run to retry
+            continue
+
+        # Change state, as this row has been processed.
+        ts.triggers = triggers
+        sm = EMPRO_state(ts)
+        sm.fired_events()
 
-            for em, context in pending_emails:
-                send_n_report(em, context, triggers['actions']['email'])
+        # Without hard triggers, no further action is necessary
+        if not hard_triggers:
+            sm.resolve()
+    return unexpected
 
-            # Change state, as this row has been processed.
-            ts.triggers = triggers
-            sm = EMPRO_state(ts)
-            sm.fired_events()
 
-            # Without hard triggers, no further action is necessary
-            if not hard_triggers:
-                sm.resolve()
+def remind_batch(batch, now):
+    """Send any due staff reminders for a batch of claimed rows
 
-        db.session.commit()
+    :returns: unexpected send failures, as from ``send_n_report()``
 
-        # Now seek out any pending actions, such as reminders to staff
-        now = datetime.utcnow()
-        for ts in TriggerState.query.filter(
-                TriggerState.state.in_(('triggered', 'resolved'))):
-            # Need to consider state == resolved, as the user may
-            # have a newer EMPRO due, but the previous still hasn't
-            # received a post intervention QB from staff, noted by
-            # the action_state:
-            if (
-                    'action_state' not in ts.triggers or
-                    ts.triggers['action_state'] in (
-                    'completed', 'missed', 'not applicable',
-                    'withdrawn')):
-                continue
+    """
+    pending_emails, reminded = [], []
+    for ts in batch:
+        # Need to consider state == resolved, as the user may
+        # have a newer EMPRO due, but the previous still hasn't
+        # received a post intervention QB from staff, noted by
+        # the action_state:
+        if (
+                'action_state' not in ts.triggers or
+                ts.triggers['action_state'] in (
+                'completed', 'missed', 'not applicable',
+                'withdrawn')):
+            continue
 
+        try:
             if ts.triggers['action_state'] not in ('required', 'overdue'):
                 raise ValueError(
                     f"Invalid action_state {ts.triggers['action_state']} "
@@ -364,29 +601,40 @@ def fire_trigger_events():
             # Withdrawn users should never receive reminders, nor staff
             # about them.
             qb_status = QB_Status(
-                user=patient, research_study_id=EMPRO_STUDY_ID, as_of_date=now)
+                user=patient, research_study_id=EMPRO_STUDY_ID,
+                as_of_date=now)
             if qb_status.withdrawn_by(now):
                 triggers = copy.deepcopy(ts.triggers)
                 triggers['action_state'] = 'withdrawn'
                 ts.triggers = triggers
                 continue
 
-            if ts.reminder_due():
-                pending_emails = staff_emails(
-                    patient, ts.hard_trigger_list(), False)
-
-                # necessary to make deep copy in order to update DB JSON
-                triggers = copy.deepcopy(ts.triggers)
-                triggers['action_state'] = 'overdue'
-                for em in pending_emails:
-                    send_n_report(
-                        em, context="reminder staff alert",
-                        record=triggers['actions']['email'])
-
-                # push updated record back into trigger_states
-                ts.triggers = triggers
+            if not ts.reminder_due():
+                continue
 
-        db.session.commit()
+            # necessary to make deep copy in order to update DB JSON
+            triggers = copy.deepcopy(ts.triggers)
+            triggers['action_state'] = 'overdue'
+            row_emails = [
+                (em, "reminder staff alert", triggers['actions']['email'])
+                for em in staff_emails(
+                    patient, ts.hard_trigger_list(), False)]
+        except Exception as exc:
+            # leave the row as is, still due a reminder on the next run
+            current_app.logger.exception(
+                "Error preparing reminder for %s: %s", ts, exc)
+            continue
+        pending_emails.extend(row_emails)
+        reminded.append((ts, triggers))
+
+    unexpected = send_n_report(pending_emails)
+
+    # push updated records back into trigger_states; rows failing
+    # to send are left, still due a reminder on the next run
+    for ts, triggers in reminded:
+        if not failed_to_send(triggers['actions']['email'], unexpected):
+            ts.triggers = triggers
+    return unexpected
 
 
 def empro_staff_qbd_accessor(qnr):
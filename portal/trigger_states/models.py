@@ -1,6 +1,8 @@
+from collections import defaultdict
 from datetime import datetime, timedelta
+from sqlalchemy import event
 from sqlalchemy.dialects.postgresql import ENUM, JSONB
-from sqlalchemy.orm import make_transient
+from sqlalchemy.orm import make_transient, object_session
 
 from ..database import db
 from ..date_tools import FHIR_datetime, weekday_delta
@@ -137,16 +139,143 @@ class TriggerState(db.Model):
             TriggerState.id.desc()).first()
 
 
+@event.listens_for(TriggerState, 'after_insert')
+@event.listens_for(TriggerState, 'after_update')
+def _trigger_state_written(mapper, connection, target):
+    """Notify those awaiting the user's trigger state, once committed"""
+    from ..models.resource_version import mark_modified  # avoid cycle
+    mark_modified(object_session(target), 'trigger_state', target.user_id)
+
+
+OBSERVATION_DOMAIN_SYSTEM = 'http://us.truenth.org/observation'
+
+
+class DomainScore(db.Model):
+    """ORM class for scored EMPRO answers, one row per question
+
+    Written when the SDC Observations for a QuestionnaireResponse are
+    ingested, so trigger evaluation and reporting needn't reload and
+    parse the Observations' codings.
+
+    """
+    __tablename__ = 'empro_domain_scores'
+    __table_args__ = (
+        db.Index(
+            'ix_empro_domain_scores_user_authored', 'user_id', 'authored'),)
+    id = db.Column(db.Integer, primary_key=True)
+    questionnaire_response_id = db.Column(
+        db.ForeignKey('questionnaire_responses.id', ondelete='CASCADE'),
+        nullable=False, index=True)
+    user_id = db.Column(
+        db.ForeignKey('users.id', ondelete='CASCADE'), nullable=False)
+    authored = db.Column(db.DateTime, nullable=False)
+    domain = db.Column(db.Text, nullable=False)
+    link_id = db.Column(db.Text, nullable=False)
+    score = db.Column(db.Integer, nullable=False)
+    severity = db.Column(db.Text)
+
+    def __repr__(self):
+        return (
+            "DomainScore {0.domain} {0.link_id}: {0.score} for "
+            "QNR {0.questionnaire_response_id}".format(self))
+
+    @staticmethod
+    def parse_observation(obs):
+        """Extract (domain, link_id, score, severity) from FHIR Observation
+
+        :returns: tuple of values, or None if the Observation isn't a
+          scored domain answer
+
+        """
+        domain = None
+        for coding in obs.get('code', {}).get('coding', []):
+            if coding.get('system') == OBSERVATION_DOMAIN_SYSTEM:
+                domain = coding['code']
+        value = obs.get('valueCoding')
+        if not (domain and value):
+            return None
+
+        # answer code format: "<link_id>.<score>"
+        link_id, score = value['code'].rsplit('.', 1)
+        # severity is only present on penultimate, ultimate
+        severity = None
+        if value.get('extension'):
+            severity = value['extension'][0]['valueCoding']['code']
+        return domain, link_id, int(score), severity
+
+    @classmethod
+    def record(cls, qnr, obs_bundle):
+        """Persist scores from the SDC Observation bundle for given QNR
+
+        Replaces any scores previously recorded for the QNR, as when
+        re-extracted.  Caller is responsible for committing.
+
+        """
+        authored = qnr.authored
+        rows = []
+        for obs in obs_bundle['entry']:
+            parsed = cls.parse_observation(obs)
+            if not parsed:
+                continue
+            domain, link_id, score, severity = parsed
+            rows.append({
+                'questionnaire_response_id': qnr.id,
+                'user_id': qnr.subject_id,
+                'authored': authored,
+                'domain': domain,
+                'link_id': link_id,
+                'score': score,
+                'severity': severity})
+
+        cls.query.filter(
+            cls.questionnaire_response_id == qnr.id).delete(
+            synchronize_session=False)
+        db.session.bulk_insert_mappings(cls, rows)
+
+    @classmethod
+    def scores_by_qnr(cls, qnr_ids):
+        """Return recorded scores for the given QNRs, in a single query
+
+        :returns: dictionary keyed by qnr_id, with a dictionary keyed by
+          domain for each, containing a dictionary keyed by link_id with
+          value tuple (score, severity).  QNRs without recorded scores
+          are not included.
+
+        """
+        results = {}
+        query = cls.query.filter(
+            cls.questionnaire_response_id.in_(qnr_ids)).with_entities(
+            cls.questionnaire_response_id, cls.domain, cls.link_id,
+            cls.score, cls.severity)
+        for qnr_id, domain, link_id, score, severity in query:
+            results.setdefault(qnr_id, {}).setdefault(
+                domain, defaultdict(dict))[link_id] = (score, severity)
+        return results
+
+    @classmethod
+    def authored_by_qnr(cls, user_id):
+        """Return dictionary of authored datetimes keyed by the user's QNRs"""
+        query = cls.query.filter(cls.user_id == user_id).with_entities(
+            cls.questionnaire_response_id, cls.authored).distinct()
+        return dict(query)
+
+
 class TriggerStatesReporting:
     """Manage reporting details for a given patient"""
     MAX_VISIT = 12
 
     def __init__(self, patient_id):
         self.patient_id = patient_id
-        self.latest_by_visit = dict()
-        for v in range(self.MAX_VISIT):
-            self.latest_by_visit[v] = TriggerState.latest_for_visit(
-                patient_id, v)
+        self.latest_by_visit = dict.fromkeys(range(self.MAX_VISIT))
+        # latest row per visit month, via postgres DISTINCT ON
+        latest = TriggerState.query.filter(
+            TriggerState.user_id == patient_id).filter(
+            TriggerState.visit_month < self.MAX_VISIT).order_by(
+            TriggerState.visit_month, TriggerState.id.desc()).distinct(
+            TriggerState.visit_month)
+        for ts in latest:
+            self.latest_by_visit[ts.visit_month] = ts
+        self.authored_by_qnr = DomainScore.authored_by_qnr(patient_id)
 
     def domains_accessed(self, visit_month):
         """Return list of domains accessed for visit_month
@@ -159,11 +288,11 @@ class TriggerStatesReporting:
         """
         def authored_from_visit(visit_month):
             """Extract authored datetime from given visit month"""
-            if not getattr(
-                    self.latest_by_visit[visit_month],
-                    'triggers',
-                    None):
+            ts = self.latest_by_visit[visit_month]
+            if not getattr(ts, 'triggers', None):
                 return None
+            if ts.questionnaire_response_id in self.authored_by_qnr:
+                return self.authored_by_qnr[ts.questionnaire_response_id]
             authored = self.latest_by_visit[visit_month].triggers.get(
                 "source", {}).get("authored")
             if authored:
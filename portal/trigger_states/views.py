@@ -1,5 +1,5 @@
 from flask import Blueprint, current_app, jsonify, request
-from .empro_states import users_trigger_state
+from .empro_states import await_trigger_state, users_trigger_state
 from .models import TriggerState
 from ..database import db
 from ..date_tools import FHIR_datetime
@@ -16,6 +16,17 @@ trigger_states = Blueprint('trigger_states', __name__)
 def user_triggers(user_id):
     """Return a JSON object defining the current triggers for user
 
+    Rather than polling while triggers are processed, clients may wait
+    for a change of state, by long-poll:
+    :param wait: maximum seconds to wait, limited by configured
+      ``TRIGGER_STATE_MAX_WAIT_SECONDS``, by default a couple of seconds,
+      as each waiting request ties up a sync web worker.  Returns as
+      soon as the state differs from ``state``, or on timeout; clients
+      repeat the request to wait longer.
+    :param state: the state to wait out, defaults to ``inprocess``.
+      Immediately after submission, pass ``due`` to wait for processing
+      to begin.
+
     Query string parameters supported for additional debugging:
     :param reprocess_qnr_id: ID for QNR (must belong to matching patient)
     :param purge: set True to purge observations and rerun through SDC
@@ -34,7 +45,15 @@ def user_triggers(user_id):
     # confirm view access
     get_user(user_id, 'view', allow_on_url_authenticated_encounters=True)
 
-    ts = users_trigger_state(user_id)
+    wait = min(
+        request.args.get('wait', 0, type=float),
+        current_app.config['TRIGGER_STATE_MAX_WAIT_SECONDS'])
+    if wait > 0:
+        ts = await_trigger_state(
+            user_id, pending_state=request.args.get('state', 'inprocess'),
+            timeout=wait)
+    else:
+        ts = users_trigger_state(user_id)
 
     # Debugging parameter - reprocess as if given QNR was just submitted
     if request.args.get('reprocess_qnr_id'):
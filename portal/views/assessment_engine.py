@@ -1,5 +1,4 @@
 """Assessment Engine API view functions"""
-from datetime import datetime
 
 from flask import (
     Blueprint,
@@ -28,16 +27,23 @@ from ..models.encounter import EC
 from ..models.fhir import bundle_results
 from ..models.identifier import Identifier
 from ..models.intervention import INTERVENTION
+from ..models.pending_work import pending_work
+from ..models.post_submission import (
+    await_submissions,
+    submit_for_processing,
+)
 from ..models.qb_timeline import invalidate_users_QBT
 from ..models.questionnaire import Questionnaire
 from ..models.questionnaire_response import (
     NoFutureDates,
     QuestionnaireResponse,
+    paged_responses,
 )
 from ..models.research_study import (
     ResearchStudy,
     research_study_id_from_questionnaire,
 )
+from ..models.resource_version import ResourceVersion
 from ..models.role import ROLE
 from ..models.user import current_user, get_user
 from ..timeout_lock import LockTimeout, guarded_task_launch
@@ -601,31 +607,19 @@ def assessment(patient_id, instrument_id):
         patient_id, 'view', allow_on_url_authenticated_encounters=True)
     questionnaire_responses = QuestionnaireResponse.query.filter_by(
         subject_id=patient.id).order_by(
-        QuestionnaireResponse.document['authored'].desc())
+        QuestionnaireResponse.authored.desc())
 
     instrument_id = request.args.get('instrument_id', instrument_id)
     if instrument_id is not None:
         questionnaire_responses = questionnaire_responses.filter(
-            QuestionnaireResponse.document[
-                ("questionnaire", "reference")
-            ].astext.endswith(instrument_id)
-        )
+            QuestionnaireResponse.instrument_id == instrument_id)
 
     documents = []
     for qnr in questionnaire_responses:
-        # NB, document_answered returns a (potentially) modified *copy* of
-        # the document, so changes aren't persisted or found in db session
-        # cached objects.  see TN-2417 for example side-effects
+        # NB, document_answered shares unmodified branches with the
+        # persisted document, never mutate in place lest changes be
+        # persisted or found in db session cached objects.  see TN-2417
         document = qnr.document_answered
-        for question in document['group']['question']:
-            for answer in question['answer']:
-                # Hack: Extensions should be a list, correct in-place if need be
-                # todo: migrate towards FHIR spec in persisted data
-                if (
-                    'extension' in answer.get('valueCoding', {}) and
-                    not isinstance(answer['valueCoding']['extension'], (tuple, list))
-                ):
-                    answer['valueCoding']['extension'] = [answer['valueCoding']['extension']]
 
         # Hack: add missing "resource" wrapper for DTSU2 compliance
         # Remove when all interventions compliant
@@ -712,19 +706,19 @@ def get_qnr_by_id(patient_id, qnr_id):
             400,
             "Requested patient doesn't own requested questionnaire_response")
 
-    # NB, document_answered returns a (potentially) modified *copy* of
-    # the document, so changes aren't persisted or found in db session
-    # cached objects.  see TN-2417 for example side-effects
+    # The status extension of in-progress responses changes with time,
+    # as the questionnaire bank expires, so only tag those that are done
+    version = None
+    if qnr.status != 'in-progress':
+        version = ResourceVersion('questionnaire_response', qnr.id)
+        not_modified = version.not_modified()
+        if not_modified:
+            return not_modified
+
+    # NB, document_answered shares unmodified branches with the
+    # persisted document, never mutate in place lest changes be
+    # persisted or found in db session cached objects.  see TN-2417
     document = qnr.document_answered
-    for question in document['group']['question']:
-        for answer in question['answer']:
-            # Hack: Extensions should be a list, correct in-place if need be
-            # todo: migrate towards FHIR spec in persisted data
-            if (
-                'extension' in answer.get('valueCoding', {}) and
-                not isinstance(answer['valueCoding']['extension'], (tuple, list))
-            ):
-                answer['valueCoding']['extension'] = [answer['valueCoding']['extension']]
 
     # Hack: add missing "resource" wrapper for DTSU2 compliance
     # Remove when all interventions compliant
@@ -743,7 +737,8 @@ def get_qnr_by_id(patient_id, qnr_id):
         assert('extension' not in qnr.document)  # catch future collisions
         document['extension'] = extensions
 
-    return jsonify(document)
+    response = jsonify(document)
+    return version.tag(response) if version else response
 
 
 @assessment_engine_api.route('/api/patient/assessment')
@@ -790,6 +785,31 @@ def get_assessments():
             - epic26
             - eq5d
         collectionFormat: multi
+      - name: _count
+        in: query
+        description:
+          request a page of at most this many responses, returned
+          directly rather than via a background task.  Pages are ordered
+          by time of last write; the bundle includes a `next` link while
+          more remain.
+        required: false
+        type: integer
+      - name: _since
+        in: query
+        description:
+          with paging, only include responses written (submitted or
+          modified) at or after the given FHIR datetime
+        required: false
+        type: string
+        format: date-time
+      - name: _cursor
+        in: query
+        description:
+          opaque position from a previous page's `next` link.  Retain
+          the last seen to later fetch only responses written since,
+          including back dated and modified responses.
+        required: false
+        type: string
     produces:
       - application/json
     responses:
@@ -860,6 +880,9 @@ def get_assessments():
     if research_study_id is None:
         research_study_id = 0
 
+    if {'_count', '_since', '_cursor'}.intersection(request.args):
+        return assessments_page(questionnaire_list, research_study_id)
+
     # This frequently takes over a minute to produce.  Generate a serializable
     # form of all args for reliable hand off to a background task.
     kwargs = {
@@ -887,6 +910,38 @@ def get_assessments():
         return response
 
 
+def assessments_page(instrument_ids, research_study_id):
+    """Synchronous, keyset paged form of ``get_assessments()``"""
+    if request.args.get('format', 'json').lower() != 'json':
+        abort(400, "paged results only available in JSON format")
+    max_count = current_app.config['ASSESSMENT_PAGE_MAX_COUNT']
+    count = request.args.get('_count', max_count, type=int)
+    if not 0 < count <= max_count:
+        abort(400, f"_count must be between 1 and {max_count}")
+    since = FHIR_datetime.parse(
+        request.args.get('_since'), error_subject='_since', none_safe=True)
+
+    try:
+        entries, next_cursor = paged_responses(
+            instrument_ids=instrument_ids,
+            current_user=current_user(),
+            research_study_id=research_study_id,
+            count=count,
+            since=since,
+            cursor=request.args.get('_cursor'),
+            patch_dstu2=request.args.get('patch_dstu2'))
+    except ValueError as e:
+        abort(400, str(e))
+
+    links = [{'relation': 'self', 'url': request.url}]
+    if next_cursor:
+        args = request.args.to_dict(flat=False)
+        args['_cursor'] = next_cursor
+        links.append({'relation': 'next', 'url': url_for(
+            '.get_assessments', _external=True, **args)})
+    return jsonify(bundle_results(elements=entries, links=links))
+
+
 @assessment_engine_api.route(
     '/api/patient/<int:patient_id>/assessment',
     methods=('PUT',),
@@ -988,23 +1043,15 @@ def assessment_update(patient_id):
     existing_qnr.document = updated_qnr
     db.session.add(existing_qnr)
     db.session.commit()
-    existing_qnr.assign_qb_relationship(acting_user_id=current_user().id)
-
-    # TODO: only extract QuestionnaireResponses where the corresponding Questionnaire has the SDC extension
-    qn_name = existing_qnr.document.get("questionnaire").get("reference", '').split('/')[-1]
-    if qn_name == 'ironman_ss' and existing_qnr.status == 'completed':
-        from ..tasks import extract_observations_task
-        extract_observations_task.apply_async(
-            kwargs={'questionnaire_response_id': existing_qnr.id}
-        )
     auditable_event(
         "updated {}".format(existing_qnr),
         user_id=current_user().id,
         subject_id=patient.id,
         context='assessment',
     )
+    response['version'] = submit_for_processing(
+        existing_qnr, acting_user_id=current_user().id)
     response.update({'message': 'questionnaire response updated successfully'})
-    invalidate_users_QBT(patient.id, research_study_id='all')
     return jsonify(response)
 
 
@@ -1681,27 +1728,135 @@ def assessment_add(patient_id):
 
     db.session.add(questionnaire_response)
     db.session.commit()
-    questionnaire_response.assign_qb_relationship(
-        acting_user_id=current_user().id)
-
-
-    # TODO: only extract QuestionnaireResponses where the corresponding Questionnaire has the SDC extension
-    qn_name = questionnaire_response.document.get("questionnaire").get("reference", '').split('/')[-1]
-    if qn_name == 'ironman_ss' and questionnaire_response.status == 'completed':
-        from ..tasks import extract_observations_task
-        extract_observations_task.apply_async(
-            kwargs={'questionnaire_response_id': questionnaire_response.id}
-        )
-
     auditable_event("added {}".format(questionnaire_response),
-                    user_id=current_user().id, subject_id=patient_id,
+                    user_id=current_user().id, subject_id=patient.id,
                     context='assessment')
+    response['version'] = submit_for_processing(
+        questionnaire_response, acting_user_id=current_user().id)
     response.update({'message': 'questionnaire response saved successfully'})
-
-    invalidate_users_QBT(patient.id, research_study_id='all')
     return jsonify(response)
 
 
+@assessment_engine_api.route('/api/batch', methods=('POST',))
+@crossdomain()
+@oauth.require_oauth()
+def batch_submit():
+    """Add a batch of questionnaire responses and observations
+
+    Submit a FHIR Bundle of type `batch` or `transaction`, each entry
+    including the resource and a `request` POSTing to the corresponding
+    single resource endpoint, i.e. `api/patient/<id>/assessment` for a
+    QuestionnaireResponse or `api/patient/<id>/clinical` for an
+    Observation.  Entries may span several patients.
+
+    All entries are validated before any are saved; a single invalid
+    entry rejects the entire batch.  The response Bundle includes the
+    location of each saved resource, in entry order, and the submission
+    `version` for each patient with questionnaire responses.
+    ---
+    operationId: batchSubmit
+    tags:
+      - Assessment Engine
+    produces:
+      - application/json
+    parameters:
+      - name: entry_method
+        in: query
+        description:
+          Entry method such as `paper` if known, applied to all
+          questionnaire responses in the batch
+        required: false
+        type: string
+      - in: body
+        name: body
+        schema:
+          id: BatchBundle
+          required:
+            - resourceType
+            - type
+            - entry
+          properties:
+            resourceType:
+              type: string
+              description: must be Bundle
+            type:
+              type: string
+              description: batch or transaction
+            entry:
+              type: array
+              items:
+                type: object
+    responses:
+      200:
+        description: batch saved; returns a batch-response Bundle
+      400:
+        description: if the Bundle or any of its entries is invalid
+      401:
+        description:
+          if missing valid OAuth token or logged-in user lacks permission
+          to edit any of the referenced patients
+      409:
+        description:
+          if a QuestionnaireResponse identifier is already in use, or
+          repeated within the batch
+    security:
+      - ServiceToken: []
+
+    """
+    from ..models.batch_submission import (
+        BatchEntryError,
+        parse_batch,
+        persist_batch,
+        process_batch,
+        validate_batch,
+    )
+
+    if not hasattr(request, 'json') or not request.json:
+        return jsonify(message='Invalid request - requires JSON'), 400
+
+    encounter_type = None
+    if 'entry_method' in request.args:
+        entry_method = getattr(EC, request.args['entry_method'].upper(), None)
+        if entry_method is None:
+            abort(400, "unknown entry_method")
+        encounter_type = entry_method.codings[0]
+
+    acting_user = current_user()
+    try:
+        entries = parse_batch(request.json)
+        # Verify the current user has permission to edit every patient
+        patients = {
+            patient_id: get_user(
+                patient_id, 'edit',
+                allow_on_url_authenticated_encounters=True)
+            for patient_id in {e.patient_id for e in entries}}
+        validate_batch(entries)
+        persisted = persist_batch(
+            entries, patients=patients, acting_user=acting_user,
+            encounter_type=encounter_type)
+    except BatchEntryError as e:
+        return jsonify(ok=False, message=str(e), entry=e.index), e.status_code
+
+    versions = process_batch(persisted, acting_user_id=acting_user.id)
+
+    def location(item):
+        if item.resource_type == 'Observation':
+            return url_for(
+                'clinical_api.clinical_update', patient_id=item.patient_id,
+                observation_id=item.resource_id, _external=True)
+        return url_for(
+            '.get_qnr_by_id', patient_id=item.patient_id,
+            qnr_id=item.resource_id, _external=True)
+
+    return jsonify({
+        'resourceType': 'Bundle',
+        'type': '{}-response'.format(request.json['type']),
+        'version': {str(k): v for k, v in versions.items()},
+        'entry': [
+            {'response': {'status': '201 Created', 'location': location(i)}}
+            for i in persisted]})
+
+
 @assessment_engine_api.route('/api/invalidate/<int:user_id>')
 @oauth.require_oauth()
 def invalidate(user_id):
@@ -1725,35 +1880,35 @@ def present_needed():
     user is enrolled in, present-needed on the first found with outstanding
     work.  Call again after completion to pick up the next study.
 
-    """
-    from ..models.qb_status import QB_Status  # avoid cycle
+    Waits briefly on processing of the subject's recent submissions.  Pass
+    the `version` returned from the submission to wait on that one only.
 
+    """
     subject_id = request.args.get('subject_id') or current_user().id
     subject = get_user(
         subject_id, 'edit', allow_on_url_authenticated_encounters=True)
+    # read-your-writes; let any recent submissions finish processing
+    await_submissions(
+        subject.id, version=request.args.get('version', type=int))
+    # without `authored`, status is as of now
     as_of_date = FHIR_datetime.parse(
         request.args.get('authored'), none_safe=True)
-    if not as_of_date:
-        as_of_date = datetime.utcnow()
 
     for rs in ResearchStudy.assigned_to(subject):
-        assessment_status = QB_Status(
+        work = pending_work(
             subject, research_study_id=rs, as_of_date=as_of_date)
-        if assessment_status.overall_status == 'Withdrawn':
+        if work.withdrawn:
             abort(400, 'Withdrawn; no pending work found')
 
         args = dict(request.args.items())
-        args['instrument_id'] = (
-            assessment_status.instruments_needing_full_assessment(
-                classification='all'))
+        args.pop('version', None)
+        args['instrument_id'] = work.needed
 
-        # Instruments in progress need special handling.  Assemble
-        # the list of external document ids for reliable resume
+        # Instruments in progress need special handling.  The summary
+        # includes the external document ids for reliable resume
         # behavior at external assessment intervention.
-        resume_ids = assessment_status.instruments_in_progress(
-            classification='all')
-        if resume_ids:
-            args['resume_identifier'] = resume_ids
+        if work.resume_identifiers:
+            args['resume_identifier'] = work.resume_identifiers
 
         if args.get('instrument_id') or args.get('resume_identifier'):
             # work to be done in this study, break out of loop
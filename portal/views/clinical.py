@@ -7,6 +7,7 @@ from ..extensions import oauth
 from ..models.audit import Audit
 from ..models.clinical_constants import CC
 from ..models.observation import Observation
+from ..models.resource_version import ResourceVersion
 from ..models.user import current_user, get_user
 from ..models.value_quantity import ValueQuantity
 from .crossdomain import crossdomain
@@ -362,9 +363,14 @@ def clinical(patient_id):
     """
     patient = get_user(
         patient_id, 'view', allow_on_url_authenticated_encounters=True)
+    version = ResourceVersion('clinical', patient.id)
+    not_modified = version.not_modified()
+    if not_modified:
+        return not_modified
+
     patch_dstu2 = request.args.get('patch_dstu2', False)
-    return jsonify(patient.clinical_history(
-        requestURL=request.url, patch_dstu2=patch_dstu2))
+    return version.tag(jsonify(patient.clinical_history(
+        requestURL=request.url, patch_dstu2=patch_dstu2)))
 
 
 @clinical_api.route('/patient/<int:patient_id>/clinical',
@@ -7,6 +7,7 @@ from ..audit import auditable_event
 from ..database import db
 from ..extensions import oauth
 from ..models.reference import MissingReference
+from ..models.resource_version import ResourceVersion
 from ..models.user import current_user, get_user
 from .crossdomain import crossdomain
 
@@ -72,7 +73,11 @@ def demographics(patient_id):
         patient_id = current_user().id
     patient = get_user(
         patient_id, 'view', allow_on_url_authenticated_encounters=True)
-    return jsonify(patient.as_fhir(include_empties=False))
+    version = ResourceVersion('patient', patient.id)
+    not_modified = version.not_modified()
+    if not_modified:
+        return not_modified
+    return version.tag(jsonify(patient.as_fhir(include_empties=False)))
 
 
 @demographics_api.route('/demographics/<int:patient_id>', methods=('PUT',))
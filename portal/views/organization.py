@@ -13,13 +13,17 @@ from flask_user import roles_required
 from sqlalchemy import and_, exc
 
 from ..audit import auditable_event
-from ..cache import FIVE_MINS, cache, request_args_in_key
 from ..database import db
 from ..extensions import oauth
 from ..models.coding import Coding
 from ..models.identifier import Identifier
-from ..models.organization import Organization, OrganizationIdentifier, OrgTree
+from ..models.organization import (
+    Organization,
+    OrganizationIdentifier,
+    OrgTree,
+)
 from ..models.reference import MissingReference, Reference
+from ..models.resource_version import ResourceVersion
 from ..models.role import ROLE
 from ..models.user import current_user, get_user
 from ..system_uri import IETF_LANGUAGE_TAG, PRACTICE_REGION
@@ -31,7 +35,6 @@ org_api = Blueprint('org_api', __name__, url_prefix='/api')
 @org_api.route('/organization')
 @crossdomain()
 @oauth.require_oauth()
-@cache.cached(timeout=FIVE_MINS, key_prefix=request_args_in_key)
 def organization_search():
     """Obtain a bundle (list) of all matching organizations
 
@@ -91,6 +94,11 @@ def organization_search():
       - ServiceToken: []
 
     """
+    version = ResourceVersion('organization', 'all')
+    not_modified = version.not_modified()
+    if not_modified:
+        return not_modified
+
     filter = None
     found_ids = []
     system, value, tree_view = None, None, None
@@ -157,7 +165,7 @@ def organization_search():
         if matching_orgs:
             abort(400, "Can't combine search filters with `tree_view`")
         return render_template('org_tree.html', bundle=bundle)
-    return jsonify(bundle)
+    return version.tag(jsonify(bundle))
 
 
 @org_api.route('/organization/<string:id_or_code>')
@@ -360,7 +368,7 @@ def organization_post():
                     user_id=current_user().id, subject_id=current_user().id,
                     context='organization')
     OrgTree.invalidate_cache()
-    return jsonify(org.as_fhir(include_empties=False))
+    return jsonify(org.store_fhir()[False])
 
 
 @org_api.route('/organization/<int:organization_id>', methods=('PUT',))
@@ -440,7 +448,7 @@ def organization_put(organization_id):
         json.dumps(request.json)), user_id=current_user().id,
         subject_id=current_user().id, context='organization')
     OrgTree.invalidate_cache()
-    return jsonify(org.as_fhir(include_empties=False))
+    return jsonify(org.store_fhir()[False])
 
 
 @org_api.route('/user/<int:user_id>/organization')
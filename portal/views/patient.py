@@ -384,7 +384,7 @@ def patient_timeline(patient_id):
 
     qnrs = QuestionnaireResponse.query.filter(
         QuestionnaireResponse.subject_id == patient_id).order_by(
-        QuestionnaireResponse.document['authored'])
+        QuestionnaireResponse.authored)
 
     def get_recur_id(qnr):
         if qnr.questionnaire_bank and len(qnr.questionnaire_bank.recurs):
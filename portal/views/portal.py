@@ -1,5 +1,6 @@
 """Portal view functions (i.e. not part of the API or auth)"""
 
+import copy
 from datetime import datetime
 from pprint import pformat
 from time import strftime, time
@@ -27,7 +28,6 @@ from flask import (
 )
 from flask_babel import gettext as _
 from flask_sqlalchemy import get_debug_queries
-from flask_swagger import swagger
 from flask_user import roles_required
 from flask_wtf import FlaskForm
 from sqlalchemy import and_
@@ -40,6 +40,7 @@ from wtforms import (
     validators,
 )
 
+from ..api_spec import swagger_spec
 from ..audit import auditable_event
 from ..database import db
 from ..extensions import oauth
@@ -749,7 +750,7 @@ def patient_reminder_email(user_id):
     :param research_study_id: set for targeted reminder emails, defaults to 0
 
     """
-    from ..models.qb_status import QB_Status
+    from ..models.qb_status import qb_status
     user = get_user(user_id, 'edit')
     research_study_id = int(request.args.get('research_study_id', 0))
     try:
@@ -762,10 +763,7 @@ def patient_reminder_email(user_id):
             name_key = UserReminderEmail_ATMA.name_key()
 
         # If the user has a pending questionnaire bank, include for due date
-        qstats = QB_Status(
-            user,
-            research_study_id=research_study_id,
-            as_of_date=datetime.utcnow())
+        qstats = qb_status(user, research_study_id=research_study_id)
         qbd = qstats.current_qbd()
         if qbd:
             qb_id, qb_iteration = qbd.qb_id, qbd.iteration
@@ -956,7 +954,7 @@ def spec():
     Point Swagger-UI to this view for rendering
 
     """
-    swag = swagger(current_app)
+    swag = copy.deepcopy(swagger_spec())
     metadata = current_app.config.metadata
     swag.update({
         "info": {
@@ -1107,7 +1105,8 @@ def format_task_output(result):
       :required_user_id: if defined, *ONLY* said user can view the result
       :required_roles: if defined (list of role_names), *ONLY* users with
         one of the given role names can view the result
-      :response_format: with values such as ``csv`` or ``json``
+      :response_format: with values such as ``csv``, ``json`` or
+        ``manifest``
       :data: actual data to be included
 
     :return: HTTP Response appropriate for given job result.
@@ -1171,6 +1170,9 @@ def format_task_output(result):
                 'resourceType', None) == 'Bundle':
             return jsonify(data)
         return jsonify(bundle_results(elements=data))
+    elif response_format == 'manifest':
+        # bulk export manifest, served as is
+        return jsonify(data)
     else:
         abort(400, "unsupported response_format: '{}'".format(
             response_format))
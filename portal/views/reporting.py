@@ -2,22 +2,28 @@ import csv
 from datetime import datetime
 from io import StringIO
 from time import strftime
+from uuid import uuid4
 
 from flask import (
     Blueprint,
+    abort,
     jsonify,
     make_response,
     render_template,
     request,
+    send_from_directory,
     url_for,
 )
 from flask_user import roles_required
 
+from ..date_tools import FHIR_datetime
 from ..extensions import oauth
+from ..models.bulk_export import EXPORT_TYPES, export_dir, export_owner
 from ..models.organization import Organization, OrgTree
 from ..models.qb_status import QB_Status
 from ..models.role import ROLE
 from ..models.user import current_user, patients_query
+from ..stage_timing import reset_timings, timing_report
 from ..timeout_lock import LockTimeout, guarded_task_launch
 
 reporting_api = Blueprint('reporting', __name__)
@@ -51,7 +57,8 @@ def overdue_table(top_org=None):
         user=current_user(), top_org=top_org)
 
 
-def generate_overdue_table_html(overdue_stats, user, top_org):
+def generate_overdue_table_html(
+        overdue_stats, user, top_org, visible_org_ids=None):
     """generate html from given statistics
 
     :param overdue_stats: a dict keyed by
@@ -62,6 +69,8 @@ def generate_overdue_table_html(overdue_stats, user, top_org):
       patient visibility
     :param top_org: used to restrict report to a portion of the patients
       for which the given user has view permissions
+    :param visible_org_ids: optional set of organization ids the user
+      may view, when already known, in place of ``user.can_view_org()``
 
     :returns: report in html
 
@@ -71,7 +80,10 @@ def generate_overdue_table_html(overdue_stats, user, top_org):
     for org_id, org_name in sorted(overdue_stats, key=lambda x: x[1]):
         if top_org and not ot.at_or_below_ids(top_org.id, [org_id]):
             continue
-        if not user.can_view_org(org_id):
+        if visible_org_ids is not None:
+            if org_id not in visible_org_ids:
+                continue
+        elif not user.can_view_org(org_id):
             continue
 
         # For each org, generate a row with org name in position 0
@@ -228,3 +240,180 @@ def questionnaire_status():
         response = make_response(msg, 502)
         response.mimetype = "text/plain"
         return response
+
+
+@reporting_api.route('/api/report/stage_timings', methods=('GET', 'DELETE'))
+@roles_required(ROLE.ADMIN.value)
+@oauth.require_oauth()
+def stage_timings():
+    """Return (or reset) timing percentiles of messaging pipeline stages
+
+    ---
+    tags:
+      - Report
+    operationId: stage_timings
+    parameters:
+      - name: pipeline
+        in: query
+        description: optional pipeline name, such as `communication` or
+          `site_summary`, used to limit results.
+        required: false
+        type: string
+    produces:
+      - application/json
+    responses:
+      200:
+        description:
+          Returns JSON keyed by pipeline then stage, with the sample count,
+          mean, max and 50th, 90th and 99th percentile durations in seconds.
+          DELETE clears the recorded timings.
+      401:
+        description:
+          if missing valid OAuth token or if the authorized user lacks
+          permission to view timings
+
+    """
+    pipeline = request.args.get('pipeline')
+    if request.method == 'DELETE':
+        reset_timings(pipeline=pipeline)
+    return jsonify(timing_report(pipeline=pipeline))
+
+
+@reporting_api.route('/api/patient/$export')
+@roles_required([ROLE.ADMIN.value, ROLE.RESEARCHER.value])
+@oauth.require_oauth()
+def bulk_export():
+    """Launch bulk export of patient data, as FHIR NDJSON files
+
+    Modeled on the FHIR bulk data ``$export`` operation.  Exports all
+    patients the current user may view, along with their
+    QuestionnaireResponses, Observations and Procedures, as one NDJSON
+    file per resource type and chunk of patients.
+
+    Returns 202 with the status URL in the Location header.  On
+    completion, ``/task/<id>`` returns the export manifest, listing the
+    URL and resource count of each file.  Files remain available for
+    the configured ``EXPORT_RETENTION_HOURS``.
+    ---
+    tags:
+      - Report
+      - Patient
+    operationId: bulk_export
+    parameters:
+      - name: _type
+        in: query
+        description:
+          optional comma separated list of resource types to export, from
+          Patient, QuestionnaireResponse, Observation and Procedure.
+          Defaults to all.
+        required: false
+        type: string
+      - name: _since
+        in: query
+        description:
+          optional FHIR datetime; only include resources written
+          (submitted or modified) at or after.  Patient resources are
+          always included.
+        required: false
+        type: string
+        format: date-time
+    produces:
+      - application/json
+    responses:
+      202:
+        description:
+          export launched; see Location header for the status URL
+      400:
+        description: invalid query parameters
+      401:
+        description:
+          if missing valid OAuth token or if the authorized user lacks
+          permission to export
+      502:
+        description: if another export is in progress
+
+    """
+    from ..tasks import bulk_export_task
+
+    resource_types = EXPORT_TYPES
+    if request.args.get('_type'):
+        resource_types = [
+            t.strip() for t in request.args['_type'].split(',')]
+        unsupported = set(resource_types) - set(EXPORT_TYPES)
+        if unsupported:
+            abort(400, "unsupported _type: {}".format(
+                ', '.join(sorted(unsupported))))
+    since = request.args.get('_since')
+    if since:
+        since = FHIR_datetime.as_fhir(
+            FHIR_datetime.parse(since, error_subject='_since'))
+
+    kwargs = {
+        'export_id': uuid4().hex,
+        'acting_user_id': current_user().id,
+        'resource_types': list(resource_types),
+        'since': since,
+        'request_url': request.url,
+        'transaction_time': FHIR_datetime.as_fhir(datetime.utcnow()),
+        'lock_key': "bulk_export_task_lock",
+    }
+
+    try:
+        task = guarded_task_launch(bulk_export_task, **kwargs)
+        return jsonify({}), 202, {'Location': url_for(
+            'portal.task_status', task_id=task.id, _external=True)}
+    except LockTimeout:
+        msg = (
+            "The system is busy exporting data for another user. "
+            "Please try again in a few minutes.")
+        response = make_response(msg, 502)
+        response.mimetype = "text/plain"
+        return response
+
+
+@reporting_api.route('/api/export/<export_id>/<filename>')
+@roles_required([ROLE.ADMIN.value, ROLE.RESEARCHER.value])
+@oauth.require_oauth()
+def export_file(export_id, filename):
+    """Download an NDJSON file from a completed bulk export
+
+    Only available to the user who requested the export.  See
+    ``bulk_export()``; file URLs are listed in the export manifest.
+    ---
+    tags:
+      - Report
+    operationId: export_file
+    produces:
+      - application/fhir+ndjson
+    parameters:
+      - name: export_id
+        in: path
+        description: export identifier, from the manifest file URL
+        required: true
+        type: string
+      - name: filename
+        in: path
+        description: NDJSON file name, from the manifest file URL
+        required: true
+        type: string
+    responses:
+      200:
+        description: the NDJSON file
+      401:
+        description:
+          if missing valid OAuth token or if the authorized user didn't
+          request the export
+      404:
+        description: if no such export or file exists, or it expired
+
+    """
+    if not export_id.isalnum():
+        abort(404)
+    owner = export_owner(export_id)
+    if owner is None:
+        abort(404)
+    if owner != current_user().id:
+        abort(401, "export only available to the requesting user")
+    return send_from_directory(
+        export_dir(export_id), filename,
+        mimetype='application/fhir+ndjson', as_attachment=True)
@@ -5,6 +5,7 @@ from ..models.organization import (
     OrgTree,
     OrganizationResearchProtocol,
 )
+from ..models.post_submission import await_submissions
 from ..models.qb_status import patient_research_study_status
 from ..models.research_protocol import ResearchProtocol
 from ..models.research_study import ResearchStudy
@@ -73,6 +74,7 @@ def rs_for_patient(user_id):
             "only supported on patients."
             "  see also /api/staff/<id>/research_study")
 
+    await_submissions(user.id)
     return jsonify(research_study=patient_research_study_status(user))
 
 
@@ -1,4 +1,7 @@
 """TrueNTH API view functions"""
+import hashlib
+from time import time
+
 from flask import (
     Blueprint,
     current_app,
@@ -9,18 +12,108 @@ from flask import (
     session,
     url_for,
 )
+from flask_wtf.csrf import generate_csrf
+from markupsafe import escape
 from werkzeug.exceptions import Unauthorized
 
 from ..audit import auditable_event
+from ..cache import cache
 from ..csrf import csrf
 from ..extensions import oauth
 from ..models.client import validate_origin
+from ..models.i18n import get_locale
 from ..models.user import current_user
 from ..usage_monitor import mark_usage
 from .crossdomain import crossdomain
 
 truenth_api = Blueprint('truenth_api', __name__, url_prefix='/api')
 
+# Template variables holding per-user values in cached wrapper fragments
+WRAPPER_PLACEHOLDERS = {
+    name: '__portal_wrapper_{}__'.format(name) for name in (
+        'user_id',
+        'welcome_name',
+        'movember_profile',
+        'expires_in',
+        'csrf_token_value')}
+
+
+def user_fragment_key(user):
+    """Return the user attributes the shared wrapper fragment varies on"""
+    if not user:
+        return (None, (), False)
+    top_org = user.organizations[0].id if user.organizations else None
+    return (
+        top_org,
+        tuple(sorted(r.name for r in user.roles)),
+        user.is_registered())
+
+
+def cached_fragment(template, fragment_key, render):
+    """Return rendered fragment from cache, rendering on a miss
+
+    :param template: name of template, included in the cache key
+    :param fragment_key: tuple of all values the rendered fragment varies on
+    :param render: function to render the fragment on a cache miss
+
+    """
+    key = "fragment::{}::{}".format(
+        template,
+        hashlib.sha1(repr(fragment_key).encode('utf-8')).hexdigest())
+    html = cache.get(key)
+    if html is None:
+        html = render()
+        cache.set(
+            key, html, timeout=current_app.config['FRAGMENT_CACHE_TIMEOUT'])
+    return html
+
+
+def fill_placeholders(html, **values):
+    """Substitute escaped per-user values for the WRAPPER_PLACEHOLDERS"""
+    for name, value in values.items():
+        html = html.replace(
+            WRAPPER_PLACEHOLDERS[name], str(escape(value)))
+    return html
+
+
+def csrf_etag_key():
+    """Return the values an embedded CSRF token's validity depends on
+
+    CSRF tokens are signed with a timestamp, so differ on every request.
+    ETags of responses embedding a token vary on these values instead:
+    the session's raw token, which the token is bound to, and the half
+    ``WTF_CSRF_TIME_LIMIT`` interval, so a client's copy never holds a
+    token more than half its lifetime old.
+
+    NB - call after ``generate_csrf()``, which sets the raw token
+
+    """
+    limit = current_app.config.get('WTF_CSRF_TIME_LIMIT', 3600)
+    interval = int(time() // (limit / 2)) if limit else None
+    raw_token = session.get(
+        current_app.config.get('WTF_CSRF_FIELD_NAME', 'csrf_token'))
+    return raw_token, interval
+
+
+def conditional_response(html, etag_key=None):
+    """Return response with ETag, honoring If-None-Match (304)
+
+    :param html: response body
+    :param etag_key: tuple of values fully determining the body, from
+      which the ETag is derived.  Required for bodies including per
+      request values; defaults to a hash of the body.
+
+    """
+    response = make_response(html)
+    if etag_key is None:
+        response.add_etag()
+    else:
+        response.set_etag(hashlib.sha1(
+            repr(etag_key).encode('utf-8')).hexdigest())
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
 
 @truenth_api.route("/ping", methods=('POST', 'OPTIONS'))
 @csrf.portal_exempt
@@ -194,17 +287,48 @@ def portal_wrapper_html():
 
     cookie_timeout = request.cookies.get('SS_INACTIVITY_TIMEOUT')
     disable_links = True if 'disable_links' in request.args else False
-    html = render_template(
-        'portal_wrapper.html',
-        PORTAL=''.join(('//', current_app.config['SERVER_NAME'])),
-        user=user,
-        movember_profile=movember_profile,
-        login_url=login_url,
-        branded_logos=branded_logos(),
-        enable_links=not disable_links,
-        expires_in=cookie_timeout if cookie_timeout else expires_in()
-    )
-    return make_response(html)
+    user_auth_method = user.current_encounter().auth_method if user else ''
+
+    # Everything the shared fragment varies on belongs in the key;
+    # per-user values are rendered as placeholders and filled in below
+    fragment_key = (
+        get_locale(),
+        request.args.get('brand'),
+        login_url,
+        not disable_links,
+        user_auth_method,
+        'login_as_id' in session,
+    ) + user_fragment_key(user)
+
+    def render_fragment():
+        return render_template(
+            'portal_wrapper.html',
+            PORTAL=''.join(('//', current_app.config['SERVER_NAME'])),
+            user=user,
+            user_auth_method=user_auth_method,
+            login_url=login_url,
+            branded_logos=branded_logos(),
+            enable_links=not disable_links,
+            **WRAPPER_PLACEHOLDERS)
+
+    welcome_name = ''
+    if user and user.display_name != "Anonymous":
+        welcome_name = ", {}".format(user.display_name)
+    fragment = cached_fragment(
+        'portal_wrapper.html', fragment_key, render_fragment)
+    user_values = {
+        'user_id': user.id if user else '',
+        'welcome_name': welcome_name,
+        'movember_profile': movember_profile,
+        'expires_in': cookie_timeout if cookie_timeout else expires_in()}
+    html = fill_placeholders(
+        fragment, csrf_token_value=generate_csrf(), **user_values)
+    # the CSRF token changes every request; see csrf_etag_key()
+    etag_key = (
+        hashlib.sha1(fragment.encode('utf-8')).hexdigest(),
+        tuple(sorted(user_values.items())),
+        csrf_etag_key())
+    return conditional_response(html, etag_key=etag_key)
 
 
 @truenth_api.route('/portal-footer-html/', methods=('GET', 'OPTIONS'))
@@ -241,12 +365,15 @@ def portal_footer_html():
     else:
         user = current_user()
 
-    html = render_template(
-        'portal_footer.html',
-        PORTAL=''.join(('//', current_app.config['SERVER_NAME'])),
-        user=user
-    )
-    return make_response(html)
+    def render_fragment():
+        return render_template(
+            'portal_footer.html',
+            PORTAL=''.join(('//', current_app.config['SERVER_NAME'])),
+            user=user)
+
+    fragment_key = (get_locale(), bool(user))
+    html = cached_fragment('portal_footer.html', fragment_key, render_fragment)
+    return conditional_response(html)
 
 
 # Deprecated rewrites follow
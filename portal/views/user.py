@@ -37,6 +37,7 @@ from ..models.questionnaire_bank import trigger_date
 from ..models.qb_timeline import QB_StatusCacheKey, invalidate_users_QBT
 from ..models.questionnaire_response import QuestionnaireResponse
 from ..models.relationship import Relationship
+from ..models.resource_version import ResourceVersion
 from ..models.role import ROLE, Role
 from ..models.table_preference import TablePreference
 from ..models.url_token import url_token
@@ -602,8 +603,12 @@ def user_consents(user_id):
 
     """
     user = get_user(user_id, 'view')
-    return jsonify(consent_agreements=[c.as_json() for c in
-                                       user.all_consents])
+    version = ResourceVersion('consent', user.id)
+    not_modified = version.not_modified()
+    if not_modified:
+        return not_modified
+    return version.tag(jsonify(
+        consent_agreements=[c.as_json() for c in user.all_consents]))
 
 
 @user_api.route('/user/<int:user_id>/consent', methods=('POST',))
@@ -2429,14 +2434,14 @@ def get_current_user_qb(user_id):
       - ServiceToken: []
 
     """
-    from ..models.qb_status import QB_Status
+    from ..models.qb_status import qb_status
     user = get_user(user_id, 'view')
     date = request.args.get('as_of_date')
-    # allow date and time info to be available
-    date = FHIR_datetime.parse(date) if date else datetime.utcnow()
+    # allow date and time info to be available; defaults to now
+    date = FHIR_datetime.parse(date) if date else None
 
     research_study_id = int(request.args.get('research_study_id', 0))
-    qstats = QB_Status(
+    qstats = qb_status(
         user=user, research_study_id=research_study_id, as_of_date=date)
     qbd = qstats.current_qbd()
 
@@ -41,6 +41,7 @@ from portal.models.procedure import Procedure
 from portal.models.qb_timeline import invalidate_users_QBT
 from portal.models.questionnaire_bank import add_static_questionnaire_bank
 from portal.models.questionnaire import Questionnaire
+from portal.models.reference_data import ReferenceData
 from portal.models.relationship import add_static_relationships
 from portal.models.research_study import add_static_research_studies
 from portal.models.role import ROLE, Role, add_static_roles
@@ -566,6 +567,7 @@ class TestCase(Base):
             if attr.startswith('_lazy'):
                 delattr(INTERVENTION, attr)
         OrgTree.invalidate_cache()
+        ReferenceData.invalidate_cache()
 
         # Removed potentially cached data from other tests
         cache.clear()
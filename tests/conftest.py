@@ -29,6 +29,7 @@ from portal.models.organization import (
 from portal.models.practitioner import Practitioner
 from portal.models.procedure import Procedure
 from portal.models.qb_timeline import invalidate_users_QBT
+from portal.models.reference_data import ReferenceData
 from portal.models.relationship import add_static_relationships
 from portal.models.research_protocol import ResearchProtocol
 from portal.models.research_study import add_static_research_studies
@@ -214,6 +215,7 @@ def initialized_db(app):
     yield
 
     cache.clear()
+    ReferenceData.invalidate_cache()
     db.session.remove()
     db.engine.dispose()
     db.drop_all()
@@ -231,7 +233,7 @@ def celery_worker_parameters():
     as parameters when instantiating :class:`~celery.worker.WorkController`.
     """
     return {
-        'queues': ('celery', 'low_priority'),
+        'queues': ('celery', 'low_priority', 'post_submission'),
         'perform_ping_check': False}
 
 
@@ -2,12 +2,14 @@
 
 
 import sys
+import time
 from urllib.parse import parse_qsl, unquote_plus, urlparse
 
 from flask import render_template_string
 from flask_webtest import SessionScope
 import pytest
 
+from portal.cache import cache
 from portal.extensions import db
 from portal.models.app_text import (
     AppText,
@@ -15,6 +17,7 @@ from portal.models.app_text import (
     UnversionedResource,
     VersionedResource,
     app_text,
+    content_cache_key,
 )
 from portal.models.user import User
 
@@ -150,3 +153,27 @@ def test_mail_resource():
     # test footer optionality
     tmr._footer = None
     assert len(tmr.body.splitlines()) == 1
+
+
+def test_cached_mail_resource(app):
+    url = "https://notarealwebsitebeepboop.com/mail"
+    locale_code = 'en_US'
+    cache.set(content_cache_key(url + '?languageId=en_US', locale_code), {
+        'status_code': 200,
+        'reason': 'OK',
+        'text': '',
+        'json': {
+            'subject': 'cached {subjkey}',
+            'body': 'cached {bodykey}',
+            'version': '1.2'},
+        'fetched_at': time.time(),
+        'variable_list': ['bodykey', 'subjkey']})
+
+    tmr = MailResource(
+        url, locale_code=locale_code,
+        variables={'subjkey': 'subject', 'bodykey': 'body'})
+    assert tmr.error_msg is None
+    assert tmr.subject == 'cached subject'
+    assert tmr.body == 'cached body'
+    assert set(tmr.variable_list) == {'bodykey', 'subjkey'}
+    assert 'version=1.2' in tmr.url
@@ -1,4 +1,5 @@
 """Unit test module for Assessment Engine API"""
+import copy
 from datetime import datetime
 import json
 import os
@@ -12,6 +13,7 @@ import pytest
 from portal.date_tools import FHIR_datetime
 from portal.extensions import db
 from portal.models.audit import Audit
+from portal.models.coding import Coding
 from portal.models.identifier import Identifier
 from portal.models.organization import Organization
 from portal.models.questionnaire_bank import (
@@ -20,6 +22,7 @@ from portal.models.questionnaire_bank import (
 )
 from portal.models.questionnaire_response import (
     QuestionnaireResponse,
+    consolidate_answer_pairs,
     qnr_csv_column_headers,
 )
 from portal.models.research_protocol import ResearchProtocol
@@ -33,6 +36,22 @@ from portal.system_uri import (
 from tests import TEST_USER_ID, TestCase
 
 
+def test_consolidate_answer_pairs_copy_free():
+    answers = [
+        {'valueString': 'Yes'},
+        {'valueCoding': {'code': 'yes.1', 'system': 'http://example.com'}},
+        {'valueString': 'free text'},
+    ]
+    consolidated = list(consolidate_answer_pairs(answers))
+    assert consolidated == [
+        {'valueCoding': {
+            'code': 'yes.1', 'system': 'http://example.com', 'text': 'Yes'}},
+        {'valueString': 'free text'},
+    ]
+    # source answers, typically a persisted document, remain untouched
+    assert 'text' not in answers[1]['valueCoding']
+
+
 class TestAssessmentEngine(TestCase):
 
     def test_qnr_validation(self):
@@ -47,6 +66,22 @@ class TestAssessmentEngine(TestCase):
         with pytest.raises(jsonschema.ValidationError):
             QuestionnaireResponse.validate_document(data)
 
+    def test_qnr_validator_compiled_once(self):
+        from portal.api_spec import schema_validator
+        validator = schema_validator('QuestionnaireResponse')
+        assert schema_validator('QuestionnaireResponse') is validator
+
+    def test_qnr_structural_check(self):
+        with pytest.raises(jsonschema.ValidationError) as e:
+            QuestionnaireResponse.validate_document(
+                {'resourceType': 'QuestionnaireResponse'})
+        assert "'status' is a required property" in str(e.value)
+
+        with pytest.raises(jsonschema.ValidationError):
+            QuestionnaireResponse.validate_document(
+                {'resourceType': 'QuestionnaireResponse',
+                 'status': 'completed', 'bogus': True})
+
     def test_submit_assessment(self):
         swagger_spec = swagger(self.app)
         data = swagger_spec['definitions']['QuestionnaireResponse']['example']
@@ -65,6 +100,24 @@ class TestAssessmentEngine(TestCase):
             self.test_user.questionnaire_responses[0].encounter.auth_method
             == 'password_authenticated')
 
+    def test_submit_assessment_version(self):
+        from portal.models.post_submission import SubmissionVersion
+        swagger_spec = swagger(self.app)
+        data = swagger_spec['definitions']['QuestionnaireResponse']['example']
+
+        self.promote_user(role_name=ROLE.PATIENT.value)
+        self.login()
+        response = self.client.post(
+            '/api/patient/{}/assessment'.format(TEST_USER_ID), json=data)
+        assert response.status_code == 200
+        version = response.json['version']
+
+        # pipeline runs inline when testing; version is already processed
+        submitted, processed = SubmissionVersion(TEST_USER_ID).versions()
+        assert submitted == processed == version
+        qnr = db.session.merge(self.test_user).questionnaire_responses[0]
+        assert qnr.questionnaire_bank_id is not None
+
     def test_submit_invalid_assessment(self):
         data = {'no_questionnaire_field': True}
 
@@ -73,6 +126,81 @@ class TestAssessmentEngine(TestCase):
             '/api/patient/{}/assessment'.format(TEST_USER_ID), json=data)
         assert response.status_code == 400
 
+    def batch(self, *entries):
+        return {'resourceType': 'Bundle', 'type': 'batch', 'entry': [
+            {'resource': resource, 'request': {
+                'method': 'POST', 'url': 'api/patient/{}/{}'.format(
+                    TEST_USER_ID, endpoint)}}
+            for endpoint, resource in entries]}
+
+    def test_batch_submit(self):
+        swagger_spec = swagger(self.app)
+        data = swagger_spec['definitions']['QuestionnaireResponse']['example']
+        second = copy.deepcopy(data)
+        second['identifier']['value'] += '.2'
+        observation = {
+            'resourceType': 'Observation',
+            'code': {'coding': [{
+                'system': 'http://loinc.org', 'code': '28540-3'}]},
+            'valueQuantity': {
+                'value': 18.7, 'units': 'g/dl',
+                'system': 'http://unitsofmeasure.org', 'code': 'g/dl'},
+            'status': 'final',
+            'issued': '2015-08-04T13:27:00+01:00'}
+
+        self.promote_user(role_name=ROLE.PATIENT.value)
+        self.login()
+        response = self.client.post('/api/batch', json=self.batch(
+            ('assessment', data), ('clinical', observation),
+            ('assessment', second)))
+        assert response.status_code == 200
+        assert response.json['type'] == 'batch-response'
+        entries = response.json['entry']
+        assert len(entries) == 3
+        assert '/clinical/' in entries[1]['response']['location']
+        assert str(TEST_USER_ID) in response.json['version']
+
+        user = db.session.merge(self.test_user)
+        qnrs = user.questionnaire_responses.all()
+        assert len(qnrs) == 2
+        assert qnrs[0].encounter_id != qnrs[1].encounter_id
+        assert user.observations.count() == 1
+
+    def test_batch_submit_duplicate(self):
+        swagger_spec = swagger(self.app)
+        data = swagger_spec['definitions']['QuestionnaireResponse']['example']
+
+        self.promote_user(role_name=ROLE.PATIENT.value)
+        self.login()
+        response = self.client.post('/api/batch', json=self.batch(
+            ('assessment', data), ('assessment', data)))
+        assert response.status_code == 409
+        assert response.json['entry'] == 1
+        user = db.session.merge(self.test_user)
+        assert user.questionnaire_responses.count() == 0
+
+    def test_batch_submit_invalid_issued(self):
+        swagger_spec = swagger(self.app)
+        data = swagger_spec['definitions']['QuestionnaireResponse']['example']
+        observation = {
+            'resourceType': 'Observation',
+            'code': {'coding': [{
+                'system': 'http://loinc.org', 'code': 'batch-only'}]},
+            'valueQuantity': {'value': 1, 'units': 'g/dl'},
+            'issued': 'not a date'}
+
+        self.promote_user(role_name=ROLE.PATIENT.value)
+        self.login()
+        response = self.client.post('/api/batch', json=self.batch(
+            ('clinical', observation), ('assessment', data)))
+        assert response.status_code == 400
+        assert response.json['entry'] == 0
+
+        # nothing from the batch persisted, including new codings
+        user = db.session.merge(self.test_user)
+        assert user.questionnaire_responses.count() == 0
+        assert not Coding.query.filter_by(code='batch-only').count()
+
     def test_invalid_status(self):
         swagger_spec = swagger(self.app)
         data = swagger_spec['definitions']['QuestionnaireResponse']['example']
@@ -20,7 +20,13 @@ from portal.models.identifier import Identifier
 from portal.models.intervention import INTERVENTION
 from portal.models.organization import Organization
 from portal.models.overall_status import OverallStatus
-from portal.models.qb_status import QB_Status
+from portal.models import pending_work as pending_work_module
+from portal.models.pending_work import (
+    PendingWork,
+    forget_pending_work,
+    pending_work,
+)
+from portal.models.qb_status import QB_Status, qb_status
 from portal.models.qb_timeline import invalidate_users_QBT
 from portal.models.questionnaire import Questionnaire
 from portal.models.questionnaire_bank import (
@@ -31,6 +37,9 @@ from portal.models.questionnaire_response import (
     QNR_results,
     QuestionnaireResponse,
     aggregate_responses,
+    decode_cursor,
+    encode_cursor,
+    paged_responses,
     qnr_document_id,
 )
 from portal.models.recur import Recur
@@ -360,6 +369,44 @@ class TestAggregateResponses(TestQuestionnaireSetup):
             qr.qnrs
         assert "non UTC timezone" in str(e.value)
 
+    def test_derived_columns(self):
+        qr = QuestionnaireResponse(
+            subject_id=TEST_USER_ID,
+            document={
+                'status': 'completed',
+                'authored': '2021-02-05T10:00:00+10:00',
+                'questionnaire': {
+                    'reference': 'https://example.com/api/questionnaires/eortc'
+                }})
+        assert qr.instrument_id == 'eortc'
+        assert qr.authored == datetime(2021, 2, 5)
+
+        # reassignment keeps columns in sync
+        document = copy.deepcopy(qr.document)
+        document['authored'] = '2021-02-06T00:00:00Z'
+        qr.document = document
+        assert qr.authored == datetime(2021, 2, 6)
+
+    def test_document_answered_extension_list(self):
+        # no registered Questionnaire; extensions still corrected to lists
+        extension = {'url': 'http://example.com/ext', 'valueDecimal': 1}
+        qr = QuestionnaireResponse(
+            subject_id=TEST_USER_ID,
+            document={
+                'status': 'completed',
+                'authored': '2021-02-05T10:00:00Z',
+                'questionnaire': {
+                    'reference':
+                        'https://example.com/api/questionnaires/unknown'},
+                'group': {'question': [{'answer': [{'valueCoding': {
+                    'code': 'a', 'extension': extension}}]}]}})
+        document = qr.document_answered
+        answer = document['group']['question'][0]['answer'][0]
+        assert answer['valueCoding']['extension'] == [extension]
+        # persisted document untouched
+        assert qr.document['group']['question'][0]['answer'][0][
+            'valueCoding']['extension'] == extension
+
     def test_aggregate_response_timepoints(self):
         # generate a few mock qr's from various qb iterations, confirm
         # time points.
@@ -389,6 +436,62 @@ class TestAggregateResponses(TestQuestionnaireSetup):
         found = [i['timepoint'] for i in bundle['entry']]
         assert set(found) == expected
 
+    def test_cursor(self):
+        updated = datetime(2021, 2, 5, 10, 30, 15, 250)
+        assert decode_cursor(encode_cursor(updated, 12)) == (updated, 12)
+        with pytest.raises(ValueError):
+            decode_cursor('not-a-cursor')
+
+    def test_paged_responses(self):
+        nineback, nowish = associative_backdate(
+            now=now, backdate=relativedelta(months=9, hours=1))
+        self.bless_with_basics(
+            setdate=nineback, local_metastatic='metastatic')
+        instrument_id = 'eortc'
+        for months_back in (9, 6, 3, 0):
+            backdate, _ = associative_backdate(
+                now=now, backdate=relativedelta(months=months_back))
+            mock_qr(instrument_id=instrument_id, timestamp=backdate)
+
+        staff = self.add_user(username='staff')
+        staff.organizations.append(Organization.query.filter(
+                Organization.name == 'metastatic').one())
+        self.promote_user(staff, role_name=ROLE.STAFF.value)
+        staff = db.session.merge(staff)
+
+        found, cursor = [], None
+        while True:
+            entries, cursor = paged_responses(
+                instrument_ids=[instrument_id], current_user=staff,
+                research_study_id=0, count=3, cursor=cursor)
+            found.extend(entries)
+            if not cursor:
+                break
+        assert [i['timepoint'] for i in found] == [
+            'Baseline', 'Month 3', 'Month 6', 'Month 9']
+
+        # resume from the last page's position yields only new responses
+        last = QuestionnaireResponse.query.order_by(
+            QuestionnaireResponse.updated.desc()).first()
+        last_cursor = encode_cursor(last.updated, last.id)
+        entries, _ = paged_responses(
+            instrument_ids=[instrument_id], current_user=staff,
+            research_study_id=0, count=3, cursor=last_cursor)
+        assert entries == []
+
+        # including those back dated or modified since
+        backdate, _ = associative_backdate(
+            now=now, backdate=relativedelta(months=3))
+        mock_qr(instrument_id=instrument_id, timestamp=backdate)
+        baseline = QuestionnaireResponse.query.order_by(
+            QuestionnaireResponse.authored).first()
+        baseline.document = dict(baseline.document, status='completed')
+        db.session.commit()
+        entries, _ = paged_responses(
+            instrument_ids=[instrument_id], current_user=staff,
+            research_study_id=0, count=3, cursor=last_cursor)
+        assert [i['timepoint'] for i in entries] == ['Month 6', 'Baseline']
+
     def test_site_ids(self):
         # bless org w/ expected identifier type
         wanted_system = 'http://pcctc.org/'
@@ -465,6 +568,83 @@ class TestQB_Status(TestQuestionnaireSetup):
                 iteration=None,
                 status='in-progress')
 
+    def test_shared_qb_status(self):
+        self.bless_with_basics(local_metastatic='localized', setdate=now)
+        user = db.session.merge(self.test_user)
+        a_s = qb_status(user, research_study_id=0, as_of_date=now)
+        assert qb_status(user, research_study_id=0, as_of_date=now) is a_s
+
+        # writing a QNR discards the user's shared instances
+        mock_qr(instrument_id='epic26', timestamp=now)
+        user = db.session.merge(self.test_user)
+        assert qb_status(
+            user, research_study_id=0, as_of_date=now) is not a_s
+
+    def test_shared_qb_status_now(self):
+        self.bless_with_basics(local_metastatic='localized', setdate=now)
+        self.app.config['QB_STATUS_NOW_BUCKET_SECONDS'] = 60
+        try:
+            user = db.session.merge(self.test_user)
+            a_s = qb_status(user, research_study_id=0)
+            assert qb_status(user, research_study_id=0) is a_s
+
+            invalidate_users_QBT(TEST_USER_ID, research_study_id='all')
+            assert qb_status(user, research_study_id=0) is not a_s
+        finally:
+            self.app.config['QB_STATUS_NOW_BUCKET_SECONDS'] = 0
+
+    def test_pending_work(self):
+        self.bless_with_basics(local_metastatic='localized', setdate=now)
+        user = db.session.merge(self.test_user)
+        work = pending_work(user, research_study_id=0)
+        assert set(work.needed) == localized_instruments
+        assert work.ready and not work.withdrawn
+        assert work.valid_until > datetime.utcnow()
+        assert PendingWork.query.filter_by(user_id=TEST_USER_ID).count() == 1
+
+        # writing a QNR discards the summary, recomputed on next lookup
+        mock_qr(instrument_id='epic26', timestamp=now)
+        assert not PendingWork.query.filter_by(user_id=TEST_USER_ID).count()
+        user = db.session.merge(self.test_user)
+        work = pending_work(user, research_study_id=0)
+        assert set(work.needed) == localized_instruments - {'epic26'}
+
+    def test_pending_work_racing_write(self):
+        self.bless_with_basics(local_metastatic='localized', setdate=now)
+        summarize = pending_work_module.summarize
+
+        def summarize_then_write(user, research_study_id, as_of_date=None):
+            values = summarize(user, research_study_id, as_of_date)
+            # a write committed while summarizing invalidates the result
+            forget_pending_work(user.id)
+            db.session.commit()
+            return values
+
+        pending_work_module.summarize = summarize_then_write
+        try:
+            user = db.session.merge(self.test_user)
+            work = pending_work(user, research_study_id=0)
+        finally:
+            pending_work_module.summarize = summarize
+        assert set(work.needed) == localized_instruments
+        assert not PendingWork.query.filter_by(user_id=TEST_USER_ID).count()
+
+        # without interference, the next lookup persists
+        user = db.session.merge(self.test_user)
+        pending_work(user, research_study_id=0)
+        assert PendingWork.query.filter_by(user_id=TEST_USER_ID).count() == 1
+
+    def test_pending_work_org_invalidation(self):
+        self.bless_with_basics(local_metastatic='localized', setdate=now)
+        user = db.session.merge(self.test_user)
+        pending_work(user, research_study_id=0)
+        assert PendingWork.query.filter_by(user_id=TEST_USER_ID).count() == 1
+
+        org = Organization.query.filter(
+            Organization.name == 'localized').one()
+        org.invalidation_hook()
+        assert not PendingWork.query.filter_by(user_id=TEST_USER_ID).count()
+
     def test_enrolled_in_metastatic(self):
         """metastatic should include baseline and indefinite"""
         self.bless_with_basics(local_metastatic='metastatic')
@@ -0,0 +1,117 @@
+"""Test module for bulk FHIR NDJSON export"""
+from datetime import datetime
+import json
+import os
+import time
+
+from portal.extensions import db
+from portal.models.bulk_export import (
+    export_chunks,
+    export_dir,
+    export_expired,
+    export_manifest,
+    export_owner,
+    purge_exports,
+    write_chunk,
+)
+from portal.models.codeable_concept import CodeableConcept
+from portal.models.coding import Coding
+from portal.models.encounter import Encounter
+from portal.models.observation import Observation
+from portal.models.questionnaire_response import QuestionnaireResponse
+from portal.models.role import ROLE
+
+
+def test_export(
+        app, monkeypatch, tmp_path, add_user, promote_user, test_user,
+        bless_with_basics, add_procedure):
+    monkeypatch.setitem(app.config, 'EXPORT_DIR', str(tmp_path))
+    add_procedure()
+    admin = add_user(username='admin@example.com')
+    promote_user(user=admin, role_name=ROLE.ADMIN.value)
+    admin_id = db.session.merge(admin).id
+    patient_id = db.session.merge(test_user).id
+
+    chunks = export_chunks(
+        acting_user_id=admin_id, resource_types=['Patient', 'Procedure'],
+        since=None, export_id='abc123')
+    assert [c['resource_type'] for c in chunks] == ['Patient', 'Procedure']
+    assert chunks[0]['patient_ids'] == [patient_id]
+
+    results = [write_chunk(**chunk) for chunk in chunks]
+    assert [r['count'] for r in results] == [1, 1]
+    with open(os.path.join(export_dir('abc123'), results[1]['file'])) as f:
+        lines = f.read().splitlines()
+    assert json.loads(lines[0])['resourceType'] == 'Procedure'
+
+    # nothing recorded since
+    chunk = dict(chunks[1], since='2100-01-01T00:00:00Z')
+    assert write_chunk(**chunk)['count'] == 0
+
+    result = export_manifest(
+        chunk_results=results, export_id='abc123', acting_user_id=admin_id,
+        request_url='http://localhost/api/patient/$export',
+        transaction_time='2021-02-05T00:00:00Z', lock_key='lock')
+    assert result['response_format'] == 'manifest'
+    output = result['data']['output']
+    assert [o['type'] for o in output] == ['Patient', 'Procedure']
+    assert output[0]['url'].endswith('/api/export/abc123/Patient-0000.ndjson')
+    assert export_owner('abc123') == admin_id
+
+
+def test_export_extracted_observations(app, monkeypatch, tmp_path, test_user):
+    """SDC extracted observations belong to the QNR subject"""
+    monkeypatch.setitem(app.config, 'EXPORT_DIR', str(tmp_path))
+    patient_id = db.session.merge(test_user).id
+    encounter = Encounter(
+        status='finished', auth_method='password_authenticated',
+        user_id=patient_id, start_time=datetime.utcnow())
+    qnr = QuestionnaireResponse(
+        subject_id=patient_id, encounter=encounter, status='completed',
+        document={
+            'resourceType': 'QuestionnaireResponse',
+            'status': 'completed',
+            'authored': '2021-02-05T00:00:00Z'})
+    coding = Coding(
+        system='http://us.truenth.org/observation', code='ironman_ss.1',
+        display='Pain').add_if_not_found()
+    concept = CodeableConcept(codings=[coding]).add_if_not_found()
+    db.session.add(qnr)
+    db.session.flush()
+    db.session.add(Observation(
+        codeable_concept=concept, derived_from=str(qnr.id)))
+    db.session.commit()
+
+    result = write_chunk(
+        export_id='sdc', resource_type='Observation', chunk_index=0,
+        patient_ids=[patient_id], since=None)
+    assert result['count'] == 1
+    with open(os.path.join(export_dir('sdc'), result['file'])) as f:
+        fhir = json.loads(f.readline())
+    assert fhir['subject']['reference'].endswith(
+        'api/patient/{}'.format(patient_id))
+
+
+def test_purge_exports(app, monkeypatch, tmp_path):
+    monkeypatch.setitem(app.config, 'EXPORT_DIR', str(tmp_path))
+    retention = app.config['EXPORT_RETENTION_HOURS'] * 60 * 60
+    for export_id in ('complete', 'incomplete'):
+        os.makedirs(export_dir(export_id))
+    with open(os.path.join(export_dir('complete'), 'manifest.json'), 'w') as f:
+        json.dump({'required_user_id': 1, 'manifest': {}}, f)
+
+    assert not export_expired('complete')
+    assert purge_exports() == []
+    assert export_owner('complete') == 1
+
+    later = time.time() + retention + 1
+    assert export_expired('complete', now=later)
+    assert purge_exports(now=later) == ['complete', 'incomplete']
+    assert not os.path.exists(export_dir('complete'))
+    assert export_owner('complete') is None
+
+
+def test_export_bad_type(client, test_user_login, promote_user):
+    promote_user(role_name=ROLE.RESEARCHER.value)
+    response = client.get('/api/patient/$export?_type=Patient,Encounter')
+    assert response.status_code == 400
@@ -3,6 +3,8 @@
 
 from datetime import datetime
 import re
+from smtplib import SMTPException
+from unittest.mock import Mock, patch
 
 from dateutil.relativedelta import relativedelta
 from flask_webtest import SessionScope
@@ -14,11 +16,14 @@ from portal.models.clinical_constants import CC
 from portal.models.communication import (
     Communication,
     DynamicDictLookup,
+    TemplateArgsPrefetch,
     load_template_args,
+    send_communications,
 )
 from portal.models.communication_request import CommunicationRequest
 from portal.models.identifier import Identifier
 from portal.models.intervention import Intervention
+from portal.models.message import EmailMessage
 from portal.models.overall_status import OverallStatus
 from portal.models.qb_status import QB_Status
 from portal.models.qb_timeline import invalidate_users_QBT, update_users_QBT
@@ -233,6 +238,22 @@ class TestCommunication(TestQuestionnaireSetup):
         assert len([e for e in expected if e.status == 'preparation']) == 1
         assert len([e for e in expected if e.status == 'suspended']) == 2
 
+    def test_batch_skips_existing(self):
+        # Repeat runs of the batch shouldn't duplicate communications
+
+        mock_communication_request('localized', '{"days": 7}')
+        mock_communication_request('localized', '{"days": 14}')
+        self.bless_with_basics(
+            backdate=relativedelta(days=15), local_metastatic='localized')
+
+        update_patient_loop(update_cache=False, queue_messages=True)
+        assert Communication.query.count() == 2
+
+        update_patient_loop(update_cache=False, queue_messages=True)
+        assert Communication.query.count() == 2
+        assert Communication.query.filter_by(
+            status='preparation').count() == 1
+
     def test_no_email(self):
         # User w/o email shouldn't trigger communication
 
@@ -292,6 +313,91 @@ class TestCommunication(TestQuestionnaireSetup):
         assert comm.message.recipients == TEST_USERNAME
         assert comm.status == 'completed'
 
+    def test_send_communications_batch(self):
+        self.add_user('__system__')
+        self.bless_with_basics()
+        cr = mock_communication_request(
+            'localized', '{"days": 14}',
+            communication_request_name="Symptom Tracker | 3 Mo Reminder (1)")
+
+        st = Intervention.query.filter_by(name='self_management').one()
+        if not st.link_url:
+            st.link_url = 'https://stg-sm.cirg.washington.edu'
+
+        comm = Communication(user_id=TEST_USER_ID, communication_request=cr)
+        failures = send_communications([comm])
+
+        # One connection for the batch; audited as per send_message
+        assert not failures
+        assert comm.status == 'completed'
+        assert comm.message.recipients == TEST_USERNAME
+        audits = Audit.query.filter(
+            Audit.comment.contains("EmailMessage")).all()
+        assert len(audits) == 1
+        assert audits[0].subject_id == TEST_USER_ID
+
+    def test_send_communications_batch_prepare_error(self):
+        self.add_user('__system__')
+        self.bless_with_basics()
+        cr = mock_communication_request(
+            'localized', '{"days": 14}',
+            communication_request_name="Symptom Tracker | 3 Mo Reminder (1)")
+
+        st = Intervention.query.filter_by(name='self_management').one()
+        if not st.link_url:
+            st.link_url = 'https://stg-sm.cirg.washington.edu'
+
+        bad, good = (
+            Communication(
+                user_id=TEST_USER_ID, communication_request=cr,
+                status='preparation')
+            for _ in range(2))
+        bad.prepare_message = Mock(side_effect=KeyError('missing_var'))
+        failures = send_communications([bad, good])
+
+        # failure to render one doesn't block the rest of the batch
+        assert [c for c, _ in failures] == [bad]
+        assert bad.status == 'preparation'
+        assert good.status == 'completed'
+
+    def test_send_communications_batch_send_error(self):
+        self.add_user('__system__')
+        self.bless_with_basics()
+        cr = mock_communication_request(
+            'localized', '{"days": 14}',
+            communication_request_name="Symptom Tracker | 3 Mo Reminder (1)")
+
+        st = Intervention.query.filter_by(name='self_management').one()
+        if not st.link_url:
+            st.link_url = 'https://stg-sm.cirg.washington.edu'
+
+        comm = Communication(
+            user_id=TEST_USER_ID, communication_request=cr,
+            status='preparation')
+        db.session.add(comm)
+        db.session.commit()
+        comm = db.session.merge(comm)
+
+        def failed_send(email_messages):
+            # messages committed ahead of the send, as by audit events
+            db.session.commit()
+            return [SMTPException('dropped') for _ in email_messages]
+
+        with patch(
+                'portal.models.communication.send_message_batch',
+                failed_send):
+            failures = send_communications([comm])
+            db.session.commit()
+            failures = send_communications([comm])
+            db.session.commit()
+
+        # no orphaned message rows left behind by the retries
+        assert [c for c, _ in failures] == [comm]
+        assert comm.status == 'preparation'
+        assert comm.message is None
+        assert not EmailMessage.query.filter_by(
+            user_id=TEST_USER_ID).count()
+
     def test_preview(self):
         self.bless_with_basics()
         cr = mock_communication_request(
@@ -323,6 +429,27 @@ class TestCommunication(TestQuestionnaireSetup):
         dd = load_template_args(user=user)
         assert dd['practitioner_name'] == 'Bob Jones'
 
+    def test_template_args_variables(self):
+        dd = load_template_args(
+            user=None, variables=['st_button', 'unknown_var'])
+        assert set(dd) == {'st_button'}
+        assert 'Symptom Tracker' in dd['st_button']
+
+    def test_prefetch_practitioner(self):
+        self.bless_with_basics()
+        dr = self.add_practitioner(first_name='Bob', last_name='Jones')
+        with SessionScope(db):
+            db.session.add(dr)
+            db.session.commit()
+        dr, user = map(db.session.merge, (dr, self.test_user))
+        user.practitioner_id = dr.id
+
+        prefetch = TemplateArgsPrefetch(users=[user])
+        assert dr.id in prefetch.practitioners
+        dd = load_template_args(user=user, prefetch=prefetch)
+        assert dd['practitioner_name'] == 'Bob Jones'
+        assert dd['parent_org'] == '101'
+
     def test_missing_practitioner(self):
         self.bless_with_basics()
         user = db.session.merge(self.test_user)
@@ -8,7 +8,11 @@ from portal.extensions import db
 from portal.models.audit import Audit
 from portal.models.auth import AuthProvider
 from portal.models.identifier import Identifier
-from portal.models.organization import Organization, OrgTree
+from portal.models.organization import (
+    Organization,
+    OrgTree,
+    UserOrganization,
+)
 from portal.models.reference import Reference
 from portal.models.role import ROLE
 from portal.models.user import NO_EMAIL_PREFIX, User
@@ -46,6 +50,63 @@ class TestDemographics(TestCase):
         assert len(fhir['telecom']) == 1
         assert fhir['telecom'][0]['value'] == TEST_USERNAME
 
+    def test_demographics_conditional(self):
+        self.login()
+        response = self.client.get('/api/demographics/{}'.format(
+            TEST_USER_ID))
+        assert response.status_code == 200
+        etag = response.headers['ETag']
+
+        response = self.client.get(
+            '/api/demographics/{}'.format(TEST_USER_ID),
+            headers={'If-None-Match': etag})
+        assert response.status_code == 304
+        assert response.headers['ETag'] == etag
+
+        # a committed change advances the version
+        user = db.session.merge(self.test_user)
+        user.first_name = 'Changed'
+        db.session.commit()
+        response = self.client.get(
+            '/api/demographics/{}'.format(TEST_USER_ID),
+            headers={'If-None-Match': etag})
+        assert response.status_code == 200
+        assert response.json['name']['given'] == 'Changed'
+        assert response.headers['ETag'] != etag
+
+    def test_demographics_conditional_related_rows(self):
+        self.shallow_org_tree()
+        org_id = Organization.query.filter(Organization.id > 0).first().id
+        user = db.session.merge(self.test_user)
+        user.phone = '555-1234'
+        db.session.commit()
+
+        self.login()
+        response = self.client.get(
+            '/api/demographics/{}'.format(TEST_USER_ID))
+        etag = response.headers['ETag']
+
+        # phone is updated in place, on the contact point row
+        user = db.session.merge(self.test_user)
+        user.phone = '555-4321'
+        db.session.commit()
+        response = self.client.get(
+            '/api/demographics/{}'.format(TEST_USER_ID),
+            headers={'If-None-Match': etag})
+        assert response.status_code == 200
+        assert '555-4321' in [t['value'] for t in response.json['telecom']]
+        etag = response.headers['ETag']
+
+        # link rows added directly, rather than via the user's collection
+        db.session.add(UserOrganization(
+            user_id=TEST_USER_ID, organization_id=org_id))
+        db.session.commit()
+        response = self.client.get(
+            '/api/demographics/{}'.format(TEST_USER_ID),
+            headers={'If-None-Match': etag})
+        assert response.status_code == 200
+        assert response.headers['ETag'] != etag
+
     def test_demographics404(self):
         self.login()
         self.promote_user(role_name=ROLE.ADMIN.value)
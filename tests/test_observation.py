@@ -104,3 +104,36 @@ def test_parse_bundle_extensions(obs_bundle, initialized_with_ss_qnr):
 
     assert found_extensions['ultimate'] == 8
     assert found_extensions['penultimate'] == 11
+
+
+def test_parse_bundle_reuses_codings(obs_bundle, initialized_with_ss_qnr):
+    from portal.models.codeable_concept import CodeableConcept
+    from portal.models.coding import Coding
+
+    Observation.parse_obs_bundle(obs_bundle)
+    codings, concepts = Coding.query.count(), CodeableConcept.query.count()
+
+    # second submission of same bundle adds observations, not codings
+    Observation.parse_obs_bundle(obs_bundle)
+    assert Coding.query.count() == codings
+    assert CodeableConcept.query.count() == concepts
+    assert Observation.query.count() == 2 * len(obs_bundle['entry'])
+
+
+def test_domain_scores(obs_bundle, initialized_with_ss_qnr):
+    from portal.trigger_states.models import DomainScore
+
+    qnr = db.session.merge(initialized_with_ss_qnr)
+    Observation.parse_obs_bundle(obs_bundle)
+    DomainScore.record(qnr, obs_bundle)
+    with SessionScope(db):
+        db.session.commit()
+
+    qnr = db.session.merge(initialized_with_ss_qnr)
+    scores = DomainScore.scores_by_qnr([qnr.id])[qnr.id]
+    assert scores == DomainManifold.scores_from_observations(qnr.id)
+    assert DomainManifold(qnr).cur_obs == scores
+
+    # recording again replaces, rather than duplicates, the scores
+    DomainScore.record(qnr, obs_bundle)
+    assert DomainScore.query.count() == len(obs_bundle['entry'])
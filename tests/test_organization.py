@@ -9,6 +9,7 @@ from urllib.parse import quote_plus
 from flask_webtest import SessionScope
 import pytest
 
+from portal.cache import cache
 from portal.extensions import db
 from portal.models.coding import Coding
 from portal.models.identifier import Identifier
@@ -21,6 +22,8 @@ from portal.models.organization import (
     OrgTree,
     ResearchProtocolExtension,
     org_restriction_by_role,
+    organization_fhir_generation,
+    organization_fhir_key,
 )
 from portal.models.reference import Reference
 from portal.models.research_protocol import ResearchProtocol
@@ -263,6 +266,48 @@ def test_organization_list(
     assert len(bundle['entry']) == count
 
 
+def test_organization_list_after_put(
+        promote_user, test_user_login, shallow_org_tree, client):
+    promote_user(role_name=ROLE.ADMIN.value)
+
+    # first request stores serialized documents
+    response = client.get('/api/organization')
+    assert response.status_code == 200
+    names = {e['id']: e['name']
+             for e in response.json['entry']}
+    assert names[102] == '102'
+
+    response = client.put(
+        '/api/organization/102',
+        content_type='application/json',
+        data=json.dumps({'resourceType': 'Organization', 'name': 'renamed'}))
+    assert response.status_code == 200
+
+    # stored document replaced on write
+    response = client.get('/api/organization')
+    names = {e['id']: e['name']
+             for e in response.json['entry']}
+    assert names[102] == 'renamed'
+
+
+def test_organization_fhir_retired_on_commit(shallow_org_tree):
+    generation = organization_fhir_generation()
+    org = Organization.query.get(102)
+    org.store_fhir()
+    assert cache.get(organization_fhir_key(102, False, generation))
+
+    # stored documents retire only once the change commits
+    org.name = 'renamed'
+    db.session.flush()
+    assert organization_fhir_generation() == generation
+    db.session.commit()
+    generation = organization_fhir_generation()
+    assert not cache.get(organization_fhir_key(102, False, generation))
+
+    org = Organization.query.get(102)
+    assert org.store_fhir()[False]['name'] == 'renamed'
+
+
 def test_organization_search(
         shallow_org_tree, client, test_user_login):
     count = Organization.query.count()
@@ -0,0 +1,111 @@
+"""Test module for patient batch scheduling"""
+import time
+
+from portal.models.patient_batch import (
+    COST_KEY,
+    PatientBatchScheduler,
+    job_kind,
+    stream_patient_ids,
+)
+from portal.models.role import ROLE
+
+
+def test_claim_skips_in_flight(app):
+    scheduler = PatientBatchScheduler()
+    scheduler.redis.delete(scheduler.in_flight_key)
+
+    assert scheduler.claim([1, 2, 3]) == [1, 2, 3]
+    assert scheduler.claim([2, 3, 4]) == [4]
+    assert scheduler.in_flight() == {1, 2, 3, 4}
+
+    scheduler.release([1, 2, 3, 4])
+    assert scheduler.claim([2]) == [2]
+    scheduler.release([2])
+
+
+def test_stale_claims_lapse(app):
+    scheduler = PatientBatchScheduler()
+    scheduler.redis.delete(scheduler.in_flight_key)
+    timeout = scheduler.in_flight_timeout
+
+    # claim left behind by a lost task, older than the timeout
+    now = time.time()
+    assert scheduler.claim([1], now=now - timeout - 1) == [1]
+    assert scheduler.in_flight() == set()
+    assert scheduler.claim([1, 2], now=now) == [1, 2]
+    assert scheduler.claim([1, 2], now=now) == []
+    scheduler.release([1, 2])
+
+
+def test_claims_per_kind(app):
+    cache = PatientBatchScheduler(kind=job_kind(True, False))
+    messages = PatientBatchScheduler(kind=job_kind(False, True))
+    cache.redis.delete(cache.in_flight_key, messages.in_flight_key)
+
+    # a cache refresh in flight doesn't hold back queueing messages
+    assert cache.claim([1, 2]) == [1, 2]
+    assert messages.claim([1, 2]) == [1, 2]
+    cache.release([1, 2])
+    assert messages.in_flight() == {1, 2}
+    messages.release([1, 2])
+
+
+def test_release_own_claims(app):
+    scheduler = PatientBatchScheduler()
+    scheduler.redis.delete(scheduler.in_flight_key)
+    timeout = scheduler.in_flight_timeout
+
+    # a lapsed claim, since taken by another run, isn't released
+    lapsed = time.time() - timeout - 1
+    assert scheduler.claim([1, 2], now=lapsed) == [1, 2]
+    now = time.time()
+    assert scheduler.claim([1], now=now) == [1]
+    scheduler.release([1, 2], claimed_at=lapsed)
+    assert scheduler.in_flight() == {1}
+
+    scheduler.release([1], claimed_at=now)
+    assert scheduler.in_flight() == set()
+
+def test_progress_per_run(app):
+    first, second = PatientBatchScheduler(), PatientBatchScheduler()
+    first.start_run()
+    first.record_progress(queued=3)
+    second.start_run()
+    second.record_progress(queued=5)
+
+    # overlapping runs don't clobber each other's progress
+    assert first.progress()['queued'] == '3'
+    assert second.progress()['queued'] == '5'
+    assert PatientBatchScheduler().progress() == {}
+
+
+def test_batch_size_from_cost(app):
+    scheduler = PatientBatchScheduler()
+    scheduler.redis.delete(COST_KEY)
+    assert scheduler.batch_size() == app.config[
+        'UPDATE_PATIENT_TASK_BATCH_SIZE']
+
+    target = app.config['UPDATE_PATIENT_TASK_TARGET_SECONDS']
+    scheduler.record_cost(patient_count=10, seconds=10)
+    assert scheduler.batch_size() == target
+
+    # moving average weighs in the prior cost
+    scheduler.record_cost(patient_count=10, seconds=20)
+    assert scheduler.batch_size() == int(target / 1.3)
+
+    scheduler.redis.delete(COST_KEY)
+    scheduler.record_cost(patient_count=1, seconds=0.00001)
+    assert scheduler.batch_size() == app.config[
+        'UPDATE_PATIENT_TASK_MAX_BATCH_SIZE']
+    scheduler.redis.delete(COST_KEY)
+
+
+def test_stream_priority_first(add_user, promote_user):
+    ids = []
+    for i in range(3):
+        user = add_user('patient{}@example.com'.format(i))
+        promote_user(user, role_name=ROLE.PATIENT.value)
+        ids.append(user.id)
+
+    streamed = list(stream_patient_ids(page_size=2, priority={ids[2]}))
+    assert streamed == [ids[2], ids[0], ids[1]]
@@ -0,0 +1,84 @@
+"""Test module for the QuestionnaireResponse post submission pipeline"""
+from datetime import datetime
+
+import pytest
+
+from portal.database import db
+from portal.models import post_submission
+from portal.models.encounter import Encounter
+from portal.models.post_submission import (
+    SubmissionVersion,
+    await_submissions,
+    process_submissions,
+)
+from portal.models.questionnaire_response import QuestionnaireResponse
+from portal.tasks import extract_observations_task
+
+
+def test_versions(app, test_user):
+    versions = SubmissionVersion(test_user.id)
+    versions.redis.delete(versions.submitted_key, versions.processed_key)
+
+    first, second = versions.submit(), versions.submit()
+    assert (first, second) == (1, 2)
+    assert not versions.wait(timeout=0)
+
+    # out of order completion doesn't move processed back
+    versions.mark_processed(second)
+    versions.mark_processed(first)
+    assert versions.versions() == (2, 2)
+    assert versions.wait(timeout=0)
+
+    versions.submit()
+    assert versions.wait(version=second, timeout=0)
+    assert not versions.wait(timeout=0)
+
+
+def test_await_lost_submission(app, test_user):
+    versions = SubmissionVersion(test_user.id)
+    versions.redis.delete(versions.submitted_key, versions.processed_key)
+    versions.submit()
+
+    # a pipeline that never completes is only waited on once
+    app.config['POST_SUBMISSION_WAIT_SECONDS'] = 0
+    assert not await_submissions(test_user.id)
+    assert versions.versions() == (1, 1)
+    assert await_submissions(test_user.id)
+
+
+def test_extraction_failure_keeps_timeline(test_user, monkeypatch):
+    now = datetime.utcnow()
+    qnr = QuestionnaireResponse(
+        subject_id=test_user.id, status='completed', authored=now,
+        document={'questionnaire': {
+            'reference': 'https://SERVER_NAME/api/questionnaires/ironman_ss'}},
+        encounter=Encounter(
+            status='planned', auth_method='url_authenticated',
+            user_id=test_user.id, start_time=now))
+    db.session.add(qnr)
+    db.session.commit()
+    qnr_id, user_id = qnr.id, test_user.id
+
+    versions = SubmissionVersion(user_id)
+    versions.redis.delete(versions.submitted_key, versions.processed_key)
+    version = versions.submit()
+
+    invalidated = []
+    monkeypatch.setattr(
+        QuestionnaireResponse, 'assign_qb_relationship',
+        lambda self, acting_user_id: None)
+    monkeypatch.setattr(
+        post_submission, 'rebuild_timeline', lambda user_id: None)
+    monkeypatch.setattr(
+        'portal.models.qb_timeline.invalidate_users_QBT',
+        lambda *args, **kwargs: invalidated.append(args))
+
+    def broker_down(*args, **kwargs):
+        # processed version is already marked when extraction is queued
+        assert versions.versions() == (version, version)
+        raise ConnectionError('broker unavailable')
+
+    monkeypatch.setattr(extract_observations_task, 'apply_async', broker_down)
+    with pytest.raises(ConnectionError):
+        process_submissions([qnr_id], user_id, version)
+    assert not invalidated
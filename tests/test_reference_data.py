@@ -0,0 +1,82 @@
+"""Test module for reference data registry"""
+from sqlalchemy import event
+
+from portal.database import db
+from portal.models.intervention import INTERVENTION, Intervention
+from portal.models.reference_data import ReferenceData, lookup_by_name
+from portal.models.role import ROLE, Role, add_static_roles
+
+
+def test_roles_by_name(app):
+    add_static_roles()
+    db.session.commit()
+
+    registry = ReferenceData.current()
+    patient = registry.roles.by_name(ROLE.PATIENT.value)
+    assert patient.id == Role.query.filter_by(name='patient').one().id
+    assert registry.roles.get(patient.id) is patient
+    assert len(registry.roles) == Role.query.count()
+
+
+def test_registry_reused(app):
+    add_static_roles()
+    db.session.commit()
+    assert ReferenceData.current() is ReferenceData.current()
+
+
+def test_bump_generation(app):
+    first = ReferenceData.current()
+    ReferenceData.bump_generation()
+    assert ReferenceData.current() is not first
+
+
+def test_lookup_miss(app):
+    assert ReferenceData.current().roles.by_name('bogus') is None
+    assert lookup_by_name(Role, 'bogus') is None
+
+
+def test_intervention_lookup(initialized_db):
+    intervention = Intervention(name='care_plan', description='test')
+    db.session.add(intervention)
+    db.session.commit()
+
+    # added after registry load; falls back to query
+    ReferenceData.current()
+    assert INTERVENTION.CARE_PLAN.id == intervention.id
+
+    ReferenceData.bump_generation()
+    assert lookup_by_name(Intervention, 'care_plan').id == intervention.id
+
+
+def test_lookup_without_query(app):
+    add_static_roles()
+    db.session.commit()
+    ReferenceData.current()
+    db.session.remove()
+
+    statements = []
+
+    def count(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    event.listen(db.engine, 'before_cursor_execute', count)
+    try:
+        patient = lookup_by_name(Role, ROLE.PATIENT.value)
+        assert lookup_by_name(Role, ROLE.PATIENT.value) is patient
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', count)
+    assert patient in db.session
+    assert patient.name == ROLE.PATIENT.value
+    assert not statements
+
+
+def test_intervention_change_bumps_generation(initialized_db):
+    intervention = Intervention(name='care_plan', description='test')
+    db.session.add(intervention)
+    db.session.commit()
+    generation = ReferenceData.current_generation()
+
+    intervention.description = 'changed'
+    db.session.commit()
+    assert ReferenceData.current_generation() > generation
+    assert INTERVENTION.CARE_PLAN.description == 'changed'
@@ -108,6 +108,43 @@ class TestReporting(TestCase):
         assert row[3] == a_s.due_date
         assert row[4] == a_s.expired_date
 
+    def test_site_summaries(self):
+        from portal.models.app_text import AppText, SiteSummaryEmail_ATMA
+        from portal.models.audit import Audit
+        from portal.models.reporting import generate_and_send_summaries
+
+        self.add_system_user()
+        org = Organization(name='summary org')
+        # testing config substitutes content for the schema-less url
+        summary_text = AppText(
+            name=SiteSummaryEmail_ATMA.name_key(org='summary org'),
+            custom_text='site-summary')
+        with SessionScope(db):
+            db.session.add(org)
+            db.session.add(summary_text)
+            db.session.commit()
+        org = db.session.merge(org)
+        org_id = org.id
+
+        staff_ids = []
+        for i in range(2):
+            staff = self.add_user(
+                'staff{}@example.com'.format(i), first_name='Staff',
+                last_name=str(i))
+            staff.birthdate = datetime(1970, 1, 1)
+            staff.organizations.append(org)
+            with SessionScope(db):
+                db.session.commit()
+            staff = db.session.merge(staff)
+            staff_ids.append(staff.id)
+            self.promote_user(user=staff, role_name=ROLE.STAFF.value)
+
+        # Both staff share a locale and visible orgs; each gets a message
+        assert generate_and_send_summaries(org_id) is None
+        for staff_id in staff_ids:
+            assert Audit.query.filter(Audit.subject_id == staff_id).filter(
+                Audit.comment.contains('EmailMessage')).count() == 1
+
 
 class TestQBStats(TestQuestionnaireBank):
 
@@ -0,0 +1,90 @@
+"""Test module for the SDC client, against a local stub server"""
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import json
+from threading import Thread
+
+import pytest
+
+from portal.sdc_client import SDCClient, SDCError, backoff_delay
+
+
+class StubSDCHandler(BaseHTTPRequestHandler):
+    """Fails the first `failures` requests with 503, then echoes bundles"""
+    failures = 0
+    requests = []
+
+    def do_POST(self):
+        length = int(self.headers['Content-Length'])
+        payload = json.loads(self.rfile.read(length))
+        StubSDCHandler.requests.append(payload)
+        if StubSDCHandler.failures:
+            StubSDCHandler.failures -= 1
+            self.send_response(503)
+            self.end_headers()
+            return
+
+        if payload['resourceType'] == 'Bundle':
+            body = {'resourceType': 'Bundle', 'entry': [
+                {'resource': observations(e['resource'])}
+                for e in payload['entry']]}
+        else:
+            body = observations(payload)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.end_headers()
+        self.wfile.write(json.dumps(body).encode('utf-8'))
+
+    def log_message(self, format, *args):
+        pass
+
+
+def observations(qnr):
+    return {'resourceType': 'Bundle', 'entry': [], 'id': qnr['id']}
+
+
+@pytest.fixture
+def sdc_stub(app, monkeypatch):
+    server = HTTPServer(('127.0.0.1', 0), StubSDCHandler)
+    thread = Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    StubSDCHandler.failures = 0
+    StubSDCHandler.requests = []
+    monkeypatch.setitem(app.config, 'SDC_BACKOFF_SECONDS', 0)
+    yield "http://127.0.0.1:{}".format(server.server_port)
+    server.shutdown()
+    server.server_close()
+
+
+def test_backoff_bounds():
+    for attempt in range(6):
+        assert 0 <= backoff_delay(attempt, base=0.5, cap=4) <= 4
+
+
+def test_extract(sdc_stub):
+    result = SDCClient(base_url=sdc_stub).extract(
+        {'resourceType': 'QuestionnaireResponse', 'id': 'a'})
+    assert result['id'] == 'a'
+
+
+def test_extract_retries(sdc_stub):
+    StubSDCHandler.failures = 2
+    result = SDCClient(base_url=sdc_stub).extract(
+        {'resourceType': 'QuestionnaireResponse', 'id': 'a'})
+    assert result['id'] == 'a'
+    assert len(StubSDCHandler.requests) == 3
+
+
+def test_extract_gives_up(app, sdc_stub):
+    StubSDCHandler.failures = app.config['SDC_RETRIES'] + 1
+    with pytest.raises(SDCError):
+        SDCClient(base_url=sdc_stub).extract(
+            {'resourceType': 'QuestionnaireResponse', 'id': 'a'})
+
+
+def test_extract_bundle(sdc_stub):
+    qnrs = [
+        {'resourceType': 'QuestionnaireResponse', 'id': qnr_id}
+        for qnr_id in ('a', 'b', 'c')]
+    results = SDCClient(base_url=sdc_stub).extract_bundle(qnrs)
+    assert [r['id'] for r in results] == ['a', 'b', 'c']
+    assert len(StubSDCHandler.requests) == 1
@@ -0,0 +1,49 @@
+"""Test module for stage timing"""
+from portal.models.role import ROLE
+from portal.stage_timing import (
+    percentile,
+    record_timing,
+    reset_timings,
+    stage_timer,
+    timing_report,
+)
+
+
+def test_percentile():
+    samples = list(range(1, 101))
+    assert percentile(samples, 50) == 50
+    assert percentile(samples, 99) == 99
+    assert percentile([3], 90) == 3
+
+
+def test_report(app):
+    reset_timings()
+    for seconds in (0.1, 0.2, 0.3, 0.4):
+        record_timing('communication', 'smtp', seconds)
+    with stage_timer('communication', 'template_args'):
+        pass
+
+    report = timing_report()
+    smtp = report['communication']['smtp']
+    assert smtp['count'] == 4
+    assert smtp['max'] == 0.4
+    assert smtp['p50'] == 0.2
+    assert report['communication']['template_args']['count'] == 1
+
+    reset_timings(pipeline='communication')
+    assert timing_report() == {}
+
+
+def test_timings_endpoint(
+        client, test_user_login, promote_user):
+    promote_user(role_name=ROLE.ADMIN.value)
+    reset_timings()
+    record_timing('site_summary', 'smtp', 0.5)
+
+    response = client.get('/api/report/stage_timings?pipeline=site_summary')
+    assert response.status_code == 200
+    assert response.json['site_summary']['smtp']['count'] == 1
+
+    response = client.delete('/api/report/stage_timings')
+    assert response.status_code == 200
+    assert response.json == {}
@@ -1,6 +1,7 @@
 """Test module for trigger_states blueprint """
 from flask_webtest import SessionScope
 from datetime import datetime
+from threading import Timer
 import pytest
 from statemachine.exceptions import TransitionNotAllowed
 
@@ -8,9 +9,17 @@ from portal.database import db
 from portal.models.role import ROLE
 from portal.trigger_states.empro_domains import DomainTriggers
 from portal.trigger_states.empro_states import (
+    abandon_trigger_critical_section,
+    await_trigger_state,
+    TRIGGER_CLAIMS_KEY,
+    claim_trigger_states,
+    claims_redis,
+    enter_user_trigger_critical_section,
     evaluate_triggers,
     fire_trigger_events,
     initiate_trigger,
+    release_trigger_critical_section,
+    release_trigger_states,
     users_trigger_state,
 )
 from portal.trigger_states.models import TriggerState
@@ -22,6 +31,26 @@ def test_initial_state(test_user):
     assert state.state == 'unstarted'
 
 
+def test_await_trigger_state(app, test_user):
+    user_id = test_user.id
+    # not in the pending state; returns immediately
+    assert await_trigger_state(
+        user_id, pending_state='inprocess', timeout=5).state == 'unstarted'
+
+    # times out without change
+    assert await_trigger_state(
+        user_id, pending_state='unstarted', timeout=0.1).state == 'unstarted'
+
+    def transition():
+        with app.app_context():
+            db.session.add(TriggerState(user_id=user_id, state='due'))
+            db.session.commit()
+
+    Timer(0.2, transition).start()
+    assert await_trigger_state(
+        user_id, pending_state='unstarted', timeout=5).state == 'due'
+
+
 def test_initial_state_view(client, initialized_patient_logged_in):
     """Confirm unknown user gets initial state"""
     user_id = initialized_patient_logged_in.id
@@ -56,6 +85,20 @@ def test_initiate_trigger(test_user):
     assert before == results.id
 
 
+def test_abandon_trigger_critical_section(test_user):
+    user_id = test_user.id
+    initiate_trigger(user_id)
+    enter_user_trigger_critical_section(user_id)
+    assert users_trigger_state(user_id).state == 'inprocess'
+
+    # failed extraction restores state, so it may be attempted again
+    abandon_trigger_critical_section(user_id)
+    assert users_trigger_state(user_id).state == 'due'
+    enter_user_trigger_critical_section(user_id)
+    assert users_trigger_state(user_id).state == 'inprocess'
+    release_trigger_critical_section(user_id)
+
+
 def test_base_eval(
         test_user, initialized_with_ss_recur_qb, initialized_with_ss_qnr):
     test_user_id = db.session.merge(test_user).id
@@ -140,6 +183,80 @@ def test_fire_trigger_events(initialized_patient, processed_ts, promote_user):
     assert len(ts.triggers['actions']['email']) > 1
 
 
+def test_claim_trigger_states(processed_ts):
+    claims_redis().delete(TRIGGER_CLAIMS_KEY)
+    ts_id = db.session.merge(processed_ts).id
+    claimed = claim_trigger_states(('processed',), after_id=0, batch_size=5)
+    assert [ts.id for ts in claimed] == [ts_id]
+
+    # keyset cursor moves beyond claimed rows
+    assert not claim_trigger_states(
+        ('processed',), after_id=ts_id, batch_size=5)
+
+    # claims outlast commits, until released
+    db.session.commit()
+    assert not claim_trigger_states(('processed',), after_id=0, batch_size=5)
+    release_trigger_states([ts_id])
+    claimed = claim_trigger_states(('processed',), after_id=0, batch_size=5)
+    assert [ts.id for ts in claimed] == [ts_id]
+    release_trigger_states([ts_id])
+
+
+def test_fire_prepare_failure(
+        initialized_patient, processed_ts, promote_user, monkeypatch):
+    user_id = db.session.merge(initialized_patient).id
+
+    def failing_staff_emails(patient, hard_triggers, initial_notification):
+        raise ValueError("patient lacks a single organization")
+
+    monkeypatch.setattr(
+        'portal.trigger_states.empro_states.staff_emails',
+        failing_staff_emails)
+    fire_trigger_events()
+
+    # failure recorded, row left for the next run, and claim released
+    ts = users_trigger_state(user_id)
+    assert ts.state == 'processed'
+    assert 'error' in ts.triggers['actions']['email'][0]
+    assert not claims_redis().zcard(TRIGGER_CLAIMS_KEY)
+
+
+def test_fired_emails_recorded(
+        initialized_patient, processed_ts, promote_user):
+    user = db.session.merge(initialized_patient)
+    user_id = user.id
+    user.clinicians.append(user)
+    promote_user(user=user, role_name=ROLE.CLINICIAN.value)
+
+    fire_trigger_events()
+
+    ts = users_trigger_state(user_id)
+    for email in ts.triggers['actions']['email']:
+        assert email['email_message_id']
+
+
+def test_fire_unexpected_send_failure(
+        initialized_patient, processed_ts, promote_user, monkeypatch):
+    user = db.session.merge(initialized_patient)
+    user_id = user.id
+    user.clinicians.append(user)
+    promote_user(user=user, role_name=ROLE.CLINICIAN.value)
+
+    def failing_batch(email_messages):
+        return [ConnectionResetError('boom') for _ in email_messages]
+
+    monkeypatch.setattr(
+        'portal.trigger_states.empro_states.send_message_batch',
+        failing_batch)
+    with pytest.raises(ConnectionResetError):
+        fire_trigger_events()
+
+    # row left for the next run to retry, rather than half recorded
+    ts = users_trigger_state(user_id)
+    assert ts.state == 'processed'
+    assert 'actions' not in ts.triggers
+
+
 def test_fire_reminders(initialized_patient, triggered_ts, promote_user):
     # pretend patient is it's own clinician for staff email
     user = db.session.merge(initialized_patient)
@@ -1,3 +1,5 @@
+from unittest.mock import patch
+
 from tests import FIRST_NAME, LAST_NAME, TestCase
 
 
@@ -20,3 +22,46 @@ class TestTrueNTH(TestCase):
 
         assert response.status_code == 200
         assert username in response.get_data(as_text=True)
+
+    def test_portal_wrapper_etag(self):
+        self.login()
+        response = self.client.get('/api/portal-wrapper-html/')
+        assert response.status_code == 200
+        etag = response.headers['ETag']
+        assert etag
+
+        # cached fragment, same user; expect 304 on matching ETag
+        response = self.client.get(
+            '/api/portal-wrapper-html/',
+            headers={'If-None-Match': etag})
+        assert response.status_code == 304
+
+    def test_portal_wrapper_etag_ignores_csrf(self):
+        "fresh CSRF token on every request mustn't defeat the ETag"
+        self.login()
+        with patch(
+                'portal.views.truenth.generate_csrf', return_value='first'):
+            response = self.client.get('/api/portal-wrapper-html/')
+        etag = response.headers['ETag']
+
+        with patch(
+                'portal.views.truenth.generate_csrf', return_value='second'):
+            response = self.client.get(
+                '/api/portal-wrapper-html/',
+                headers={'If-None-Match': etag})
+        assert response.status_code == 304
+
+    def test_portal_wrapper_shared_fragment(self):
+        "users sharing a fragment still see their own name"
+        self.login()
+        response = self.client.get('/api/portal-wrapper-html/')
+        assert FIRST_NAME in response.get_data(as_text=True)
+
+        user = self.add_user(
+            username='test2@example.com', first_name='Other')
+        self.login(user_id=user.id)
+        response = self.client.get('/api/portal-wrapper-html/')
+        results = response.get_data(as_text=True)
+        assert 'Other' in results
+        assert FIRST_NAME not in results
+        assert '__portal_wrapper_' not in results